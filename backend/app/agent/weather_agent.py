@@ -3,24 +3,130 @@
 This module configures and manages the stateful weather assistant
 using Letta's memory and tool capabilities.
 """
-from typing import Optional, List
+from typing import AsyncIterator, Optional, Dict, Final, List, Set, Tuple, TYPE_CHECKING
+from collections import OrderedDict
+from weakref import WeakValueDictionary
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from functools import lru_cache
+import asyncio
+import importlib.util
+import inspect
+import json
 import logging
+import os
+import re
+import threading
+import time
+
+import httpx
+
+# HTTP/2 lets concurrent Letta calls share one connection (needs httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
-# Try to import from new letta_client API
 try:
-    from letta_client import Letta
-    from letta import LLMConfig, EmbeddingConfig
-    LETTA_AVAILABLE = True
+    import orjson
+    ORJSON_AVAILABLE = True
 except ImportError:
-    LETTA_AVAILABLE = False
-    Letta = None
-    LLMConfig = None
-    EmbeddingConfig = None
+    ORJSON_AVAILABLE = False
+
+# The Letta SDK pulls in a large dependency tree, so only check that it is
+# installed here and import it when a client is actually created
+LETTA_AVAILABLE = importlib.util.find_spec("letta_client") is not None
 
+if TYPE_CHECKING:
+    from letta_client import Letta
+
+from ..cache import SingleFlight, TTLCache
+from ..config import settings
 from ..tools import weather, geocoding, calendar
 
 logger = logging.getLogger(__name__)
 
+# Persistent user_id -> Letta agent ID mapping, so lookups survive restarts
+# without scanning every agent on the server
+AGENT_CACHE_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "agent_cache.json")
+# Maximum number of user -> agent ID mappings kept (least recently used are evicted;
+# evicted agents stay on the Letta server and are looked up again by name)
+MAX_CACHED_AGENTS = 10000
+# Connection pool for the Letta server; keep-alive connections are reused
+# across requests instead of reconnecting under concurrent load
+LETTA_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+# Agent replies wait on an LLM, so only the connect phase is kept short
+LETTA_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+# Seconds to skip Letta RPCs for a user after consecutive lookup misses or
+# failed agent creations, so one misbehaving client can't flood the server
+NEGATIVE_CACHE_BACKOFF = (5.0, 30.0, 300.0)
+# Maximum Letta tool calls (create/attach) in flight at once while registering
+# tools, so agent creation doesn't monopolize the shared worker threads
+MAX_CONCURRENT_TOOL_CALLS = 8
+# Attempts for a health check that times out, or a message stream that
+# couldn't connect (the first try plus one retry); deadlines come from
+# settings.letta_health_timeout / letta_request_timeout
+LETTA_REQUEST_ATTEMPTS = 2
+# Users whose batched messages are processed at the same time
+MAX_CONCURRENT_BATCH_USERS = 16
+# Seconds before an unreachable Letta server is probed again
+LETTA_REPROBE_INTERVAL = 30.0
+# Sentinel marking the end of a relayed Letta message stream
+_STREAM_END = object()
+# Health-checked Letta clients shared by every manager, keyed by server URL, so
+# each server gets one connection pool and one health check per process
+_LETTA_CLIENTS: Dict[str, "Letta"] = {}
+_letta_clients_lock = threading.Lock()
+
+
+@contextmanager
+def _timed(label: str):
+    """Log how long the wrapped outbound call took, as latency_ms."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info("%s latency_ms=%.1f", label, (time.perf_counter() - start) * 1000)
+
+
+class _OrjsonResponse(httpx.Response):
+    """httpx response that decodes JSON bodies with orjson."""
+
+    def json(self, **kwargs):
+        if kwargs:
+            return super().json(**kwargs)
+        return orjson.loads(self.content)
+
+
+class _OrjsonTransport(httpx.BaseTransport):
+    """Transport wrapper so the Letta SDK parses responses with orjson."""
+
+    def __init__(self, transport: Optional[httpx.BaseTransport] = None):
+        self._transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self._transport.handle_request(request)
+        return _OrjsonResponse(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=response.stream,
+            extensions=response.extensions,
+            request=request,
+        )
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+def _build_letta_http_client() -> httpx.Client:
+    """Build the pooled HTTP client shared by every Letta SDK call.
+
+    Returns:
+        An httpx client sized for concurrent chat traffic, decoding
+        responses with orjson when it is installed
+    """
+    transport = httpx.HTTPTransport(limits=LETTA_HTTP_LIMITS, http2=HTTP2_AVAILABLE)
+    if ORJSON_AVAILABLE:
+        transport = _OrjsonTransport(transport)
+    return httpx.Client(transport=transport, timeout=LETTA_HTTP_TIMEOUT)
+
 
 # Weather Assistant System Prompt
 WEATHER_AGENT_PERSONA = """You are a friendly and helpful Weather Intelligence Assistant. Your purpose is to help users with weather-related queries and planning.
@@ -50,10 +156,10 @@ When responding:
 Important: Always use the available tools to get real, accurate weather data. Never make up weather information."""
 
 
-WEATHER_AGENT_HUMAN = """About the user:
-- Name: Not yet known (ask if needed for personalization)
-- Preferred temperature unit: Fahrenheit (update when user specifies)
-- Home location: Not yet set
+_HUMAN_BLOCK_TEMPLATE = """About the user:
+- Name: {name}
+- Preferred temperature unit: {temperature_unit}
+- Home location: {home_location}
 - Favorite locations: None saved yet
 - Regular activities: None tracked yet
 
@@ -61,216 +167,618 @@ Recent context:
 - Last checked location: None
 - Weather alerts acknowledged: None"""
 
+# Values shown in the human memory block until the user sets a preference
+_PREFERENCE_DEFAULTS = {
+    "name": "Not yet known (ask if needed for personalization)",
+    "temperature_unit": "Fahrenheit (update when user specifies)",
+    "home_location": "Not yet set",
+}
 
-def get_weather_tools() -> List[dict]:
-    """
-    Define the tools available to the weather agent.
+WEATHER_AGENT_HUMAN = _HUMAN_BLOCK_TEMPLATE.format(**_PREFERENCE_DEFAULTS)
 
-    Returns:
-        List of tool definitions for Letta.
-    """
-    tools = [
-        {
-            "name": "get_current_weather",
-            "description": "Get current weather conditions for a specific location. Use this when the user asks about current weather, temperature, or conditions.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "latitude": {
-                        "type": "number",
-                        "description": "Latitude of the location"
-                    },
-                    "longitude": {
-                        "type": "number",
-                        "description": "Longitude of the location"
-                    },
-                    "temperature_unit": {
-                        "type": "string",
-                        "enum": ["fahrenheit", "celsius"],
-                        "description": "Temperature unit preference",
-                        "default": "fahrenheit"
-                    }
-                },
-                "required": ["latitude", "longitude"]
-            }
-        },
-        {
-            "name": "get_weather_forecast",
-            "description": "Get weather forecast for upcoming days. Use this when the user asks about future weather or wants to plan activities.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "latitude": {
-                        "type": "number",
-                        "description": "Latitude of the location"
-                    },
-                    "longitude": {
-                        "type": "number",
-                        "description": "Longitude of the location"
-                    },
-                    "days": {
-                        "type": "integer",
-                        "description": "Number of days to forecast (1-16)",
-                        "default": 7
-                    },
-                    "temperature_unit": {
-                        "type": "string",
-                        "enum": ["fahrenheit", "celsius"],
-                        "description": "Temperature unit preference",
-                        "default": "fahrenheit"
-                    }
+# Preferences kept in the agent's memory; any others are ignored
+AGENT_MEMORY_PREFERENCES: Final = frozenset(_PREFERENCE_DEFAULTS)
+
+# Human block line label -> preference key (e.g. "Home location" -> "home_location")
+_HUMAN_BLOCK_LABELS: Final = dict(
+    re.findall(r"^- (.+): \{(\w+)\}$", _HUMAN_BLOCK_TEMPLATE, re.MULTILINE)
+)
+
+
+def _format_preference(value) -> str:
+    """Format a preference value for the human memory block."""
+    value = getattr(value, "value", value)  # Enum members
+    if isinstance(value, dict):
+        return str(value.get("name") or value.get("display_name") or value)
+    return str(value)
+
+
+def _parse_human_block(value) -> Dict[str, str]:
+    """Read the preferences a user has set back out of a rendered human block."""
+    if not isinstance(value, str):
+        return {}
+    preferences = {}
+    for label, text in re.findall(r"^- (.+?): (.*)$", value, re.MULTILINE):
+        key = _HUMAN_BLOCK_LABELS.get(label)
+        if key is not None and text != _PREFERENCE_DEFAULTS[key]:
+            preferences[key] = text
+    return preferences
+
+
+@lru_cache(maxsize=1024)
+def _render_human_block(name: str, temperature_unit: str, home_location: str) -> str:
+    """Render the complete human memory block for a set of preferences."""
+    return _HUMAN_BLOCK_TEMPLATE.format(
+        name=name,
+        temperature_unit=temperature_unit,
+        home_location=home_location,
+    )
+
+
+# Parameter schemas shared by several tools
+_COORDINATE_PROPERTIES: Final[dict] = {
+    "latitude": {
+        "type": "number",
+        "description": "Latitude of the location"
+    },
+    "longitude": {
+        "type": "number",
+        "description": "Longitude of the location"
+    },
+}
+_TEMPERATURE_UNIT_PROPERTY: Final[dict] = {
+    "type": "string",
+    "enum": ["fahrenheit", "celsius"],
+    "description": "Temperature unit preference",
+    "default": "fahrenheit"
+}
+
+# Tool schemas are constant, so build them once at import time
+_WEATHER_TOOLS: Final[Tuple[dict, ...]] = (
+    {
+        "name": "get_current_weather",
+        "description": "Get current weather conditions for a specific location. Use this when the user asks about current weather, temperature, or conditions.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                **_COORDINATE_PROPERTIES,
+                "temperature_unit": _TEMPERATURE_UNIT_PROPERTY
+            },
+            "required": ["latitude", "longitude"]
+        }
+    },
+    {
+        "name": "get_weather_forecast",
+        "description": "Get weather forecast for upcoming days. Use this when the user asks about future weather or wants to plan activities.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                **_COORDINATE_PROPERTIES,
+                "days": {
+                    "type": "integer",
+                    "description": "Number of days to forecast (1-16)",
+                    "default": 7
                 },
-                "required": ["latitude", "longitude"]
-            }
-        },
-        {
-            "name": "get_hourly_forecast",
-            "description": "Get detailed hourly weather forecast. Use this for precise timing of activities or when user needs hour-by-hour weather info.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "latitude": {
-                        "type": "number",
-                        "description": "Latitude of the location"
-                    },
-                    "longitude": {
-                        "type": "number",
-                        "description": "Longitude of the location"
-                    },
-                    "hours": {
-                        "type": "integer",
-                        "description": "Number of hours to forecast (max 384)",
-                        "default": 24
-                    },
-                    "temperature_unit": {
-                        "type": "string",
-                        "enum": ["fahrenheit", "celsius"],
-                        "description": "Temperature unit preference",
-                        "default": "fahrenheit"
-                    }
+                "temperature_unit": _TEMPERATURE_UNIT_PROPERTY
+            },
+            "required": ["latitude", "longitude"]
+        }
+    },
+    {
+        "name": "get_hourly_forecast",
+        "description": "Get detailed hourly weather forecast. Use this for precise timing of activities or when user needs hour-by-hour weather info.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                **_COORDINATE_PROPERTIES,
+                "hours": {
+                    "type": "integer",
+                    "description": "Number of hours to forecast (max 384)",
+                    "default": 24
                 },
-                "required": ["latitude", "longitude"]
-            }
-        },
-        {
-            "name": "geocode_location",
-            "description": "Convert a place name or address to coordinates. Use this when the user mentions a location by name.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "Place name, address, or city to search for"
-                    },
-                    "limit": {
-                        "type": "integer",
-                        "description": "Maximum number of results",
-                        "default": 3
-                    }
+                "temperature_unit": _TEMPERATURE_UNIT_PROPERTY
+            },
+            "required": ["latitude", "longitude"]
+        }
+    },
+    {
+        "name": "geocode_location",
+        "description": "Convert a place name or address to coordinates. Use this when the user mentions a location by name.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "string",
+                    "description": "Place name, address, or city to search for"
                 },
-                "required": ["query"]
-            }
-        },
-        {
-            "name": "reverse_geocode",
-            "description": "Convert coordinates to a place name/address. Use this to identify a location from coordinates.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "latitude": {
-                        "type": "number",
-                        "description": "Latitude"
-                    },
-                    "longitude": {
-                        "type": "number",
-                        "description": "Longitude"
-                    }
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum number of results",
+                    "default": 3
+                }
+            },
+            "required": ["query"]
+        }
+    },
+    {
+        "name": "reverse_geocode",
+        "description": "Convert coordinates to a place name/address. Use this to identify a location from coordinates.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                **_COORDINATE_PROPERTIES
+            },
+            "required": ["latitude", "longitude"]
+        }
+    },
+    {
+        "name": "get_calendar_events",
+        "description": "Get the user's upcoming calendar events. Use this to check their schedule when planning weather-dependent activities.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "days_ahead": {
+                    "type": "integer",
+                    "description": "Number of days ahead to check",
+                    "default": 7
                 },
-                "required": ["latitude", "longitude"]
-            }
-        },
-        {
-            "name": "get_calendar_events",
-            "description": "Get the user's upcoming calendar events. Use this to check their schedule when planning weather-dependent activities.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "days_ahead": {
-                        "type": "integer",
-                        "description": "Number of days ahead to check",
-                        "default": 7
-                    },
-                    "max_results": {
-                        "type": "integer",
-                        "description": "Maximum number of events to return",
-                        "default": 10
-                    }
+                "max_results": {
+                    "type": "integer",
+                    "description": "Maximum number of events to return",
+                    "default": 10
+                }
+            },
+            "required": []
+        }
+    },
+    {
+        "name": "create_weather_reminder",
+        "description": "Create a weather-related reminder in the user's calendar. Use this when suggesting they bring an umbrella, jacket, etc.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "title": {
+                    "type": "string",
+                    "description": "Reminder title (e.g., 'Bring umbrella')"
                 },
-                "required": []
-            }
-        },
-        {
-            "name": "create_weather_reminder",
-            "description": "Create a weather-related reminder in the user's calendar. Use this when suggesting they bring an umbrella, jacket, etc.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "title": {
-                        "type": "string",
-                        "description": "Reminder title (e.g., 'Bring umbrella')"
-                    },
-                    "event_time": {
-                        "type": "string",
-                        "description": "ISO format datetime for the reminder"
-                    },
-                    "weather_note": {
-                        "type": "string",
-                        "description": "Weather-related reason for the reminder"
-                    }
+                "event_time": {
+                    "type": "string",
+                    "description": "ISO format datetime for the reminder"
                 },
-                "required": ["title", "event_time", "weather_note"]
-            }
+                "weather_note": {
+                    "type": "string",
+                    "description": "Weather-related reason for the reminder"
+                }
+            },
+            "required": ["title", "event_time", "weather_note"]
+        }
+    }
+)
+
+# Tool name -> implementation used when registering tools with Letta
+_TOOL_FUNCTIONS = {
+    "get_current_weather": weather.get_current_weather,
+    "get_weather_forecast": weather.get_weather_forecast,
+    "get_hourly_forecast": weather.get_hourly_forecast,
+    "geocode_location": geocoding.geocode_location,
+    "reverse_geocode": geocoding.reverse_geocode,
+    "get_calendar_events": calendar.get_calendar_events,
+    "create_weather_reminder": calendar.create_weather_reminder,
+}
+
+
+def _load_tool_payloads() -> Dict[str, dict]:
+    """Build each tool's tools.create arguments once, reading its source a single time."""
+    payloads = {}
+    for tool_def in _WEATHER_TOOLS:
+        name = tool_def["name"]
+        func = _TOOL_FUNCTIONS[name]  # fail at import if a tool has no implementation
+        try:
+            source_code = inspect.getsource(func)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Could not read source for tool {name}: {e}")
+            continue
+        payloads[name] = {
+            "source_code": source_code,
+            "description": tool_def.get("description", ""),
+            "tags": ["weather", "utility"],
         }
-    ]
+    return payloads
+
 
-    return tools
+# Tool name -> keyword arguments for tools.create (shared, never mutated)
+_TOOL_PAYLOADS: Dict[str, dict] = _load_tool_payloads()
+
+
+def get_weather_tools() -> Tuple[dict, ...]:
+    """
+    Define the tools available to the weather agent.
+
+    Returns:
+        Tuple of tool definitions for Letta (shared, do not mutate).
+    """
+    return _WEATHER_TOOLS
+
+
+# Geocoding results for the local fallback, keyed by (normalized query, limit)
+GEOCODE_CACHE_TTL = 86400  # 24 hours
+_GEOCODE_CACHE = TTLCache(maxsize=1024, ttl=GEOCODE_CACHE_TTL)
+# Current conditions, keyed by (lat, lon rounded to 2 places, temperature unit)
+CURRENT_WEATHER_CACHE_TTL = 120  # seconds
+_CURRENT_WEATHER_CACHE = TTLCache(maxsize=1024, ttl=CURRENT_WEATHER_CACHE_TTL)
+_CURRENT_WEATHER_FLIGHTS = SingleFlight()
+
+# Keyword matching for the local (no Letta) fallback, built once at import
+_WORD_RE = re.compile(r"[a-z]+")
+# "weather in Paris?", "temperature for New York" -> the place name; findall()
+# returns one place per clause ("weather in Paris? And the weather in Oslo?")
+_LOCATION_RE = re.compile(
+    r"(?:weather|temperature)\s+(?:in|for|at)\s+(.+?)\s*(?=[?!;]|\.\s*$|$)", re.I
+)
+# Time phrases that follow "weather for/at" or trail a place name: "weather
+# for tomorrow", "weather at the moment", "weather in Paris this weekend"
+_TIME_PHRASE = (
+    r"(?:right\s+)?now|today|tonight|tomorrow|later|weekend"
+    r"|(?:the|this|next)\s+(?:moment|weekend|week|morning|afternoon|evening|night)"
+)
+_TIME_ONLY_RE = re.compile(rf"(?:{_TIME_PHRASE})", re.I)
+_TIME_SUFFIX_RE = re.compile(rf"\s+(?:(?:on|at|over|for)\s+)?(?:{_TIME_PHRASE})$", re.I)
+# One case-insensitive scan for any topic keyword; the group name picks the reply
+_KEYWORDS_RE = re.compile(
+    r"\b(?:(?P<weather>weather|temperatures?)|(?P<forecast>forecasts?))\b", re.I
+)
+# Small talk is answered without tools or an LLM call when a message consists
+# only of these words ("hi there", "thank you!", "help")
+_GREETING_WORDS = frozenset({"hi", "hello", "hey", "hiya", "howdy"})
+_THANKS_WORDS = frozenset({"thanks", "thank", "thx"})
+_FAREWELL_WORDS = frozenset({"bye", "goodbye"})
+_HELP_WORDS = frozenset({"help"})
+_SMALL_TALK_WORDS = (
+    _GREETING_WORDS | _THANKS_WORDS | _FAREWELL_WORDS | _HELP_WORDS
+    | frozenset({"there", "you", "so", "much", "ok", "okay", "please", "me"})
+)
+
+_LOCAL_WEATHER_REPLY = "I can help with weather information! Please use the weather endpoints directly (/api/v1/weather/current or /api/v1/weather/forecast) with your location coordinates, or search for a location using /api/v1/geocode."
+_LOCAL_FORECAST_REPLY = "For weather forecasts, please use the /api/v1/weather/forecast endpoint with latitude and longitude coordinates."
+_LOCAL_CURRENT_WEATHER_REPLY = "Right now in {name} it's {temperature}°F and {description} (feels like {feels_like}°F)."
+_LOCAL_NOT_FOUND_REPLY = "I couldn't find a location called \"{query}\"."
+_GREETING_REPLY = "Hello! I'm your Weather Intelligence Assistant. Ask me about the weather anywhere, e.g. \"What's the weather in Paris?\""
+_HELP_REPLY = "I can tell you the current weather for any place (try \"weather in Tokyo\"), help with forecasts, and find locations. Just ask!"
+_THANKS_REPLY = "You're welcome! Let me know if you need anything else."
+_FAREWELL_REPLY = "Goodbye! Stay dry out there."
+_LOCAL_DEFAULT_REPLY = "I'm the Weather Intelligence Assistant. I can help you with weather information, forecasts, and location searches. The full AI capabilities require a Letta server connection. For now, please use the direct API endpoints for weather data."
+_KEYWORD_REPLIES = {"weather": _LOCAL_WEATHER_REPLY, "forecast": _LOCAL_FORECAST_REPLY}
+# Longer messages are rarely repeated verbatim, so they skip the reply cache
+MAX_CACHED_MESSAGE_LENGTH = 200
+
+
+def _location_queries(message: str) -> List[str]:
+    """Extract the place names from a weather question, dropping time phrases."""
+    queries = []
+    for query in _LOCATION_RE.findall(message):
+        query = _TIME_SUFFIX_RE.sub("", query.strip())
+        if query and not _TIME_ONLY_RE.fullmatch(query):
+            queries.append(query)
+    return queries
+
+
+async def _geocode_cached(query: str) -> List[dict]:
+    """Geocode a place name to its best match, reusing earlier lookups."""
+    # Place coordinates practically never change
+    key = (query.lower(), 1)
+    locations = _GEOCODE_CACHE.get(key)
+    if locations is None:
+        with _timed("geocoding.geocode_location"):
+            locations = await geocoding.geocode_location(query, limit=1)
+        _GEOCODE_CACHE.set(key, locations)
+    return locations
+
+
+async def _current_weather_cached(location: dict) -> dict:
+    """Get current conditions for a location, reusing recent and in-flight requests."""
+    # Nearby places (~1 km) share conditions for a couple of minutes, and
+    # concurrent questions about the same place share one request
+    key = (round(location["latitude"], 2), round(location["longitude"], 2), "fahrenheit")
+    current = _CURRENT_WEATHER_CACHE.get(key)
+    if current is None:
+        current = await _CURRENT_WEATHER_FLIGHTS.do(
+            key, lambda: _fetch_current_weather(key, location)
+        )
+    return current
+
+
+async def _fetch_current_weather(key: tuple, location: dict) -> dict:
+    """Fetch current conditions and store them under the cache key."""
+    with _timed("weather.get_current_weather"):
+        current = await weather.get_current_weather(location["latitude"], location["longitude"])
+    _CURRENT_WEATHER_CACHE.set(key, current)
+    return current
+
+
+class _LocalAgentId(str):
+    """Agent ID of a user answered by the local fallback instead of Letta."""
+
+    __slots__ = ()
+
+    @classmethod
+    def for_user(cls, user_id: str) -> "_LocalAgentId":
+        """Build the local agent ID for a user."""
+        return cls(f"local_agent_{user_id}")
+
+
+def _local_reply(user_id: str, response: str, tool_calls: Optional[List[dict]] = None) -> dict:
+    """Build a chat response from the local (no Letta) handler."""
+    return {
+        "response": response,
+        "tool_calls": tool_calls if tool_calls is not None else [],
+        "agent_id": _LocalAgentId.for_user(user_id)
+    }
+
+
+@lru_cache(maxsize=1024)
+def _keyword_reply(text: str) -> str:
+    """Pick the canned topic reply for a normalized message; the first topic mentioned wins."""
+    match = _KEYWORDS_RE.search(text)
+    return _KEYWORD_REPLIES[match.lastgroup] if match else _LOCAL_DEFAULT_REPLY
+
+
+def _small_talk_reply(message: str) -> Optional[str]:
+    """
+    Answer messages that are only a greeting, thanks, farewell or help request.
+
+    Args:
+        message: User's message
+
+    Returns:
+        Canned reply, or None if the message needs real handling.
+    """
+    words = set(_WORD_RE.findall(message.lower()))
+    if not words or not words <= _SMALL_TALK_WORDS:
+        return None
+    if words & _HELP_WORDS:
+        return _HELP_REPLY
+    if words & _THANKS_WORDS:
+        return _THANKS_REPLY
+    if words & _FAREWELL_WORDS:
+        return _FAREWELL_REPLY
+    if words & _GREETING_WORDS:
+        return _GREETING_REPLY
+    return None
 
 
 class WeatherAgentManager:
     """Manager for creating and interacting with Weather Intelligence Agents."""
 
-    def __init__(self, base_url: Optional[str] = None):
+    __slots__ = (
+        "base_url",
+        "_cache_path",
+        "_agents",
+        "_preferences",
+        "_home_locations",
+        "_tool_ids",
+        "_tool_locks",
+        "_tool_call_slots",
+        "_lookup_backoff",
+        "_create_backoff",
+        "_in_flight",
+        "_client",
+        "_letta_available",
+        "_next_probe_at",
+        "_connect_lock",
+        "_cache_save_lock",
+        "_pending_messages",
+        "_background_tasks",
+        "_user_locks",
+    )
+
+    def __init__(self, base_url: Optional[str] = None, cache_path: Optional[str] = None):
         """
         Initialize the Weather Agent Manager.
 
         Args:
             base_url: Optional Letta server URL (uses default if not provided)
+            cache_path: Optional path of the persistent agent ID cache
         """
         self.base_url = base_url or "http://localhost:8283"
-        self._agents = {}
-        self._client = None
-        self._letta_available = False
+        self._cache_path = cache_path or AGENT_CACHE_PATH
+        self._agents: "OrderedDict[str, str]" = OrderedDict()
+        # user_id -> saved preferences / home location, bounded like _agents
+        self._preferences: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._home_locations: "OrderedDict[str, dict]" = OrderedDict()
+        self._tool_ids: Dict[str, str] = {}  # tool name -> Letta tool ID
+        self._tool_locks: Dict[str, asyncio.Lock] = {}
+        self._tool_call_slots = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS)
+        # user_id -> (retry-at monotonic time, consecutive failures)
+        self._lookup_backoff: Dict[str, Tuple[float, int]] = {}
+        self._create_backoff: Dict[str, Tuple[float, int]] = {}
+        # In-flight agent lookups/creations, keyed by (operation, user_id)
+        self._in_flight = SingleFlight()
+        self._client: Optional["Letta"] = None
+        # None until the Letta connection is first needed (see ensure_connected)
+        self._letta_available: Optional[bool] = None
+        # Monotonic time after which a standalone manager retries the server
+        self._next_probe_at = 0.0
+        self._connect_lock = threading.Lock()
+        self._cache_save_lock = asyncio.Lock()
+        # user_id -> (messages waiting to be sent, future for the shared reply)
+        self._pending_messages: Dict[str, Tuple[List[str], asyncio.Future]] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        # One conversation turn at a time per agent; a user's lock is dropped
+        # as soon as no request holds or waits on it
+        self._user_locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
 
-        # Try to initialize Letta client
-        if LETTA_AVAILABLE:
+    def _check_health(self):
+        """Run the Letta health check with a deadline, retrying once on timeout."""
+        for attempt in range(1, LETTA_REQUEST_ATTEMPTS + 1):
+            # Not a with-block: that would wait for a hung check to finish
+            pool = ThreadPoolExecutor(max_workers=1)
             try:
-                self._client = Letta(base_url=self.base_url)
-                # Test connection
-                self._client.health.check()
-                self._letta_available = True
-                logger.info("Letta client connected successfully")
-            except Exception as e:
-                logger.warning(f"Letta server not available: {e}. Running in standalone mode.")
+                with _timed("letta.health.check"):
+                    pool.submit(self._client.health.check).result(
+                        timeout=settings.letta_health_timeout
+                    )
+                return
+            except FuturesTimeoutError:
+                if attempt == LETTA_REQUEST_ATTEMPTS:
+                    raise TimeoutError(
+                        f"Health check timed out after {settings.letta_health_timeout}s"
+                    )
+                logger.warning(f"Letta health check timed out (attempt {attempt}), retrying")
+            finally:
+                pool.shutdown(wait=False)
+
+    async def ensure_connected(self) -> bool:
+        """
+        Connect to the Letta server on first use.
+
+        A server that was unreachable is probed again at most every
+        LETTA_REPROBE_INTERVAL seconds, so the manager recovers once it is up.
+
+        Returns:
+            True if Letta is available, False when running in standalone mode.
+        """
+        if self._needs_connect():
+            persisted = await asyncio.to_thread(self._connect)
+            # Merged here rather than in the worker thread, which would race
+            # the loop's reads of the LRU; IDs resolved meanwhile are newer
+            for user_id, agent_id in (persisted or {}).items():
+                if user_id not in self._agents:
+                    self._remember_agent(user_id, agent_id)
+        return self._letta_available
+
+    def _needs_connect(self) -> bool:
+        """Whether the server has never been checked or is due for a re-probe."""
+        if self._letta_available is None:
+            return True
+        return not self._letta_available and time.monotonic() >= self._next_probe_at
+
+    def _connect(self) -> Optional[Dict[str, str]]:
+        """
+        Create the Letta client and check the server (until it succeeds).
+
+        Returns:
+            The persisted agent ID mapping once connected, None otherwise.
+        """
+        with self._connect_lock:
+            if not self._needs_connect():
+                return None
+
+            # Try to initialize Letta client
+            if LETTA_AVAILABLE:
+                try:
+                    with _letta_clients_lock:
+                        self._client = _LETTA_CLIENTS.get(self.base_url)
+                        if self._client is None:
+                            from letta_client import Letta
+
+                            http_client = _build_letta_http_client()
+                            self._client = Letta(base_url=self.base_url, http_client=http_client)
+                            # Test connection; don't leak a pool per failed probe
+                            try:
+                                self._check_health()
+                            except Exception:
+                                http_client.close()
+                                raise
+                            _LETTA_CLIENTS[self.base_url] = self._client
+                            logger.info("Letta client connected successfully")
+                    persisted = self._load_agent_cache()
+                    self._letta_available = True
+                    return persisted
+                except Exception as e:
+                    logger.warning(f"Letta server not available: {e}. Running in standalone mode.")
+                    self._letta_available = False
+                    self._next_probe_at = time.monotonic() + LETTA_REPROBE_INTERVAL
+            else:
+                logger.warning("Letta client not installed. Running in standalone mode.")
                 self._letta_available = False
-        else:
-            logger.warning("Letta client not installed. Running in standalone mode.")
+                # Installing the package needs a restart, so never re-probe
+                self._next_probe_at = float("inf")
+            return None
 
     @property
     def client(self):
         """Get the Letta client if available."""
         return self._client
 
-    def create_agent(self, user_id: str) -> str:
+    def _load_agent_cache(self) -> Dict[str, str]:
+        """Load the persisted user_id -> agent ID mapping."""
+        if not os.path.exists(self._cache_path):
+            return {}
+        try:
+            with open(self._cache_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load agent cache: {e}")
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return {str(user_id): str(agent_id) for user_id, agent_id in data.items()}
+
+    async def _save_agent_cache(self):
+        """Persist Letta-backed agent IDs (local fallback IDs are not stored)."""
+        # Saves run one at a time, each snapshotting the map when its turn
+        # comes, so a slower older write can never replace a newer one
+        async with self._cache_save_lock:
+            remote_agents = {
+                user_id: agent_id for user_id, agent_id in self._agents.items()
+                if not isinstance(agent_id, _LocalAgentId)
+            }
+            await asyncio.to_thread(self._write_agent_cache, remote_agents)
+
+    def _write_agent_cache(self, remote_agents: Dict[str, str]):
+        """Write the agent ID mapping to disk atomically (runs in a worker thread)."""
+        tmp_path = f"{self._cache_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(remote_agents, f)
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            logger.warning(f"Could not save agent cache: {e}")
+
+    def _cached_agent_id(self, user_id: str) -> Optional[str]:
+        """Get a cached agent ID, marking it as recently used."""
+        agent_id = self._agents.get(user_id)
+        if agent_id is not None:
+            self._agents.move_to_end(user_id)
+        return agent_id
+
+    def _remember_agent(self, user_id: str, agent_id: str):
+        """Cache an agent ID, evicting the least recently used entries."""
+        self._remember(self._agents, user_id, agent_id)
+
+    @staticmethod
+    def _remember(table: OrderedDict, user_id: str, value):
+        """Store per-user state, evicting the least recently used users."""
+        table[user_id] = value
+        table.move_to_end(user_id)
+        while len(table) > MAX_CACHED_AGENTS:
+            table.popitem(last=False)
+
+    @staticmethod
+    def _in_backoff(table: Dict[str, Tuple[float, int]], user_id: str) -> bool:
+        """Check whether a user's recent miss or failure is still being backed off."""
+        entry = table.get(user_id)
+        return entry is not None and time.monotonic() < entry[0]
+
+    @staticmethod
+    def _back_off(table: Dict[str, Tuple[float, int]], user_id: str):
+        """Record a miss or failure, backing off longer on each consecutive one."""
+        now = time.monotonic()
+        failures = table[user_id][1] + 1 if user_id in table else 1
+        delay = NEGATIVE_CACHE_BACKOFF[min(failures, len(NEGATIVE_CACHE_BACKOFF)) - 1]
+        table[user_id] = (now + delay, failures)
+        if len(table) > MAX_CACHED_AGENTS:
+            for key in [k for k, (retry_at, _) in table.items() if retry_at <= now]:
+                del table[key]
+
+    def _find_remote_agent(self, user_id: str) -> Optional[str]:
+        """Look up a user's agent on the Letta server by name (single filtered request)."""
+        with _timed("letta.agents.list"):
+            for agent in self._client.agents.list(name=f"weather_agent_{user_id}", limit=1):
+                return agent.id
+        return None
+
+    async def create_agent(self, user_id: str) -> str:
         """
         Create a new weather agent for a user.
 
@@ -280,84 +788,133 @@ class WeatherAgentManager:
         Returns:
             Agent ID for the created agent.
         """
-        # If Letta is not available, use a simple local agent ID
-        if not self._letta_available:
-            agent_id = f"local_agent_{user_id}"
-            self._agents[user_id] = agent_id
-            return agent_id
+        # If Letta is not available, use a simple local agent ID; it isn't
+        # cached, so the user gets a real agent once the server is back
+        if not await self.ensure_connected():
+            return _LocalAgentId.for_user(user_id)
+
+        cached_id = self._cached_agent_id(user_id)
+        if cached_id is not None:
+            return cached_id
+
+        # Concurrent first messages from one user share a single creation
+        return await self._in_flight.do(("create", user_id), lambda: self._create_agent(user_id))
+
+    async def _create_agent(self, user_id: str) -> str:
+        """Find or create the user's Letta agent (one call per user at a time)."""
+        cached_id = self._cached_agent_id(user_id)
+        if cached_id is not None:
+            return cached_id
+
+        # Creation failed recently; answer locally until the backoff expires
+        if self._in_backoff(self._create_backoff, user_id):
+            return _LocalAgentId.for_user(user_id)
 
         try:
-            # Check if agent already exists for this user
-            existing_agents = self._client.agents.list()
-            for agent in existing_agents:
-                if agent.name == f"weather_agent_{user_id}":
-                    self._agents[user_id] = agent.id
-                    return agent.id
+            # Check if agent already exists for this user (skipped when a
+            # lookup has just missed)
+            if not self._in_backoff(self._lookup_backoff, user_id):
+                existing_id = await asyncio.to_thread(self._find_remote_agent, user_id)
+                if existing_id:
+                    self._lookup_backoff.pop(user_id, None)
+                    self._remember_agent(user_id, existing_id)
+                    await self._save_agent_cache()
+                    return existing_id
 
             # Create the agent with new API
-            agent_state = self._client.agents.create(
-                name=f"weather_agent_{user_id}",
-                system=WEATHER_AGENT_PERSONA,
-                memory_blocks=[
-                    {"label": "human", "value": WEATHER_AGENT_HUMAN},
-                    {"label": "persona", "value": WEATHER_AGENT_PERSONA}
-                ],
-                model="gpt-4o-mini",
-                embedding="text-embedding-ada-002"
-            )
+            with _timed("letta.agents.create"):
+                agent_state = await asyncio.to_thread(
+                    self._client.agents.create,
+                    name=f"weather_agent_{user_id}",
+                    system=WEATHER_AGENT_PERSONA,
+                    memory_blocks=[
+                        {"label": "human", "value": WEATHER_AGENT_HUMAN},
+                        {"label": "persona", "value": WEATHER_AGENT_PERSONA}
+                    ],
+                    model="gpt-4o-mini",
+                    embedding="text-embedding-ada-002"
+                )
 
             # Register tools with the agent
-            self._register_tools(agent_state.id)
+            await self._register_tools(agent_state.id)
 
-            self._agents[user_id] = agent_state.id
+            self._lookup_backoff.pop(user_id, None)
+            self._create_backoff.pop(user_id, None)
+            self._remember_agent(user_id, agent_state.id)
+            await self._save_agent_cache()
             return agent_state.id
         except Exception as e:
             logger.error(f"Error creating agent: {e}")
-            # Fallback to local agent
-            agent_id = f"local_agent_{user_id}"
-            self._agents[user_id] = agent_id
-            return agent_id
+            # Fallback to local agent; creation is retried once the backoff expires
+            self._back_off(self._create_backoff, user_id)
+            return _LocalAgentId.for_user(user_id)
 
-    def _register_tools(self, agent_id: str):
-        """Register weather tools with an agent."""
+    async def _register_tools(self, agent_id: str):
+        """Register weather tools with an agent (all tools concurrently)."""
         if not self._letta_available:
             return
 
-        tools = get_weather_tools()
-        for tool_def in tools:
-            try:
-                # Get source code for the tool function
-                func = self._get_tool_function(tool_def["name"])
-                if func is None:
-                    continue
-
-                import inspect
-                source_code = inspect.getsource(func)
-
-                tool = self._client.tools.create(
-                    source_code=source_code,
-                    description=tool_def.get("description", ""),
-                    tags=["weather", "utility"]
-                )
+        await asyncio.gather(
+            *(self._register_tool(agent_id, tool_def) for tool_def in _WEATHER_TOOLS)
+        )
+
+    async def _register_tool(self, agent_id: str, tool_def: dict):
+        """Attach a single tool to an agent, creating it on first use."""
+        try:
+            async with self._tool_call_slots:
+                tool_id = await self._get_tool_id(tool_def)
+
                 # Add tool to agent
-                self._client.agents.tools.create(agent_id=agent_id, tool_id=tool.id)
-            except Exception as e:
-                logger.warning(f"Could not register tool {tool_def['name']}: {e}")
-
-    def _get_tool_function(self, name: str):
-        """Get the actual function for a tool name."""
-        tool_functions = {
-            "get_current_weather": weather.get_current_weather,
-            "get_weather_forecast": weather.get_weather_forecast,
-            "get_hourly_forecast": weather.get_hourly_forecast,
-            "geocode_location": geocoding.geocode_location,
-            "reverse_geocode": geocoding.reverse_geocode,
-            "get_calendar_events": calendar.get_calendar_events,
-            "create_weather_reminder": calendar.create_weather_reminder,
-        }
-        return tool_functions.get(name)
+                with _timed("letta.agents.tools.create"):
+                    await asyncio.to_thread(
+                        self._client.agents.tools.create, agent_id=agent_id, tool_id=tool_id
+                    )
+        except Exception as e:
+            logger.warning(f"Could not register tool {tool_def['name']}: {e}")
 
-    def get_agent_id(self, user_id: str) -> Optional[str]:
+    async def _get_tool_id(self, tool_def: dict) -> str:
+        """
+        Get the Letta tool ID for a tool definition.
+
+        Tools are shared by all agents, so each one is created on the
+        server only once and its ID reused for every later agent. A tool
+        that already exists on the server (e.g. from an earlier run) is
+        reused instead of being uploaded again.
+        """
+        name = tool_def["name"]
+        tool_id = self._tool_ids.get(name)
+        if tool_id is not None:
+            return tool_id
+
+        lock = self._tool_locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            tool_id = self._tool_ids.get(name)
+            if tool_id is not None:
+                return tool_id
+
+            with _timed("letta.tools.list"):
+                existing = await asyncio.to_thread(self._find_remote_tool, name)
+            if existing is not None:
+                self._tool_ids[name] = existing
+                return existing
+
+            payload = _TOOL_PAYLOADS.get(name)
+            if payload is None:
+                raise ValueError(f"Source code unavailable for tool {name}")
+
+            with _timed("letta.tools.create"):
+                tool = await asyncio.to_thread(self._client.tools.create, **payload)
+            self._tool_ids[name] = tool.id
+            return tool.id
+
+    def _find_remote_tool(self, name: str) -> Optional[str]:
+        """Look up an existing Letta tool by name, returning its ID."""
+        for tool in self._client.tools.list(name=name, limit=1):
+            if tool.name == name:
+                return tool.id
+        return None
+
+    async def get_agent_id(self, user_id: str) -> Optional[str]:
         """
         Get the agent ID for a user.
 
@@ -367,28 +924,48 @@ class WeatherAgentManager:
         Returns:
             Agent ID if exists, None otherwise.
         """
-        if user_id in self._agents:
-            return self._agents[user_id]
+        cached_id = self._cached_agent_id(user_id)
+        if cached_id is not None:
+            return cached_id
 
-        if not self._letta_available:
+        if not await self.ensure_connected():
+            return None
+
+        # Concurrent requests for one uncached user share a single lookup
+        return await self._in_flight.do(("lookup", user_id), lambda: self._lookup_agent_id(user_id))
+
+    async def _lookup_agent_id(self, user_id: str) -> Optional[str]:
+        """Look up the user's agent on the Letta server."""
+        # Don't ask Letta again for a user that was just looked up and missing
+        if self._in_backoff(self._lookup_backoff, user_id):
             return None
 
         try:
             # Check if agent exists in Letta
-            existing_agents = self._client.agents.list()
-            for agent in existing_agents:
-                if agent.name == f"weather_agent_{user_id}":
-                    self._agents[user_id] = agent.id
-                    return agent.id
+            agent_id = await asyncio.to_thread(self._find_remote_agent, user_id)
         except Exception as e:
+            # Not a confirmed miss: no backoff, so creation still checks by
+            # name and can't make a second agent on a flaky server
             logger.warning(f"Error listing agents: {e}")
+            return None
 
+        if agent_id:
+            self._lookup_backoff.pop(user_id, None)
+            self._remember_agent(user_id, agent_id)
+            await self._save_agent_cache()
+            return agent_id
+
+        self._back_off(self._lookup_backoff, user_id)
         return None
 
     async def send_message(self, user_id: str, message: str) -> dict:
         """
         Send a message to the user's weather agent.
 
+        When settings.chat_coalesce_window is set, messages a user sends
+        within that window are merged into one agent call and every sender
+        receives the combined reply.
+
         Args:
             user_id: User identifier
             message: User's message
@@ -396,41 +973,216 @@ class WeatherAgentManager:
         Returns:
             Agent's response.
         """
-        agent_id = self.get_agent_id(user_id)
-        if not agent_id:
-            agent_id = self.create_agent(user_id)
+        window = settings.chat_coalesce_window
+        if window <= 0:
+            return await self._send_message_now(user_id, message)
+
+        pending = self._pending_messages.get(user_id)
+        if pending is None:
+            pending = ([], asyncio.get_running_loop().create_future())
+            self._pending_messages[user_id] = pending
+            flush = asyncio.create_task(self._flush_messages_after(user_id, window))
+            self._background_tasks.add(flush)
+            flush.add_done_callback(self._background_tasks.discard)
+
+        pending[0].append(message)
+        # Shield so one disconnected sender doesn't cancel the shared reply
+        return await asyncio.shield(pending[1])
+
+    async def send_messages_batch(
+        self,
+        items: List[Tuple[str, str]],
+        max_concurrency: int = MAX_CONCURRENT_BATCH_USERS
+    ) -> List[dict]:
+        """
+        Send many messages at once, handling different users concurrently.
 
-        # If Letta is not available, provide a fallback response
-        if not self._letta_available or agent_id.startswith("local_agent_"):
-            return await self._handle_message_locally(user_id, message)
+        One user's messages are sent in order so their conversation stays
+        coherent; up to max_concurrency users are served at the same time.
 
+        Args:
+            items: (user_id, message) pairs
+            max_concurrency: Maximum number of users handled at once
+
+        Returns:
+            Agent responses in the same order as items.
+        """
+        by_user: Dict[str, List[int]] = {}
+        for index, (user_id, _) in enumerate(items):
+            by_user.setdefault(user_id, []).append(index)
+
+        results: List[Optional[dict]] = [None] * len(items)
+        slots = asyncio.Semaphore(max_concurrency)
+
+        async def send_user_messages(indexes: List[int]):
+            async with slots:
+                for index in indexes:
+                    results[index] = await self.send_message(*items[index])
+
+        await asyncio.gather(*(send_user_messages(indexes) for indexes in by_user.values()))
+        return results
+
+    async def _flush_messages_after(self, user_id: str, delay: float):
+        """Send a user's pending messages as one agent call after the window closes."""
+        await asyncio.sleep(delay)
+        messages, reply = self._pending_messages.pop(user_id)
         try:
-            response = self._client.agents.messages.create(
-                agent_id=agent_id,
-                input=message
-            )
+            reply.set_result(await self._send_message_now(user_id, "\n".join(messages)))
+        except Exception as e:
+            reply.set_exception(e)
+
+    async def _send_message_now(self, user_id: str, message: str) -> dict:
+        """Send one message and collect the streamed reply."""
+        result = {}
+        async for event in self.send_message_stream(user_id, message):
+            if event.get("done"):
+                result = event
+        return {
+            "response": result["response"],
+            "tool_calls": result["tool_calls"],
+            "agent_id": result["agent_id"]
+        }
 
-            # Extract the assistant's response
-            assistant_messages = []
+    async def send_message_stream(self, user_id: str, message: str) -> AsyncIterator[dict]:
+        """
+        Send a message to the user's weather agent and stream its reply.
+
+        Args:
+            user_id: User identifier
+            message: User's message
+
+        Yields:
+            {"delta": text} for each chunk of assistant text and
+            {"tool_call": {...}} for each tool call as they arrive, then a
+            final {"done": True, ...} event carrying the full response.
+        """
+        # Greetings and thanks don't need an LLM round-trip, nor an agent:
+        # a new user's first "hi" shouldn't create one and register its tools
+        if (reply := _small_talk_reply(message)) is not None:
+            agent_id = self._cached_agent_id(user_id) or _LocalAgentId.for_user(user_id)
+            yield {"delta": reply}
+            yield {"done": True, "response": reply, "tool_calls": [], "agent_id": agent_id}
+            return
+
+        # If Letta is not available, provide a fallback response; standalone
+        # mode answers without resolving or creating an agent first
+        connected = await self.ensure_connected()
+        if connected:
+            agent_id = await self.get_agent_id(user_id)
+            if not agent_id:
+                agent_id = await self.create_agent(user_id)
+        if not connected or isinstance(agent_id, _LocalAgentId):
+            result = await self._handle_message_locally(user_id, message)
+            yield {"delta": result["response"]}
+            yield {"done": True, **result}
+            return
+
+        # Concurrent messages to the same agent would interleave in its
+        # memory; different users' agents still run in parallel
+        async with self._user_lock(user_id):
+            assistant_chunks = []
             tool_calls = []
+            # Bind hot callables to locals so the per-chunk loop uses fast local
+            # lookups instead of global/attribute lookups
+            add_assistant_chunk = assistant_chunks.append
+            add_tool_call = tool_calls.append
+            get_field = getattr
 
-            for msg in response.messages:
-                if hasattr(msg, 'assistant_message') and msg.assistant_message:
-                    assistant_messages.append(msg.assistant_message)
-                if hasattr(msg, 'tool_call') and msg.tool_call:
-                    tool_calls.append({
-                        "name": msg.tool_call.name,
-                        "arguments": msg.tool_call.arguments
-                    })
-
-            return {
-                "response": " ".join(assistant_messages) if assistant_messages else "I processed your request.",
+            try:
+                for attempt in range(1, LETTA_REQUEST_ATTEMPTS + 1):
+                    try:
+                        # getattr with a default avoids the extra lookup (and
+                        # exception) hasattr() costs on every chunk
+                        async for msg in self._stream_letta_messages(agent_id, message):
+                            if assistant_message := get_field(msg, "assistant_message", None):
+                                add_assistant_chunk(assistant_message)
+                                yield {"delta": assistant_message}
+                            if tool_call := get_field(msg, "tool_call", None):
+                                call = {"name": tool_call.name, "arguments": tool_call.arguments}
+                                add_tool_call(call)
+                                yield {"tool_call": call}
+                        break
+                    except (httpx.ConnectError, httpx.ConnectTimeout):
+                        # The message never reached Letta, so sending it again
+                        # can't record the turn twice. A timeout waiting for
+                        # output is not retried: the first request may still
+                        # be running on the server.
+                        if assistant_chunks or tool_calls or attempt == LETTA_REQUEST_ATTEMPTS:
+                            raise
+                        logger.warning(f"Could not reach Letta to stream (attempt {attempt}), retrying")
+            except Exception as e:
+                logger.error(f"Error streaming message from Letta: {e}")
+                if not assistant_chunks and not tool_calls:
+                    # Nothing reached the client yet, so answer locally instead
+                    result = await self._handle_message_locally(user_id, message)
+                    yield {"delta": result["response"]}
+                    yield {"done": True, **result}
+                    return
+
+            yield {
+                "done": True,
+                "response": "".join(assistant_chunks) or "I processed your request.",
                 "tool_calls": tool_calls,
                 "agent_id": agent_id
             }
-        except Exception as e:
-            logger.error(f"Error sending message to Letta: {e}")
-            return await self._handle_message_locally(user_id, message)
+
+    def _user_lock(self, user_id: str) -> asyncio.Lock:
+        """Get the lock serializing a user's conversation turns."""
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def _stream_letta_messages(self, agent_id: str, message: str) -> AsyncIterator:
+        """
+        Relay Letta's streaming endpoint onto the event loop.
+
+        The SDK stream is a blocking iterator, so it is consumed in a worker
+        thread that hands each chunk to the loop through a queue.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # Event loop already closed; nobody is listening any more
+                stop.set()
+
+        def produce():
+            try:
+                with _timed("letta.agents.messages.stream"):
+                    stream = self._client.agents.messages.stream(
+                        agent_id=agent_id,
+                        input=message,
+                        stream_tokens=True
+                    )
+                    for chunk in stream:
+                        if stop.is_set():
+                            break
+                        put(chunk)
+            except Exception as e:
+                put(e)
+            finally:
+                put(_STREAM_END)
+
+        worker = asyncio.create_task(asyncio.to_thread(produce))
+        try:
+            while True:
+                # Bounds the wait for each chunk, not the whole reply
+                item = await asyncio.wait_for(queue.get(), settings.letta_request_timeout)
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Stop the worker early if the consumer went away mid-stream
+            stop.set()
+            if worker.done():
+                await worker
 
     async def _handle_message_locally(self, user_id: str, message: str) -> dict:
         """
@@ -438,29 +1190,108 @@ class WeatherAgentManager:
 
         Provides basic weather functionality without AI agent.
         """
-        message_lower = message.lower()
-
-        # Simple keyword-based response
-        if "weather" in message_lower or "temperature" in message_lower:
-            return {
-                "response": "I can help with weather information! Please use the weather endpoints directly (/api/v1/weather/current or /api/v1/weather/forecast) with your location coordinates, or search for a location using /api/v1/geocode.",
-                "tool_calls": [],
-                "agent_id": f"local_agent_{user_id}"
-            }
-        elif "forecast" in message_lower:
-            return {
-                "response": "For weather forecasts, please use the /api/v1/weather/forecast endpoint with latitude and longitude coordinates.",
-                "tool_calls": [],
-                "agent_id": f"local_agent_{user_id}"
-            }
-        else:
-            return {
-                "response": "I'm the Weather Intelligence Assistant. I can help you with weather information, forecasts, and location searches. The full AI capabilities require a Letta server connection. For now, please use the direct API endpoints for weather data.",
-                "tool_calls": [],
-                "agent_id": f"local_agent_{user_id}"
-            }
+        if (reply := _small_talk_reply(message)) is not None:
+            return _local_reply(user_id, reply)
+
+        # "Weather in <place>" is answered directly with current conditions
+        if queries := _location_queries(message):
+            result = await self._local_current_weather(queries)
+            if result is not None:
+                return _local_reply(user_id, *result)
+
+        # Simple keyword-based response; common questions repeat verbatim
+        text = message.strip().lower()
+        if len(text) > MAX_CACHED_MESSAGE_LENGTH:
+            return _local_reply(user_id, _keyword_reply.__wrapped__(text))
+        return _local_reply(user_id, _keyword_reply(text))
 
-    def update_user_preferences(self, user_id: str, preferences: dict):
+    async def _local_current_weather(self, queries: List[str]) -> Optional[Tuple[str, List[dict]]]:
+        """
+        Look up current weather for the places named in a message.
+
+        Places are independent of each other, so all geocoding requests run
+        concurrently, followed by all weather requests.
+
+        Args:
+            queries: Place names extracted from the message
+
+        Returns:
+            Response text and tool calls, or None if a lookup failed or no
+            place was found.
+        """
+        queries = list(dict.fromkeys(query.strip() for query in queries))
+
+        try:
+            results = await asyncio.gather(*(_geocode_cached(query) for query in queries))
+            locations = {query: found[0] for query, found in zip(queries, results) if found}
+            conditions = dict(zip(
+                locations,
+                await asyncio.gather(*(_current_weather_cached(loc) for loc in locations.values()))
+            ))
+        except Exception as e:
+            logger.warning(f"Local weather lookup failed for {queries!r}: {e}")
+            return None
+        if not locations:
+            # Probably not a place after all; the keyword reply fits better
+            return None
+
+        tool_calls = [
+            {"name": "geocode_location", "arguments": json.dumps({"query": query})}
+            for query in queries
+        ]
+        replies = []
+        for query in queries:
+            location = locations.get(query)
+            if location is None:
+                replies.append(_LOCAL_NOT_FOUND_REPLY.format(query=query))
+                continue
+
+            current = conditions[query]
+            tool_calls.append({
+                "name": "get_current_weather",
+                "arguments": json.dumps({
+                    "latitude": location["latitude"],
+                    "longitude": location["longitude"]
+                })
+            })
+            name = location.get("name") or location.get("display_name") or query
+            replies.append(_LOCAL_CURRENT_WEATHER_REPLY.format(
+                name=name,
+                temperature=current["temperature"],
+                description=current["weather_description"].lower(),
+                feels_like=current["feels_like"]
+            ))
+
+        return " ".join(replies), tool_calls
+
+    async def warm_user_context(self, user_id: str):
+        """
+        Prefetch data a user's first messages are likely to need.
+
+        Checks calendar access and fetches the weather at the user's home
+        location concurrently, filling the caches the local weather
+        replies read from. Failures are ignored.
+
+        Args:
+            user_id: User identifier
+        """
+        prefetches = [calendar.check_calendar_availability(user_id)]
+        if (home := self._home_locations.get(user_id)) is not None:
+            prefetches.append(self._prefetch_home_weather(home))
+        await asyncio.gather(*prefetches, return_exceptions=True)
+
+    async def _prefetch_home_weather(self, home: dict):
+        """Warm the geocoding and current-weather caches for a home location."""
+        location = home
+        if name := home.get("name"):
+            # "Weather in <home>" geocodes the name, so warm that exact path
+            locations = await _geocode_cached(name)
+            if locations:
+                location = locations[0]
+        if location.get("latitude") is not None and location.get("longitude") is not None:
+            await _current_weather_cached(location)
+
+    async def update_user_preferences(self, user_id: str, preferences: dict):
         """
         Update user preferences in the agent's memory.
 
@@ -468,56 +1299,84 @@ class WeatherAgentManager:
             user_id: User identifier
             preferences: Dictionary of preferences to update
         """
-        agent_id = self.get_agent_id(user_id)
-        if not agent_id or not self._letta_available:
+        if isinstance(preferences.get("home_location"), dict):
+            self._remember(self._home_locations, user_id, preferences["home_location"])
+
+        agent_id = await self.get_agent_id(user_id)
+        if not agent_id or not await self.ensure_connected():
+            return
+
+        updates = {
+            key: _format_preference(preferences[key])
+            for key in _PREFERENCE_DEFAULTS
+            if preferences.get(key) is not None
+        }
+        if not updates:
             return
 
         try:
-            # Update preferences via agent blocks
-            updates = []
-            if "temperature_unit" in preferences:
-                updates.append(f"Preferred temperature unit: {preferences['temperature_unit']}")
-            if "home_location" in preferences:
-                updates.append(f"Home location: {preferences['home_location']}")
-            if "name" in preferences:
-                updates.append(f"Name: {preferences['name']}")
-
-            if updates:
-                # Update the human block with new preferences
-                human_block = WEATHER_AGENT_HUMAN + "\n\nUpdated preferences:\n" + "\n".join(updates)
-                self._client.agents.blocks.update(
+            # Merge with earlier updates so the block always reflects every
+            # preference, then replace it with a single memory write. After
+            # a restart (or eviction) the stored block is read once instead.
+            current = self._preferences.get(user_id)
+            if current is None:
+                with _timed("letta.agents.blocks.retrieve"):
+                    block = await asyncio.to_thread(
+                        self._client.agents.blocks.retrieve,
+                        agent_id=agent_id,
+                        block_label="human"
+                    )
+                current = _parse_human_block(getattr(block, "value", None))
+                self._remember(self._preferences, user_id, current)
+            merged = {**current, **updates}
+            if merged == current:
+                return
+
+            human_block = _render_human_block(**{**_PREFERENCE_DEFAULTS, **merged})
+            with _timed("letta.agents.blocks.update"):
+                await asyncio.to_thread(
+                    self._client.agents.blocks.update,
                     agent_id=agent_id,
                     block_label="human",
                     value=human_block
                 )
+            self._remember(self._preferences, user_id, merged)
         except Exception as e:
             logger.warning(f"Error updating preferences: {e}")
 
-    def delete_agent(self, user_id: str):
+    async def delete_agent(self, user_id: str):
         """
         Delete a user's weather agent.
 
         Args:
             user_id: User identifier
         """
-        agent_id = self.get_agent_id(user_id)
+        agent_id = await self.get_agent_id(user_id)
         if agent_id:
-            if self._letta_available and not agent_id.startswith("local_agent_"):
+            is_remote = await self.ensure_connected() and not isinstance(agent_id, _LocalAgentId)
+            if is_remote:
                 try:
-                    self._client.agents.delete(agent_id)
+                    with _timed("letta.agents.delete"):
+                        await asyncio.to_thread(self._client.agents.delete, agent_id)
                 except Exception as e:
                     logger.warning(f"Error deleting agent from Letta: {e}")
+            self._preferences.pop(user_id, None)
             if user_id in self._agents:
                 del self._agents[user_id]
+                if is_remote:
+                    await self._save_agent_cache()
 
 
 # Global agent manager instance
 agent_manager: Optional[WeatherAgentManager] = None
+_agent_manager_lock = threading.Lock()
 
 
 def get_agent_manager() -> WeatherAgentManager:
-    """Get or create the global agent manager."""
+    """Get or create the global agent manager (thread-safe)."""
     global agent_manager
     if agent_manager is None:
-        agent_manager = WeatherAgentManager()
+        with _agent_manager_lock:
+            if agent_manager is None:
+                agent_manager = WeatherAgentManager(base_url=settings.letta_base_url)
     return agent_manager
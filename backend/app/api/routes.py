@@ -1,12 +1,18 @@
 """FastAPI routes for the Weather Intelligence Agent API."""
-from fastapi import APIRouter, HTTPException, Depends, Query
-from typing import Optional, Annotated
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, Query, Request
+from fastapi.responses import StreamingResponse
+from typing import Any, Awaitable, Callable, Optional, Annotated
 from datetime import datetime, timedelta
+import asyncio
+import json
 import logging
+import uuid
 
 from ..models.schemas import (
     ChatRequest,
     ChatResponse,
+    ChatBatchRequest,
+    ChatBatchResponse,
     LocationRequest,
     GeocodeRequest,
     CurrentWeatherResponse,
@@ -18,8 +24,12 @@ from ..models.schemas import (
     CreateReminderRequest,
     TemperatureUnit,
 )
+from ..cache import SingleFlight, TTLCache
+from ..config import settings
+from ..rate_limit import TokenBucketLimiter, check_rate_limit, rate_limit
+from ..responses import OrjsonResponse
 from ..tools import weather, geocoding, calendar
-from ..agent.weather_agent import get_agent_manager, WeatherAgentManager
+from ..agent.weather_agent import AGENT_MEMORY_PREFERENCES, get_agent_manager, WeatherAgentManager
 from ..services.notifications import get_notification_service
 from ..services.weather_alerts import get_weather_alert_service
 
@@ -27,10 +37,120 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Upstream responses shared by all users. Conditions change within minutes,
+# forecasts within the hour and place names practically never.
+CURRENT_WEATHER_TTL = 300
+FORECAST_TTL = 1800
+GEOCODE_TTL = 86400
+_current_weather_cache = TTLCache(maxsize=4096, ttl=CURRENT_WEATHER_TTL)
+_forecast_cache = TTLCache(maxsize=4096, ttl=FORECAST_TTL)
+_geocode_cache = TTLCache(maxsize=4096, ttl=GEOCODE_TTL)
+# Concurrent misses for the same key share one upstream request
+_upstream_flights = SingleFlight()
+
+# Let HTTP caches reuse responses for as long as we do, then serve them stale
+# while revalidating in the background
+CURRENT_WEATHER_CACHE_CONTROL = f"public, max-age={CURRENT_WEATHER_TTL}, stale-while-revalidate=600"
+FORECAST_CACHE_CONTROL = f"public, max-age={FORECAST_TTL}, stale-while-revalidate=3600"
+GEOCODE_CACHE_CONTROL = f"public, max-age={GEOCODE_TTL}, stale-while-revalidate=604800"
+
+# Lookups in flight per batch geocode request; Nominatim asks clients to keep
+# request rates low, so batches are spread over a few connections
+MAX_CONCURRENT_GEOCODES = 5
+
+# Health probes and calendar requests re-check Google Calendar (an OAuth
+# token load, possibly a refresh) at most this often
+CALENDAR_STATUS_TTL = 30
+_calendar_status_cache = TTLCache(maxsize=1, ttl=CALENDAR_STATUS_TTL)
+
+# The whole health report is reused for a few seconds, here and by load balancers
+HEALTH_TTL = 5
+HEALTH_CACHE_CONTROL = f"public, max-age={HEALTH_TTL}"
+_health_cache = TTLCache(maxsize=1, ttl=HEALTH_TTL)
+
+# Results of queued alert checks, kept for clients to poll for an hour
+ALERT_CHECK_RESULT_TTL = 3600
+_alert_checks = TTLCache(maxsize=10000, ttl=ALERT_CHECK_RESULT_TTL)
+
+
+# Per-client limits on endpoints that spend Letta, FCM or Calendar quota
+_chat_limiter = TokenBucketLimiter(settings.chat_rate_limit)
+_notification_test_limiter = TokenBucketLimiter(settings.notification_test_rate_limit)
+_write_limiter = TokenBucketLimiter(settings.write_rate_limit)
+
+
+def _json(content: Any, cache_control: Optional[str]) -> OrjsonResponse:
+    """Encode an upstream result directly; it is already JSON-compatible."""
+    headers = {"Cache-Control": cache_control} if cache_control else None
+    return OrjsonResponse(content, headers=headers)
+
+
+def _grid(request: LocationRequest) -> tuple:
+    """Round coordinates to 2 decimals (~1 km) so nearby requests share entries."""
+    return (round(request.latitude, 2), round(request.longitude, 2))
+
+
+async def _cached(cache: TTLCache, key: tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """Return the cached result for key, fetching and storing it on a miss."""
+    result = cache.get(key)
+    if result is None:
+        result = await _upstream_flights.do(key, lambda: _fetch_and_store(cache, key, fetch))
+    return result
+
+
+async def _fetch_and_store(cache: TTLCache, key: tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """Fetch a result from upstream and cache it under key."""
+    result = await fetch()
+    cache.set(key, result)
+    return result
+
+
+async def _calendar_available() -> bool:
+    """Check whether Google Calendar is configured, re-checking at most every CALENDAR_STATUS_TTL seconds."""
+    return await _cached(_calendar_status_cache, ("calendar",), calendar.check_calendar_availability)
+
+
+async def _geocode_cached(query: str, limit: int) -> list:
+    """Geocode a place name, reusing earlier lookups of the same search."""
+    return await _cached(
+        _geocode_cache,
+        ("search", query.strip().lower(), limit),
+        lambda: geocoding.geocode_location(query=query, limit=limit)
+    )
+
+
+async def _geocode_many(queries: list, limit: int) -> dict:
+    """
+    Geocode several place names concurrently.
+
+    Args:
+        queries: Place names or addresses to search
+        limit: Maximum results per place
+
+    Returns:
+        {"results": {query: locations}} plus {"errors": {query: message}}
+        for any lookups that failed.
+    """
+    slots = asyncio.Semaphore(MAX_CONCURRENT_GEOCODES)
+
+    async def lookup(query: str) -> list:
+        async with slots:
+            return await _geocode_cached(query, limit)
+
+    found = await asyncio.gather(*(lookup(query) for query in queries), return_exceptions=True)
+    results, errors = {}, {}
+    for query, outcome in zip(queries, found):
+        if isinstance(outcome, Exception):
+            logger.warning(f"Error geocoding {query!r}: {outcome}")
+            errors[query] = f"Error geocoding: {str(outcome)}"
+        else:
+            results[query] = outcome
+    return {"results": results, "errors": errors}
+
 
 # ============== Chat Endpoints ==============
 
-@router.post("/chat", response_model=ChatResponse, tags=["Chat"])
+@router.post("/chat", response_model=ChatResponse, tags=["Chat"], dependencies=[Depends(rate_limit(_chat_limiter))])
 async def send_message(request: ChatRequest):
     """
     Send a message to the weather agent and get a response.
@@ -38,12 +158,49 @@ async def send_message(request: ChatRequest):
     The agent will process the message, potentially calling weather,
     location, or calendar tools, and return a contextual response.
     """
-    try:
-        manager = get_agent_manager()
-        result = await manager.send_message(request.user_id, request.message)
-        return ChatResponse(**result)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing message: {str(e)}")
+    manager = get_agent_manager()
+    result = await manager.send_message(request.user_id, request.message)
+    # Validated and serialized once by response_model
+    return result
+
+
+@router.post("/chat/batch", response_model=ChatBatchResponse, tags=["Chat"])
+async def send_message_batch(request: ChatBatchRequest, http_request: Request):
+    """
+    Send several messages and get all responses at once.
+
+    Different users' messages are processed concurrently; each user's
+    messages are processed in the order given. Each message counts
+    against the chat rate limit.
+    """
+    check_rate_limit(_chat_limiter, http_request, cost=len(request.messages))
+    manager = get_agent_manager()
+    results = await manager.send_messages_batch(
+        [(item.user_id, item.message) for item in request.messages]
+    )
+    return {"responses": results}
+
+
+@router.post("/chat/stream", tags=["Chat"], dependencies=[Depends(rate_limit(_chat_limiter))])
+async def stream_message(request: ChatRequest):
+    """
+    Send a message to the weather agent and stream the response.
+
+    Returns Server-Sent Events: a {"delta": ...} event per chunk of
+    assistant text, a {"tool_call": ...} event per tool call, and a final
+    {"done": true, ...} event with the complete response.
+    """
+    manager = get_agent_manager()
+
+    async def event_stream():
+        try:
+            async for event in manager.send_message_stream(request.user_id, request.message):
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            logger.error(f"Error streaming message: {e}")
+            yield f"data: {json.dumps({'error': f'Error processing message: {str(e)}'})}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 # ============== Weather Endpoints ==============
@@ -54,16 +211,17 @@ async def get_current_weather(
     temperature_unit: TemperatureUnit = TemperatureUnit.FAHRENHEIT
 ):
     """Get current weather for a location."""
-    try:
-        result = await weather.get_current_weather(
-            latitude=request.latitude,
-            longitude=request.longitude,
+    latitude, longitude = _grid(request)
+    result = await _cached(
+        _current_weather_cache,
+        ("current", latitude, longitude, temperature_unit.value),
+        lambda: weather.get_current_weather(
+            latitude=latitude,
+            longitude=longitude,
             temperature_unit=temperature_unit.value
         )
-        return result
-    except Exception as e:
-        logger.error(f"Error fetching weather: {e}")
-        raise HTTPException(status_code=500, detail=f"Error fetching weather: {str(e)}")
+    )
+    return _json(result, CURRENT_WEATHER_CACHE_CONTROL)
 
 
 @router.post("/weather/forecast", tags=["Weather"])
@@ -73,17 +231,18 @@ async def get_forecast(
     temperature_unit: TemperatureUnit = TemperatureUnit.FAHRENHEIT
 ):
     """Get weather forecast for a location (max 16 days)."""
-    try:
-        result = await weather.get_weather_forecast(
-            latitude=request.latitude,
-            longitude=request.longitude,
+    latitude, longitude = _grid(request)
+    result = await _cached(
+        _forecast_cache,
+        ("daily", latitude, longitude, days, temperature_unit.value),
+        lambda: weather.get_weather_forecast(
+            latitude=latitude,
+            longitude=longitude,
             days=days,
             temperature_unit=temperature_unit.value
         )
-        return result
-    except Exception as e:
-        logger.error(f"Error fetching forecast: {e}")
-        raise HTTPException(status_code=500, detail=f"Error fetching forecast: {str(e)}")
+    )
+    return _json(result, FORECAST_CACHE_CONTROL)
 
 
 @router.post("/weather/hourly", tags=["Weather"])
@@ -93,17 +252,18 @@ async def get_hourly(
     temperature_unit: TemperatureUnit = TemperatureUnit.FAHRENHEIT
 ):
     """Get hourly weather forecast for a location (max 168 hours / 7 days)."""
-    try:
-        result = await weather.get_hourly_forecast(
-            latitude=request.latitude,
-            longitude=request.longitude,
+    latitude, longitude = _grid(request)
+    result = await _cached(
+        _forecast_cache,
+        ("hourly", latitude, longitude, hours, temperature_unit.value),
+        lambda: weather.get_hourly_forecast(
+            latitude=latitude,
+            longitude=longitude,
             hours=hours,
             temperature_unit=temperature_unit.value
         )
-        return result
-    except Exception as e:
-        logger.error(f"Error fetching hourly forecast: {e}")
-        raise HTTPException(status_code=500, detail=f"Error fetching hourly forecast: {str(e)}")
+    )
+    return _json(result, FORECAST_CACHE_CONTROL)
 
 
 # ============== Geocoding Endpoints ==============
@@ -111,27 +271,24 @@ async def get_hourly(
 @router.post("/geocode", tags=["Location"])
 async def geocode(request: GeocodeRequest):
     """Convert a place name or address to coordinates."""
-    try:
-        results = await geocoding.geocode_location(
-            query=request.query,
-            limit=request.limit
-        )
-        return {"locations": results}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error geocoding: {str(e)}")
+    if request.queries:
+        result = await _geocode_many(request.queries, request.limit)
+        # Don't let HTTP caches keep a partial result
+        return _json(result, None if result["errors"] else GEOCODE_CACHE_CONTROL)
+    results = await _geocode_cached(request.query, request.limit)
+    return _json({"locations": results}, GEOCODE_CACHE_CONTROL)
 
 
 @router.post("/reverse-geocode", tags=["Location"])
 async def reverse_geocode(request: LocationRequest):
     """Convert coordinates to a place name/address."""
-    try:
-        result = await geocoding.reverse_geocode(
-            latitude=request.latitude,
-            longitude=request.longitude
-        )
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error reverse geocoding: {str(e)}")
+    latitude, longitude = _grid(request)
+    result = await _cached(
+        _geocode_cache,
+        ("reverse", latitude, longitude),
+        lambda: geocoding.reverse_geocode(latitude=latitude, longitude=longitude)
+    )
+    return _json(result, GEOCODE_CACHE_CONTROL)
 
 
 # ============== Calendar Endpoints ==============
@@ -139,98 +296,79 @@ async def reverse_geocode(request: LocationRequest):
 @router.get("/calendar/events", tags=["Calendar"])
 async def get_events(days_ahead: int = 7, max_results: int = 10):
     """Get upcoming calendar events."""
-    try:
-        # Check if calendar is available
-        available = await calendar.check_calendar_availability()
-        if not available:
-            raise HTTPException(
-                status_code=503,
-                detail="Google Calendar not configured. Please set up OAuth credentials."
-            )
-
-        events = await calendar.get_calendar_events(
-            start_date=datetime.utcnow(),
-            end_date=datetime.utcnow() + timedelta(days=days_ahead),
-            max_results=max_results
+    # Check if calendar is available
+    if not await _calendar_available():
+        raise HTTPException(
+            status_code=503,
+            detail="Google Calendar not configured. Please set up OAuth credentials."
         )
-        return {"events": events}
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching events: {str(e)}")
+
+    now = datetime.utcnow()
+    events = await calendar.get_calendar_events(
+        start_date=now,
+        end_date=now + timedelta(days=days_ahead),
+        max_results=max_results
+    )
+    return {"events": events}
 
 
-@router.post("/calendar/reminder", tags=["Calendar"])
+@router.post("/calendar/reminder", tags=["Calendar"], dependencies=[Depends(rate_limit(_write_limiter))])
 async def create_reminder(request: CreateReminderRequest):
     """Create a weather-related reminder."""
-    try:
-        available = await calendar.check_calendar_availability()
-        if not available:
-            raise HTTPException(
-                status_code=503,
-                detail="Google Calendar not configured."
-            )
-
-        result = await calendar.create_weather_reminder(
-            title=request.title,
-            event_time=request.event_time,
-            weather_note=request.weather_note
+    if not await _calendar_available():
+        raise HTTPException(
+            status_code=503,
+            detail="Google Calendar not configured."
         )
-        return result
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error creating reminder: {str(e)}")
+
+    result = await calendar.create_weather_reminder(
+        title=request.title,
+        event_time=request.event_time,
+        weather_note=request.weather_note
+    )
+    return result
 
 
 # ============== Agent Management Endpoints ==============
 
 @router.post("/agent/create", response_model=AgentResponse, tags=["Agent"])
-async def create_agent(request: CreateAgentRequest):
+async def create_agent(request: CreateAgentRequest, background_tasks: BackgroundTasks):
     """Create a new weather agent for a user."""
-    try:
-        manager = get_agent_manager()
-        agent_id = manager.create_agent(request.user_id)
-        return AgentResponse(agent_id=agent_id, user_id=request.user_id)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error creating agent: {str(e)}")
+    manager = get_agent_manager()
+    agent_id = await manager.create_agent(request.user_id)
+    # The app creates the agent when a session starts; warm caches for the
+    # first messages after the response is sent
+    background_tasks.add_task(manager.warm_user_context, request.user_id)
+    return AgentResponse(agent_id=agent_id, user_id=request.user_id)
 
 
 @router.get("/agent/{user_id}", response_model=AgentResponse, tags=["Agent"])
 async def get_agent(user_id: str):
     """Get agent info for a user."""
-    try:
-        manager = get_agent_manager()
-        agent_id = manager.get_agent_id(user_id)
-        if not agent_id:
-            raise HTTPException(status_code=404, detail="Agent not found")
-        return AgentResponse(agent_id=agent_id, user_id=user_id)
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching agent: {str(e)}")
+    manager = get_agent_manager()
+    agent_id = await manager.get_agent_id(user_id)
+    if not agent_id:
+        raise HTTPException(status_code=404, detail="Agent not found")
+    return AgentResponse(agent_id=agent_id, user_id=user_id)
 
 
 @router.delete("/agent/{user_id}", tags=["Agent"])
 async def delete_agent(user_id: str):
     """Delete a user's weather agent."""
-    try:
-        manager = get_agent_manager()
-        manager.delete_agent(user_id)
-        return {"status": "deleted", "user_id": user_id}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error deleting agent: {str(e)}")
+    manager = get_agent_manager()
+    await manager.delete_agent(user_id)
+    return {"status": "deleted", "user_id": user_id}
 
 
 @router.put("/agent/{user_id}/preferences", tags=["Agent"])
 async def update_preferences(user_id: str, preferences: UserPreferences):
     """Update user preferences in the agent's memory."""
-    try:
-        manager = get_agent_manager()
-        manager.update_user_preferences(user_id, preferences.model_dump())
-        return {"status": "updated", "user_id": user_id}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error updating preferences: {str(e)}")
+    manager = get_agent_manager()
+    # Serialize only what the agent stores, with enums already as strings
+    await manager.update_user_preferences(
+        user_id, preferences.model_dump(mode="json", include=AGENT_MEMORY_PREFERENCES)
+    )
+    return {"status": "updated", "user_id": user_id}
 
 
 # ============== Health Check ==============
@@ -238,13 +376,19 @@ async def update_preferences(user_id: str, preferences: UserPreferences):
 @router.get("/health", tags=["System"])
 async def health_check():
     """Check API health status."""
+    report = await _cached(_health_cache, ("health",), _health_report)
+    return _json(report, HEALTH_CACHE_CONTROL)
+
+
+async def _health_report() -> dict:
+    """Build the health report returned by /health."""
     return {
         "status": "healthy",
         "timestamp": datetime.utcnow().isoformat(),
         "services": {
             "weather_api": "available",
             "geocoding": "available",
-            "calendar": await calendar.check_calendar_availability(),
+            "calendar": await _calendar_available(),
             "notifications": get_notification_service().is_available
         }
     }
@@ -268,7 +412,7 @@ async def unregister_device(user_id: str):
     return {"status": "unregistered" if success else "not_found", "user_id": user_id}
 
 
-@router.post("/notifications/test", tags=["Notifications"])
+@router.post("/notifications/test", tags=["Notifications"], dependencies=[Depends(rate_limit(_notification_test_limiter))])
 async def send_test_notification(user_id: str, title: str, body: str):
     """Send a test notification to a user."""
     service = get_notification_service()
@@ -278,7 +422,7 @@ async def send_test_notification(user_id: str, title: str, body: str):
 
 # ============== Weather Alert Subscription Endpoints ==============
 
-@router.post("/alerts/subscribe", tags=["Alerts"])
+@router.post("/alerts/subscribe", tags=["Alerts"], dependencies=[Depends(rate_limit(_write_limiter))])
 async def subscribe_to_alerts(
     user_id: Annotated[str, Query(min_length=1, max_length=255)],
     latitude: Annotated[float, Query(ge=-90, le=90)],
@@ -310,9 +454,36 @@ async def unsubscribe_from_alerts(user_id: str):
     return {"status": "unsubscribed" if success else "not_found", "user_id": user_id}
 
 
-@router.post("/alerts/check/{user_id}", tags=["Alerts"])
-async def check_alerts_now(user_id: str):
-    """Manually trigger an alert check for a user."""
-    service = get_weather_alert_service()
-    alerts = await service.check_weather_for_user(user_id)
-    return {"user_id": user_id, "alerts": alerts, "count": len(alerts)}
+@router.post("/alerts/check/{user_id}", status_code=202, tags=["Alerts"])
+async def check_alerts_now(user_id: str, background_tasks: BackgroundTasks):
+    """
+    Queue an alert check for a user.
+
+    The check fetches weather for the user's subscription, so it runs after
+    the response is sent; poll /alerts/result/{task_id} for the alerts.
+    """
+    task_id = uuid.uuid4().hex
+    _alert_checks.set(task_id, {"task_id": task_id, "user_id": user_id, "status": "queued"})
+    background_tasks.add_task(_run_alert_check, task_id, user_id)
+    return {"task_id": task_id, "user_id": user_id, "status": "queued"}
+
+
+@router.get("/alerts/result/{task_id}", tags=["Alerts"])
+async def get_alert_check_result(task_id: str):
+    """Get the status of a queued alert check, with its alerts once done."""
+    result = _alert_checks.get(task_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Alert check not found or expired")
+    return result
+
+
+async def _run_alert_check(task_id: str, user_id: str):
+    """Run a queued alert check and record its outcome for polling."""
+    job = {"task_id": task_id, "user_id": user_id}
+    _alert_checks.set(task_id, {**job, "status": "running"})
+    try:
+        alerts = await get_weather_alert_service().check_weather_for_user(user_id)
+        _alert_checks.set(task_id, {**job, "status": "done", "alerts": alerts, "count": len(alerts)})
+    except Exception as e:
+        logger.error(f"Error checking alerts for {user_id}: {e}")
+        _alert_checks.set(task_id, {**job, "status": "failed", "error": str(e)})
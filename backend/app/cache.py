@@ -0,0 +1,79 @@
+"""In-process caching helpers shared by the agent, API and services."""
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+import asyncio
+import time
+
+
+class TTLCache:
+    """A bounded cache whose entries expire after a fixed time-to-live.
+
+    When full, the oldest entry is evicted first. Not thread-safe; meant
+    for use from the event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        Initialize the cache.
+
+        Args:
+            maxsize: Maximum number of entries kept
+            ttl: Seconds an entry stays valid after being stored
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for key, or default if missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Store a value, evicting the oldest entries beyond maxsize."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one in-flight call."""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, make_call: Callable[[], Awaitable]) -> Any:
+        """
+        Run one call per key at a time, sharing its result with concurrent callers.
+
+        Args:
+            key: Identifies the call
+            make_call: Returns the coroutine to run if no call is in flight
+
+        Returns:
+            The result of the in-flight call.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_call())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        # Shield so one cancelled caller doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def __len__(self) -> int:
+        return len(self._calls)
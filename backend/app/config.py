@@ -20,6 +20,16 @@ class Settings(BaseSettings):
 
     # Letta settings
     letta_base_url: Optional[str] = None  # Uses default if not set
+    letta_health_timeout: float = 2.0  # Seconds to wait for the startup health check
+    letta_request_timeout: float = 15.0  # Seconds to wait for each streamed reply chunk
+    # Merge chat messages a user sends within this many seconds into one agent
+    # call (0 disables)
+    chat_coalesce_window: float = 0.0
+
+    # Rate limits - requests per minute per client (0 disables)
+    chat_rate_limit: int = 30
+    notification_test_rate_limit: int = 5
+    write_rate_limit: int = 20  # Alert subscriptions and calendar reminders
 
     # Google Calendar OAuth (optional, for calendar integration)
     google_client_id: Optional[str] = None
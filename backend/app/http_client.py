@@ -0,0 +1,47 @@
+"""Shared HTTP client for calls to external APIs (Open-Meteo, Nominatim)."""
+from typing import Optional
+import asyncio
+import importlib.util
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 multiplexing needs the optional h2 package (httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Keep-alive pool sized for concurrent weather/geocoding traffic
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=60)
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=5.0)  # 10s total, 5s connect
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the process-wide async HTTP client, creating it on first use.
+
+    Pooled connections belong to the event loop that opened them, so a new
+    client is created if called from a different loop (e.g. in tests).
+
+    Returns:
+        A shared httpx.AsyncClient; callers must not close it.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT, http2=HTTP2_AVAILABLE)
+        _client_loop = loop
+    return _client
+
+
+async def close_http_client():
+    """Close the shared HTTP client (called on application shutdown)."""
+    global _client, _client_loop
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
+        logger.info("Shared HTTP client closed")
+    _client = None
+    _client_loop = None
@@ -1,9 +1,36 @@
 """FastAPI application entry point for Weather Intelligence Agent."""
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import logging
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 
+from .agent.weather_agent import get_agent_manager
 from .api.routes import router
 from .config import settings
+from .http_client import close_http_client
+from .services.notifications import get_notification_service
+from .services.weather_alerts import get_weather_alert_service
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application startup and shutdown."""
+    # Connect to Letta and create the service singletons before serving so
+    # the first request doesn't pay for it
+    await get_agent_manager().ensure_connected()
+    notification_service = get_notification_service()
+    alert_service = get_weather_alert_service()
+    await notification_service.start_workers()
+    yield
+    # Stop producing alerts before draining the notification queue
+    await alert_service.aclose()
+    await notification_service.stop_workers()
+    await close_http_client()
 
 
 # Create FastAPI application
@@ -25,25 +52,62 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 
 # Configure CORS for mobile app access
 # In production, set CORS_ORIGINS env var to specific allowed origins
 cors_origins = settings.cors_origins_list if settings.cors_origins_list else ["*"]
+cors_allow_credentials = len(cors_origins) > 0 and cors_origins[0] != "*"  # Only with specific origins
 app.add_middleware(
     CORSMiddleware,
     allow_origins=cors_origins,
-    allow_credentials=len(cors_origins) > 0 and cors_origins[0] != "*",  # Only with specific origins
+    allow_credentials=cors_allow_credentials,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["Content-Type", "Authorization", "X-Requested-With"],
 )
 
+# Compress larger JSON (forecasts, hourly data) for mobile clients; level 5
+# keeps most of the size reduction at a fraction of level 9's CPU cost
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 
 # Include API routes
 app.include_router(router, prefix="/api/v1")
 
 
+def _cors_headers(request: Request) -> dict:
+    """CORS headers CORSMiddleware would add for the request's origin."""
+    origin = request.headers.get("origin")
+    if not origin or ("*" not in cors_origins and origin not in cors_origins):
+        return {}
+    if not cors_allow_credentials:
+        return {"Access-Control-Allow-Origin": "*"}
+    return {
+        "Access-Control-Allow-Origin": origin,
+        "Access-Control-Allow-Credentials": "true",
+        "Vary": "Origin",
+    }
+
+
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    """Report any error a route doesn't handle as a 500 with its message.
+
+    HTTPExceptions raised by routes are still handled by FastAPI's default
+    handler and keep their status codes. Starlette runs this handler outside
+    CORSMiddleware, so the CORS headers are added here; without them browsers
+    hide the response from the web client.
+    """
+    logger.error(f"Error handling {request.method} {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=500,
+        content={"detail": f"Internal error: {exc}"},
+        headers=_cors_headers(request),
+    )
+
+
 @app.get("/")
 async def root():
     """Root endpoint with API information."""
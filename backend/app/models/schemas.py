@@ -1,5 +1,5 @@
 """Pydantic models for API request/response schemas."""
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, field_validator, model_validator
 from typing import Optional, List, Literal
 from datetime import datetime
 from enum import Enum
@@ -41,6 +41,16 @@ class ChatResponse(BaseModel):
     agent_id: str = Field(..., description="Agent ID that handled the request")
 
 
+class ChatBatchRequest(BaseModel):
+    """Several chat messages to process in one request."""
+    messages: List[ChatRequest] = Field(..., min_length=1, max_length=100, description="Messages to send (1-100)")
+
+
+class ChatBatchResponse(BaseModel):
+    """Responses to a chat batch, in request order."""
+    responses: List[ChatResponse]
+
+
 # ============== Weather Models ==============
 
 class LocationRequest(BaseModel):
@@ -51,9 +61,20 @@ class LocationRequest(BaseModel):
 
 class GeocodeRequest(BaseModel):
     """Request to geocode a location."""
-    query: str = Field(..., min_length=0, max_length=500, description="Place name or address to search")
+    query: str = Field(default="", min_length=0, max_length=500, description="Place name or address to search")
+    queries: Optional[List[str]] = Field(default=None, max_length=50, description="Several places to search at once (max 50)")
     limit: int = Field(default=5, ge=1, le=50, description="Maximum results (1-50)")
 
+    @model_validator(mode='after')
+    def require_query(self) -> 'GeocodeRequest':
+        """Require query (which may be empty, as before) or a non-empty queries list."""
+        if self.queries is not None:
+            if not self.queries or not all(q.strip() for q in self.queries):
+                raise ValueError('queries must be a non-empty list of place names')
+        elif 'query' not in self.model_fields_set:
+            raise ValueError('either query or queries is required')
+        return self
+
 
 class CurrentWeatherResponse(BaseModel):
     """Current weather conditions."""
@@ -0,0 +1,106 @@
+"""Per-client token-bucket rate limiting for write endpoints."""
+from collections import OrderedDict
+from typing import Callable, Hashable, Tuple
+import math
+import time
+
+from fastapi import HTTPException, Request
+
+# Clients tracked per limiter before the least recently seen is forgotten
+MAX_TRACKED_CLIENTS = 10000
+
+
+class TokenBucketLimiter:
+    """Allow each client `rate` requests per `period`, refilling continuously.
+
+    A bucket starts full, so a client can burst up to `rate` requests. Not
+    thread-safe; meant for use from the event loop.
+    """
+
+    def __init__(self, rate: int, period: float = 60.0, maxsize: int = MAX_TRACKED_CLIENTS):
+        """
+        Initialize the limiter.
+
+        Args:
+            rate: Requests allowed per period (0 disables limiting)
+            period: Seconds over which `rate` requests are allowed
+            maxsize: Maximum number of clients tracked
+        """
+        self.rate = rate
+        self.period = period
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+
+    def acquire(self, key: Hashable, cost: int = 1) -> float:
+        """
+        Take `cost` tokens from the client's bucket.
+
+        Args:
+            key: Identifies the client
+            cost: Tokens the request uses
+
+        Returns:
+            0 if the request is allowed, otherwise seconds until it would be
+            (infinite if `cost` exceeds a full bucket, which never refills
+            past `rate`).
+        """
+        if self.rate <= 0:
+            return 0.0
+        if cost > self.rate:
+            return math.inf
+        now = time.monotonic()
+        refill_per_second = self.rate / self.period
+        tokens, updated_at = self._buckets.get(key, (float(self.rate), now))
+        tokens = min(float(self.rate), tokens + (now - updated_at) * refill_per_second)
+        if tokens >= cost:
+            tokens -= cost
+            retry_after = 0.0
+        else:
+            retry_after = (cost - tokens) / refill_per_second
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def clear(self):
+        """Forget all clients."""
+        self._buckets.clear()
+
+
+def client_key(request: Request) -> str:
+    """Identify the caller by client address.
+
+    User IDs arrive unauthenticated (header, query or body), so keying on
+    them would let a client get a fresh bucket per request.
+    """
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def check_rate_limit(limiter: TokenBucketLimiter, request: Request, cost: int = 1):
+    """
+    Charge a request against the caller's bucket.
+
+    Raises:
+        HTTPException: 429 with a Retry-After header if the caller is over the limit.
+    """
+    retry_after = limiter.acquire(client_key(request), cost)
+    if retry_after == math.inf:
+        # Waiting won't help; the request is bigger than the whole allowance
+        raise HTTPException(
+            status_code=429,
+            detail=f"Request costs {cost}, more than the limit of {limiter.rate} per {limiter.period:g}s.",
+        )
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded. Try again later.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+def rate_limit(limiter: TokenBucketLimiter) -> Callable:
+    """Create a route dependency that charges one request against `limiter`."""
+    async def dependency(request: Request):
+        check_rate_limit(limiter, request)
+    return dependency
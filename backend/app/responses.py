@@ -0,0 +1,24 @@
+"""JSON response classes for the API."""
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+# orjson is optional; it encodes large forecast payloads several times faster
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+class OrjsonResponse(JSONResponse):
+    """JSON response encoded with orjson, or the json module if it isn't installed.
+
+    Content must already be JSON-compatible (dicts, lists, str, numbers,
+    bools, None); it is encoded as-is without FastAPI's jsonable_encoder.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if not ORJSON_AVAILABLE:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
@@ -3,14 +3,26 @@
 This service handles sending push notifications to mobile devices
 for weather alerts and proactive suggestions.
 """
+import asyncio
+import heapq
 import json
-from typing import Optional, List, Dict, Any, NamedTuple
-from datetime import datetime, timedelta
-import httpx
+from typing import Optional, List, Dict, Any, NamedTuple, Tuple
+from datetime import datetime
 import logging
+import time
+from functools import lru_cache
+
+from ..cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# orjson is optional; it encodes nested payload values faster than json
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # Firebase Admin SDK (optional, for production)
 try:
     import firebase_admin
@@ -21,17 +33,67 @@ except ImportError:
 
 
 class DeviceToken(NamedTuple):
-    """Device token with expiration."""
+    """Device token with expiration (times are epoch seconds)."""
     token: str
-    registered_at: datetime
-    last_used: datetime
+    registered_at: float
+    last_used: float
 
 
 # Token TTL - tokens expire after 30 days of inactivity
 TOKEN_TTL_DAYS = 30
+TOKEN_TTL_SECONDS = TOKEN_TTL_DAYS * 86400
 # Maximum number of tokens to store (to prevent unbounded growth)
 MAX_TOKENS = 10000
 
+# Tokens FCM reported as no longer valid are skipped for a day
+INVALID_TOKEN_TTL = 86400
+MAX_INVALID_TOKENS = 100000
+
+# Most messages FCM accepts in one send_each call
+FCM_BATCH_SIZE = 500
+# Most tokens FCM accepts in one topic subscribe/unsubscribe call
+FCM_TOPIC_BATCH_SIZE = 1000
+
+# Queued sends: notifications waiting beyond the queue size are dropped
+NOTIFICATION_QUEUE_SIZE = 1000
+# Each worker sends a batch at a time, so a few keep FCM busy
+NOTIFICATION_WORKERS = 4
+# Seconds a worker waits after the first queued notification for more to
+# join its batch; bursts of alerts then cost one FCM call instead of many
+NOTIFICATION_BATCH_WINDOW = 0.05
+# Seconds to let queued notifications finish sending on shutdown
+NOTIFICATION_DRAIN_TIMEOUT = 5.0
+
+SEVERITY_ICONS = {
+    "info": "ℹ️",
+    "warning": "⚠️",
+    "severe": "🚨",
+}
+DEFAULT_SEVERITY_ICON = "🌤️"
+
+
+def _encode_data(data: Optional[Dict[str, Any]]) -> Dict[str, str]:
+    """Convert a data payload to the string values FCM requires.
+
+    Scalars are sent as str(value), as they always were; only dicts and
+    lists are JSON-encoded so the app can parse nested objects back out.
+    """
+    encoded = {}
+    for key, value in (data or {}).items():
+        if not isinstance(value, (dict, list, tuple)):
+            encoded[key] = str(value)
+        elif ORJSON_AVAILABLE:
+            encoded[key] = orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        else:
+            encoded[key] = json.dumps(value, separators=(",", ":"), default=str)
+    return encoded
+
+
+@lru_cache(maxsize=1024)
+def _weather_alert_title(severity: str, location: str) -> str:
+    """Build a weather alert title; a monitoring pass reuses a few per location."""
+    return f"{SEVERITY_ICONS.get(severity, DEFAULT_SEVERITY_ICON)} Weather Alert - {location}"
+
 
 class NotificationService:
     """Service for sending push notifications."""
@@ -45,6 +107,14 @@ class NotificationService:
         """
         self._initialized = False
         self._device_tokens: Dict[str, DeviceToken] = {}  # user_id -> DeviceToken
+        # (last_used, user_id) min-heap; entries go stale when a token is used
+        # again or removed, and are skipped when popped
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._invalid_tokens = TTLCache(maxsize=MAX_INVALID_TOKENS, ttl=INVALID_TOKEN_TTL)
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        # FCM topic -> device tokens currently subscribed to it
+        self._topic_tokens: Dict[str, set] = {}
 
         if FIREBASE_AVAILABLE and firebase_credentials_path:
             try:
@@ -61,16 +131,26 @@ class NotificationService:
 
     def _cleanup_expired_tokens(self) -> int:
         """Remove expired tokens. Returns number of tokens removed."""
-        now = datetime.utcnow()
-        expired_users = [
-            user_id for user_id, token_info in self._device_tokens.items()
-            if (now - token_info.last_used).days > TOKEN_TTL_DAYS
-        ]
-        for user_id in expired_users:
-            del self._device_tokens[user_id]
-        if expired_users:
-            logger.info(f"Cleaned up {len(expired_users)} expired device tokens")
-        return len(expired_users)
+        cutoff = time.time() - TOKEN_TTL_SECONDS
+        removed = 0
+        while self._expiry_heap and self._expiry_heap[0][0] < cutoff:
+            last_used, user_id = heapq.heappop(self._expiry_heap)
+            token_info = self._device_tokens.get(user_id)
+            if token_info is not None and token_info.last_used == last_used:
+                del self._device_tokens[user_id]
+                removed += 1
+        if removed:
+            logger.info(f"Cleaned up {removed} expired device tokens")
+        return removed
+
+    def _track_last_used(self, user_id: str, last_used: float):
+        """Record a token's latest use in the expiry heap."""
+        heapq.heappush(self._expiry_heap, (last_used, user_id))
+        # Stale entries pile up as tokens are reused; rebuild once they
+        # outnumber the live ones
+        if len(self._expiry_heap) > 2 * len(self._device_tokens) + 100:
+            self._expiry_heap = [(info.last_used, uid) for uid, info in self._device_tokens.items()]
+            heapq.heapify(self._expiry_heap)
 
     def register_device(self, user_id: str, device_token: str) -> bool:
         """
@@ -83,21 +163,21 @@ class NotificationService:
         Returns:
             True if registration successful.
         """
-        # Cleanup old tokens periodically (every 100 registrations or when near limit)
-        if len(self._device_tokens) >= MAX_TOKENS - 100:
-            self._cleanup_expired_tokens()
+        # Only expired tokens are touched, so this is cheap to do every time
+        self._cleanup_expired_tokens()
 
         # Enforce maximum token limit
         if len(self._device_tokens) >= MAX_TOKENS and user_id not in self._device_tokens:
             logger.warning(f"Max device tokens ({MAX_TOKENS}) reached, rejecting registration")
             return False
 
-        now = datetime.utcnow()
+        now = time.time()
         self._device_tokens[user_id] = DeviceToken(
             token=device_token,
             registered_at=now,
             last_used=now
         )
+        self._track_last_used(user_id, now)
         return True
 
     def unregister_device(self, user_id: str) -> bool:
@@ -120,11 +200,9 @@ class NotificationService:
         token_info = self._device_tokens.get(user_id)
         if token_info:
             # Update last_used time
-            self._device_tokens[user_id] = DeviceToken(
-                token=token_info.token,
-                registered_at=token_info.registered_at,
-                last_used=datetime.utcnow()
-            )
+            now = time.time()
+            self._device_tokens[user_id] = token_info._replace(last_used=now)
+            self._track_last_used(user_id, now)
             return token_info.token
         return None
 
@@ -139,6 +217,9 @@ class NotificationService:
         """
         Send a push notification to a user.
 
+        While the send workers are running, the notification joins their
+        next FCM batch; otherwise (or if the queue is full) it is sent alone.
+
         Args:
             user_id: User identifier
             title: Notification title
@@ -149,37 +230,16 @@ class NotificationService:
         Returns:
             True if notification sent successfully.
         """
-        device_token = self.get_device_token(user_id)
-        if not device_token:
-            logger.debug(f"No device token for user {user_id}")
-            return False
-
-        if not self._initialized:
-            # Log notification for testing/development
-            logger.info(f"[NOTIFICATION] To: {user_id} | Title: {title} | Body: {body}")
-            if data:
-                logger.debug(f"  Data: {data}")
-            return True
-
-        try:
-            notification = messaging.Notification(
-                title=title,
-                body=body,
-                image=image_url,
-            )
-
-            message = messaging.Message(
-                notification=notification,
-                data={k: str(v) for k, v in (data or {}).items()},
-                token=device_token,
-            )
-
-            response = messaging.send(message)
-            logger.info(f"Notification sent to {user_id}: {response}")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to send notification to {user_id}: {e}")
-            return False
+        notification = {"user_id": user_id, "title": title, "body": body, "data": data, "image_url": image_url}
+        if self._workers:
+            reply = asyncio.get_running_loop().create_future()
+            try:
+                self._queue.put_nowait((notification, reply))
+            except asyncio.QueueFull:
+                pass
+            else:
+                return await reply
+        return (await self._deliver([notification]))[0]
 
     async def send_weather_alert(
         self,
@@ -188,6 +248,7 @@ class NotificationService:
         location: str,
         message: str,
         severity: str = "info",
+        timestamp: Optional[str] = None,
     ) -> bool:
         """
         Send a weather alert notification.
@@ -198,31 +259,59 @@ class NotificationService:
             location: Location name
             message: Alert message
             severity: Alert severity (info, warning, severe)
+            timestamp: ISO timestamp for the payload; defaults to now. Callers
+                sending many alerts at once can format it once and share it.
 
         Returns:
             True if notification sent successfully.
         """
-        severity_icons = {
-            "info": "ℹ️",
-            "warning": "⚠️",
-            "severe": "🚨",
-        }
-        icon = severity_icons.get(severity, "🌤️")
+        title, data = self._weather_alert_content(alert_type, location, severity, timestamp)
+        return await self.send_notification(user_id=user_id, title=title, body=message, data=data)
 
-        title = f"{icon} Weather Alert - {location}"
+    async def queue_weather_alert(
+        self,
+        user_id: str,
+        alert_type: str,
+        location: str,
+        message: str,
+        severity: str = "info",
+        timestamp: Optional[str] = None,
+    ) -> bool:
+        """
+        Queue a weather alert notification for the send workers.
 
-        return await self.send_notification(
-            user_id=user_id,
-            title=title,
-            body=message,
-            data={
-                "type": "weather_alert",
-                "alert_type": alert_type,
-                "location": location,
-                "severity": severity,
-                "timestamp": datetime.utcnow().isoformat(),
-            },
-        )
+        Args:
+            user_id: User identifier
+            alert_type: Type of alert (rain, storm, temperature, etc.)
+            location: Location name
+            message: Alert message
+            severity: Alert severity (info, warning, severe)
+            timestamp: ISO timestamp for the payload; defaults to now. Callers
+                sending many alerts at once can format it once and share it.
+
+        Returns:
+            True if the alert was queued (or sent, when no workers are running).
+        """
+        title, data = self._weather_alert_content(alert_type, location, severity, timestamp)
+        return await self.queue_notification(user_id=user_id, title=title, body=message, data=data)
+
+    @staticmethod
+    def _weather_alert_content(
+        alert_type: str,
+        location: str,
+        severity: str,
+        timestamp: Optional[str] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """Build the title and data payload for a weather alert."""
+        title = _weather_alert_title(severity, location)
+        data = {
+            "type": "weather_alert",
+            "alert_type": alert_type,
+            "location": location,
+            "severity": severity,
+            "timestamp": timestamp or datetime.utcnow().isoformat(),
+        }
+        return title, data
 
     async def send_schedule_reminder(
         self,
@@ -267,6 +356,9 @@ class NotificationService:
         """
         Send notification to multiple users.
 
+        Messages go to FCM in batches of up to FCM_BATCH_SIZE, each batch
+        sent concurrently over one HTTP/2 connection.
+
         Args:
             user_ids: List of user identifiers
             title: Notification title
@@ -276,16 +368,297 @@ class NotificationService:
         Returns:
             Dictionary of user_id -> success status.
         """
+        notifications = [
+            {"user_id": user_id, "title": title, "body": body, "data": data, "image_url": None}
+            for user_id in dict.fromkeys(user_ids)
+        ]
         results = {}
-        for user_id in user_ids:
-            results[user_id] = await self.send_notification(
-                user_id=user_id,
-                title=title,
-                body=body,
-                data=data,
-            )
+        for start in range(0, len(notifications), FCM_BATCH_SIZE):
+            batch = notifications[start:start + FCM_BATCH_SIZE]
+            for notification, sent in zip(batch, await self._deliver(batch)):
+                results[notification["user_id"]] = sent
+        return results
+
+    async def set_topic_members(self, topic: str, user_ids: List[str]) -> int:
+        """
+        Make a topic's subscribers exactly the given users' devices.
+
+        Devices not yet in the topic are subscribed, and devices of users no
+        longer listed (or whose token changed) are unsubscribed, so a message
+        sent to the topic right after reaches only these users.
+
+        Args:
+            topic: FCM topic name
+            user_ids: Users who should receive the topic's messages
+
+        Returns:
+            Number of devices in the topic.
+        """
+        wanted = {
+            token for token in map(self.get_device_token, user_ids)
+            if token and not self._invalid_tokens.get(token)
+        }
+        current = self._topic_tokens.get(topic, set())
+        joining = list(wanted - current)
+        leaving = list(current - wanted)
+        if self._initialized:
+            await self._manage_topic(messaging.subscribe_to_topic, joining, topic)
+            await self._manage_topic(messaging.unsubscribe_from_topic, leaving, topic)
+        if wanted:
+            self._topic_tokens[topic] = wanted
+        else:
+            self._topic_tokens.pop(topic, None)
+        return len(wanted)
+
+    @staticmethod
+    async def _manage_topic(call, tokens: List[str], topic: str):
+        """Apply a topic (un)subscribe call in chunks of FCM_TOPIC_BATCH_SIZE tokens."""
+        for start in range(0, len(tokens), FCM_TOPIC_BATCH_SIZE):
+            # The topic management calls are blocking HTTP requests
+            await asyncio.to_thread(call, tokens[start:start + FCM_TOPIC_BATCH_SIZE], topic)
+
+    async def send_to_topic(
+        self,
+        topic: str,
+        title: str,
+        body: str,
+        data: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        """
+        Send one notification to every device subscribed to a topic.
+
+        Args:
+            topic: FCM topic name
+            title: Notification title
+            body: Notification body
+            data: Optional data payload
+
+        Returns:
+            True if FCM accepted the message.
+        """
+        if not self._initialized:
+            logger.info("[NOTIFICATION] Topic: %s | Title: %s | Body: %s", topic, title, body)
+            return True
+
+        message = messaging.Message(
+            notification=messaging.Notification(title=title, body=body),
+            data=_encode_data(data),
+            topic=topic,
+        )
+        try:
+            send_response = (await messaging.send_each_async([message])).responses[0]
+        except Exception as e:
+            logger.error("Failed to send to topic %s: %s", topic, e)
+            return False
+        if not send_response.success:
+            logger.error("Failed to send to topic %s: %s", topic, send_response.exception)
+        return send_response.success
+
+    async def send_weather_alert_to_topic(
+        self,
+        topic: str,
+        alert_type: str,
+        location: str,
+        message: str,
+        severity: str = "info",
+        timestamp: Optional[str] = None,
+    ) -> bool:
+        """
+        Send a weather alert to every device subscribed to a topic.
+
+        Args:
+            topic: FCM topic name
+            alert_type: Type of alert (rain, storm, temperature, etc.)
+            location: Location name
+            message: Alert message
+            severity: Alert severity (info, warning, severe)
+            timestamp: ISO timestamp for the payload; defaults to now
+
+        Returns:
+            True if FCM accepted the message.
+        """
+        title, data = self._weather_alert_content(alert_type, location, severity, timestamp)
+        return await self.send_to_topic(topic, title=title, body=message, data=data)
+
+    async def _deliver(self, notifications: List[Dict[str, Any]]) -> List[bool]:
+        """
+        Send up to FCM_BATCH_SIZE notifications with one FCM call.
+
+        Args:
+            notifications: send_notification keyword arguments, one dict per notification
+
+        Returns:
+            Whether each notification was sent, in order.
+        """
+        results = [False] * len(notifications)
+        recipients = []  # (index, notification, device token)
+        for index, notification in enumerate(notifications):
+            device_token = self.get_device_token(notification["user_id"])
+            if not device_token:
+                logger.debug("No device token for user %s", notification["user_id"])
+            elif self._invalid_tokens.get(device_token):
+                logger.debug("Skipping invalid device token for user %s", notification["user_id"])
+            else:
+                recipients.append((index, notification, device_token))
+        if not recipients:
+            return results
+
+        if not self._initialized:
+            # Log notifications for testing/development
+            for index, notification, _ in recipients:
+                logger.info(
+                    "[NOTIFICATION] To: %s | Title: %s | Body: %s",
+                    notification["user_id"], notification["title"], notification["body"],
+                )
+                if notification["data"]:
+                    logger.debug("  Data: %s", notification["data"])
+                results[index] = True
+            return results
+
+        try:
+            messages = self._build_messages(recipients)
+            # send_each_async uses the SDK's shared async HTTP/2 client, so the
+            # batch is sent concurrently over one connection
+            response = await messaging.send_each_async(messages)
+        except Exception as e:
+            logger.error("Failed to send %d notification(s): %s", len(recipients), e)
+            return results
+
+        for (index, notification, device_token), send_response in zip(recipients, response.responses):
+            results[index] = send_response.success
+            if send_response.success:
+                logger.debug("Notification sent to %s: %s", notification["user_id"], send_response.message_id)
+                continue
+            logger.error("Failed to send notification to %s: %s", notification["user_id"], send_response.exception)
+            if isinstance(send_response.exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+                self._forget_invalid_token(notification["user_id"], device_token)
         return results
 
+    @staticmethod
+    def _build_messages(recipients: list) -> list:
+        """Build FCM messages, sharing the payload and content between identical notifications.
+
+        Broadcasts pass one data dict and text for every recipient, so each is
+        converted and wrapped once per batch rather than once per user.
+        """
+        payloads: Dict[int, Dict[str, str]] = {}
+        contents: Dict[Tuple[str, str, Optional[str]], Any] = {}
+        messages = []
+        for _, notification, device_token in recipients:
+            # Every data dict stays referenced by its notification, so ids are unique
+            data = notification["data"]
+            payload = payloads.get(id(data))
+            if payload is None:
+                payload = payloads[id(data)] = _encode_data(data)
+            content_key = (notification["title"], notification["body"], notification["image_url"])
+            content = contents.get(content_key)
+            if content is None:
+                content = contents[content_key] = messaging.Notification(
+                    title=notification["title"],
+                    body=notification["body"],
+                    image=notification["image_url"],
+                )
+            messages.append(messaging.Message(notification=content, data=payload, token=device_token))
+        return messages
+
+    def _forget_invalid_token(self, user_id: str, device_token: str):
+        """Stop sending to a token FCM rejected (app uninstalled, token revoked)."""
+        self._invalid_tokens.set(device_token, True)
+        token_info = self._device_tokens.get(user_id)
+        if token_info is not None and token_info.token == device_token:
+            del self._device_tokens[user_id]
+
+    async def queue_notification(
+        self,
+        user_id: str,
+        title: str,
+        body: str,
+        data: Optional[Dict[str, Any]] = None,
+        image_url: Optional[str] = None,
+    ) -> bool:
+        """
+        Hand a notification to the send workers without waiting for delivery.
+
+        Sends inline if the workers haven't been started (e.g. in scripts
+        and tests).
+
+        Args:
+            user_id: User identifier
+            title: Notification title
+            body: Notification body text
+            data: Optional data payload
+            image_url: Optional image URL
+
+        Returns:
+            True if queued (or sent), False if the queue is full.
+        """
+        notification = {"user_id": user_id, "title": title, "body": body, "data": data, "image_url": image_url}
+        if not self._workers:
+            return (await self._deliver([notification]))[0]
+        try:
+            self._queue.put_nowait((notification, None))
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Notification queue full, dropping notification for %s", user_id)
+            return False
+
+    async def start_workers(self, count: int = NOTIFICATION_WORKERS):
+        """Start the background tasks that send queued notifications."""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+        self._workers = [asyncio.create_task(self._send_worker()) for _ in range(count)]
+        logger.info(f"Started {count} notification workers")
+
+    async def stop_workers(self):
+        """Let queued notifications finish sending, then stop the workers."""
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), NOTIFICATION_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d unsent notifications on shutdown", self._queue.qsize())
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        # Callers awaiting a dropped send get a failure instead of waiting forever
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if future is not None and not future.done():
+                future.set_result(False)
+        self._workers = []
+        self._queue = None
+
+    async def _send_worker(self):
+        """Send queued notifications in batches until cancelled."""
+        while True:
+            batch = [await self._queue.get()]
+            results: List[bool] = []
+            try:
+                await self._fill_batch(batch)
+                results = await self._deliver([notification for notification, _ in batch])
+            except Exception as e:
+                logger.exception("Sending %d queued notification(s) failed: %s", len(batch), e)
+            finally:
+                # Runs on cancellation too, so no sender waits forever
+                for index, (_, reply) in enumerate(batch):
+                    if reply is not None and not reply.done():
+                        reply.set_result(index < len(results) and results[index])
+                    self._queue.task_done()
+
+    async def _fill_batch(self, batch: list):
+        """Add notifications queued within NOTIFICATION_BATCH_WINDOW, up to FCM_BATCH_SIZE."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + NOTIFICATION_BATCH_WINDOW
+        while len(batch) < FCM_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                return
+
 
 # Global notification service instance
 _notification_service: Optional[NotificationService] = None
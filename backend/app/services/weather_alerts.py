@@ -4,18 +4,65 @@ This service monitors weather conditions and sends alerts
 when significant changes or severe weather is detected.
 """
 import asyncio
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple
 from datetime import datetime, timedelta
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import logging
+import time
 
+from ..cache import SingleFlight, TTLCache
 from ..tools import weather, geocoding
 from .notifications import get_notification_service
 
 logger = logging.getLogger(__name__)
 
+# Subscribers checked at once per monitoring pass; each check makes two
+# Open-Meteo requests
+MAX_CONCURRENT_ALERT_CHECKS = 50
 
-@dataclass
+# Subscribers in the same ~11 km grid cell share one weather fetch; results
+# are reused for a few minutes, well within one monitoring pass
+ALERT_GRID_DECIMALS = 1
+CONDITIONS_TTL = 300
+
+# Open-Meteo codes for thunderstorms and heavy rain, freezing rain, snow
+# and showers
+SEVERE_WEATHER_CODES = frozenset((95, 96, 99, 65, 67, 75, 82, 86))
+
+# Conditions usually persist across several monitoring passes; repeat an
+# alert type no more often than this
+MIN_RENOTIFY_INTERVAL = timedelta(hours=3)
+
+
+def _grid_cell(latitude: float, longitude: float) -> Tuple[float, float]:
+    """Round a location to its alert grid cell."""
+    return round(latitude, ALERT_GRID_DECIMALS), round(longitude, ALERT_GRID_DECIMALS)
+
+
+def _cell_label(cell: Tuple[float, float]) -> str:
+    """Neutral name for a grid cell, shared by everyone in it (e.g. "40.7°N, 74.0°W")."""
+    latitude, longitude = cell
+    return (
+        f"{abs(latitude):.{ALERT_GRID_DECIMALS}f}°{'N' if latitude >= 0 else 'S'}, "
+        f"{abs(longitude):.{ALERT_GRID_DECIMALS}f}°{'E' if longitude >= 0 else 'W'}"
+    )
+
+
+def severe_alert_topic(cell: Tuple[float, float]) -> str:
+    """FCM topic that carries a grid cell's severe weather alerts."""
+    return f"severe_weather_{cell[0]}_{cell[1]}"
+
+
+@dataclass(slots=True, frozen=True)
+class CellConditions:
+    """Weather for one alert grid cell, with the alerts that apply to everyone in it."""
+    current: Dict[str, Any]
+    forecast: Dict[str, Any]
+    severe_alert: Optional[Dict[str, Any]]
+    rain_alert: Optional[Dict[str, Any]]
+
+
+@dataclass(slots=True)
 class UserWeatherSubscription:
     """User's weather monitoring subscription."""
     user_id: str
@@ -30,6 +77,8 @@ class UserWeatherSubscription:
     temperature_threshold_low: float = 32.0   # Fahrenheit
     last_checked: Optional[datetime] = None
     last_conditions: Optional[Dict[str, Any]] = None
+    last_alert_sent: Dict[str, datetime] = field(default_factory=dict)
+    min_renotify_interval: timedelta = MIN_RENOTIFY_INTERVAL
 
 
 class WeatherAlertService:
@@ -40,6 +89,11 @@ class WeatherAlertService:
         self._subscriptions: Dict[str, UserWeatherSubscription] = {}
         self._running = False
         self._check_interval = 1800  # 30 minutes
+        self._check_slots = asyncio.Semaphore(MAX_CONCURRENT_ALERT_CHECKS)
+        # Grid cell -> CellConditions
+        self._conditions = TTLCache(maxsize=10000, ttl=CONDITIONS_TTL)
+        self._conditions_flights = SingleFlight()
+        self._monitor_task: Optional[asyncio.Task] = None
 
     def subscribe(
         self,
@@ -106,12 +160,23 @@ class WeatherAlertService:
                 setattr(sub, key, value)
         return True
 
-    async def check_weather_for_user(self, user_id: str) -> List[Dict[str, Any]]:
+    async def check_weather_for_user(
+        self,
+        user_id: str,
+        now: Optional[datetime] = None,
+        notify_severe: bool = True,
+        timestamp: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
         """
         Check weather conditions for a user and generate alerts.
 
         Args:
             user_id: User identifier
+            now: Time of the check; a monitoring pass shares one per grid cell
+            notify_severe: Whether to push severe alerts to this user; a
+                monitoring pass sends those to the whole grid cell instead
+            timestamp: `now` as an ISO string for alert payloads; a monitoring
+                pass formats it once per grid cell
 
         Returns:
             List of generated alerts.
@@ -124,83 +189,100 @@ class WeatherAlertService:
             return []
 
         alerts = []
-        notification_service = get_notification_service()
+        now = now or datetime.utcnow()
+        timestamp = timestamp or now.isoformat()
 
         try:
-            # Get current weather
-            current = await weather.get_current_weather(
-                latitude=sub.latitude,
-                longitude=sub.longitude,
-            )
-
-            # Get forecast for rain prediction
-            forecast = await weather.get_hourly_forecast(
-                latitude=sub.latitude,
-                longitude=sub.longitude,
-                hours=24,
-            )
+            # Severe weather and rain depend only on the grid cell, so those
+            # checks run once per cell; only the thresholds are per user
+            conditions = await self._get_conditions(sub.latitude, sub.longitude)
+            current = conditions.current
 
             # Check for severe weather
             if sub.severe_weather_alerts:
-                severe_alert = self._check_severe_weather(current, sub)
+                severe_alert = conditions.severe_alert
                 if severe_alert:
                     alerts.append(severe_alert)
-                    await notification_service.send_weather_alert(
-                        user_id=user_id,
-                        alert_type=severe_alert["type"],
-                        location=sub.location_name,
-                        message=severe_alert["message"],
-                        severity="severe",
-                    )
+                    if notify_severe:
+                        await self._notify(sub, severe_alert["type"], severe_alert["message"], "severe", now, timestamp)
 
             # Check for rain
             if sub.rain_alerts:
-                rain_alert = self._check_rain(current, forecast, sub)
+                rain_alert = conditions.rain_alert
                 if rain_alert:
                     alerts.append(rain_alert)
-                    await notification_service.send_weather_alert(
-                        user_id=user_id,
-                        alert_type="rain",
-                        location=sub.location_name,
-                        message=rain_alert["message"],
-                        severity="warning",
-                    )
+                    await self._notify(sub, "rain", rain_alert["message"], "warning", now, timestamp)
 
             # Check temperature extremes
             if sub.temperature_alerts:
                 temp_alert = self._check_temperature(current, sub)
                 if temp_alert:
                     alerts.append(temp_alert)
-                    await notification_service.send_weather_alert(
-                        user_id=user_id,
-                        alert_type="temperature",
-                        location=sub.location_name,
-                        message=temp_alert["message"],
-                        severity="info",
-                    )
+                    await self._notify(sub, "temperature", temp_alert["message"], "info", now, timestamp)
 
             # Update last checked
-            sub.last_checked = datetime.utcnow()
+            sub.last_checked = now
             sub.last_conditions = current
 
         except Exception as e:
-            logger.error(f"Error checking weather for user {user_id}: {e}")
+            logger.exception("Error checking weather for user %s: %s", user_id, e)
 
         return alerts
 
-    def _check_severe_weather(
+    async def _notify(
         self,
-        current: Dict[str, Any],
         sub: UserWeatherSubscription,
-    ) -> Optional[Dict[str, Any]]:
+        alert_type: str,
+        message: str,
+        severity: str,
+        now: datetime,
+        timestamp: str,
+    ) -> None:
+        """Queue an alert unless the same type was sent to the user recently."""
+        last_sent = sub.last_alert_sent.get(alert_type)
+        if last_sent is not None and now - last_sent < sub.min_renotify_interval:
+            return
+        queued = await get_notification_service().queue_weather_alert(
+            user_id=sub.user_id,
+            alert_type=alert_type,
+            location=sub.location_name,
+            message=message,
+            severity=severity,
+            timestamp=timestamp,
+        )
+        # A dropped alert (full queue) is retried on the next check
+        if queued:
+            sub.last_alert_sent[alert_type] = now
+
+    async def _get_conditions(self, latitude: float, longitude: float) -> CellConditions:
+        """Get current weather, the hourly forecast and shared alerts for a location's grid cell."""
+        cell = _grid_cell(latitude, longitude)
+        conditions = self._conditions.get(cell)
+        if conditions is not None:
+            return conditions
+        return await self._conditions_flights.do(cell, lambda: self._fetch_conditions(*cell))
+
+    async def _fetch_conditions(self, latitude: float, longitude: float) -> CellConditions:
+        """Fetch and cache one grid cell's current weather and forecast."""
+        current, forecast = await asyncio.gather(
+            weather.get_current_weather(latitude=latitude, longitude=longitude),
+            weather.get_hourly_forecast(latitude=latitude, longitude=longitude, hours=24),
+        )
+        conditions = CellConditions(
+            current=current,
+            forecast=forecast,
+            severe_alert=self._check_severe_weather(current),
+            rain_alert=self._check_rain(current, forecast),
+        )
+        self._conditions.set((latitude, longitude), conditions)
+        return conditions
+
+    def _check_severe_weather(self, current: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Check for severe weather conditions."""
         weather_code = current.get("weather_code", 0)
         description = current.get("weather_description", "")
 
-        # Severe weather codes (thunderstorms, heavy precipitation)
-        severe_codes = [95, 96, 99, 65, 67, 75, 82, 86]
-
-        if weather_code in severe_codes:
+        if weather_code in SEVERE_WEATHER_CODES:
             return {
                 "type": "severe_weather",
                 "message": f"Severe weather alert: {description}. Take precautions!",
@@ -224,7 +306,6 @@ class WeatherAlertService:
         self,
         current: Dict[str, Any],
         forecast: Dict[str, Any],
-        sub: UserWeatherSubscription,
     ) -> Optional[Dict[str, Any]]:
         """Check for upcoming rain."""
         # Skip if already raining
@@ -277,29 +358,132 @@ class WeatherAlertService:
 
         return None
 
+    async def _broadcast_severe_alert(
+        self,
+        cell: Tuple[float, float],
+        subs: List[UserWeatherSubscription],
+        now: datetime,
+        timestamp: str,
+    ) -> None:
+        """Send a grid cell's severe weather alert once, to an FCM topic for the cell.
+
+        Only subscribers due for the alert are in the topic when it is sent, so
+        those still inside their re-notify interval don't get it again. The
+        title names the cell, not any one subscriber's saved location.
+        """
+        alert = (await self._get_conditions(*cell)).severe_alert
+        if not alert:
+            return
+        members = [sub for sub in subs if sub.alerts_enabled and sub.severe_weather_alerts]
+        due = [
+            sub for sub in members
+            if now - sub.last_alert_sent.get(alert["type"], datetime.min) >= sub.min_renotify_interval
+        ]
+        if not due:
+            return
+
+        notification_service = get_notification_service()
+        topic = severe_alert_topic(cell)
+        try:
+            await notification_service.set_topic_members(topic, [sub.user_id for sub in due])
+            sent = await notification_service.send_weather_alert_to_topic(
+                topic=topic,
+                alert_type=alert["type"],
+                location=_cell_label(cell),
+                message=alert["message"],
+                severity="severe",
+                timestamp=timestamp,
+            )
+        except Exception as e:
+            logger.error("Topic alert for %s failed: %s", topic, e)
+            sent = False
+
+        if sent:
+            for sub in due:
+                sub.last_alert_sent[alert["type"]] = now
+            return
+        # Fall back to alerting each due subscriber directly
+        for sub in due:
+            await self._notify(sub, alert["type"], alert["message"], "severe", now, timestamp)
+
+    async def check_all_users(self, spread: float = 0):
+        """
+        Check every subscriber, up to MAX_CONCURRENT_ALERT_CHECKS at a time.
+
+        Subscribers are checked a grid cell at a time. Severe weather affects
+        the whole cell, so its alert goes out as one FCM topic message; the
+        per-user checks then handle rain and temperature alerts.
+
+        Args:
+            spread: Seconds to stagger the cells' checks over, so a monitoring
+                pass makes a steady trickle of requests instead of a burst
+        """
+        started = datetime.utcnow()
+
+        cells: Dict[Tuple[float, float], List[UserWeatherSubscription]] = {}
+        for sub in self._subscriptions.values():
+            cells.setdefault(_grid_cell(sub.latitude, sub.longitude), []).append(sub)
+
+        async def check_cell(cell: Tuple[float, float], subs: List[UserWeatherSubscription], delay: float):
+            await asyncio.sleep(delay)
+            # A spread pass reaches later cells long after the snapshot: skip
+            # users who unsubscribed or re-subscribed (a new object) since
+            subs = [sub for sub in subs if self._subscriptions.get(sub.user_id) is sub]
+            if not subs:
+                return
+            now = started + timedelta(seconds=delay)
+            # Every alert for this cell carries the same payload timestamp
+            timestamp = now.isoformat()
+            try:
+                async with self._check_slots:
+                    await self._broadcast_severe_alert(cell, subs, now, timestamp)
+            except Exception as e:
+                logger.exception("Error monitoring weather for cell %s: %s", cell, e)
+
+            async def check(user_id: str):
+                async with self._check_slots:
+                    await self.check_weather_for_user(user_id, now, notify_severe=False, timestamp=timestamp)
+
+            user_ids = [sub.user_id for sub in subs]
+            results = await asyncio.gather(*(check(user_id) for user_id in user_ids), return_exceptions=True)
+            for user_id, result in zip(user_ids, results):
+                if isinstance(result, Exception):
+                    logger.error("Error monitoring weather for %s: %s", user_id, result, exc_info=result)
+
+        step = spread / len(cells) if cells else 0
+        await asyncio.gather(*(
+            check_cell(cell, subs, index * step) for index, (cell, subs) in enumerate(cells.items())
+        ))
+
     async def start_monitoring(self):
         """Start the background weather monitoring loop."""
         if self._running:
             return
 
         self._running = True
+        self._monitor_task = asyncio.current_task()
         logger.info("Weather alert monitoring started")
 
         while self._running:
-            for user_id in list(self._subscriptions.keys()):
-                try:
-                    await self.check_weather_for_user(user_id)
-                except Exception as e:
-                    logger.error(f"Error monitoring weather for {user_id}: {e}")
+            pass_started = time.monotonic()
+            await self.check_all_users(spread=self._check_interval)
 
-            # Wait before next check
-            await asyncio.sleep(self._check_interval)
+            # Checks are spread over the interval; wait out whatever is left
+            await asyncio.sleep(max(0.0, self._check_interval - (time.monotonic() - pass_started)))
 
     def stop_monitoring(self):
         """Stop the background weather monitoring."""
         self._running = False
         logger.info("Weather alert monitoring stopped")
 
+    async def aclose(self):
+        """Stop monitoring and cancel the pass in progress, including its pending checks."""
+        self.stop_monitoring()
+        task, self._monitor_task = self._monitor_task, None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
 
 # Global weather alert service instance
 _weather_alert_service: Optional[WeatherAlertService] = None
@@ -7,6 +7,8 @@ import httpx
 from typing import Optional, List
 import logging
 
+from ..http_client import get_http_client
+
 logger = logging.getLogger(__name__)
 
 NOMINATIM_BASE_URL = "https://nominatim.openstreetmap.org"
@@ -41,14 +43,15 @@ async def geocode_location(
         "limit": limit,
     }
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        response = await client.get(
-            f"{NOMINATIM_BASE_URL}/search",
-            params=params,
-            headers=HEADERS
-        )
-        response.raise_for_status()
-        results = response.json()
+    client = get_http_client()
+    response = await client.get(
+        f"{NOMINATIM_BASE_URL}/search",
+        params=params,
+        headers=HEADERS,
+        timeout=HTTP_TIMEOUT
+    )
+    response.raise_for_status()
+    results = response.json()
 
     locations = []
     for result in results:
@@ -93,14 +96,15 @@ async def reverse_geocode(
         "addressdetails": 1,
     }
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        response = await client.get(
-            f"{NOMINATIM_BASE_URL}/reverse",
-            params=params,
-            headers=HEADERS
-        )
-        response.raise_for_status()
-        result = response.json()
+    client = get_http_client()
+    response = await client.get(
+        f"{NOMINATIM_BASE_URL}/reverse",
+        params=params,
+        headers=HEADERS,
+        timeout=HTTP_TIMEOUT
+    )
+    response.raise_for_status()
+    result = response.json()
 
     address = result.get("address", {})
 
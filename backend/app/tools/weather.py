@@ -8,6 +8,8 @@ from typing import Optional
 from datetime import datetime, timedelta
 import logging
 
+from ..http_client import get_http_client
+
 logger = logging.getLogger(__name__)
 
 OPEN_METEO_BASE_URL = "https://api.open-meteo.com/v1"
@@ -15,6 +17,67 @@ OPEN_METEO_BASE_URL = "https://api.open-meteo.com/v1"
 # HTTP timeout settings (in seconds)
 HTTP_TIMEOUT = httpx.Timeout(10.0, connect=5.0)  # 10s total, 5s connect
 
+# Response field -> Open-Meteo daily variable
+_DAILY_COLUMNS = (
+    ("temp_high", "temperature_2m_max"),
+    ("temp_low", "temperature_2m_min"),
+    ("feels_like_high", "apparent_temperature_max"),
+    ("feels_like_low", "apparent_temperature_min"),
+    ("sunrise", "sunrise"),
+    ("sunset", "sunset"),
+    ("precipitation", "precipitation_sum"),
+    ("precipitation_probability", "precipitation_probability_max"),
+    ("precipitation_hours", "precipitation_hours"),
+    ("wind_speed_max", "wind_speed_10m_max"),
+    ("wind_gusts_max", "wind_gusts_10m_max"),
+    ("uv_index_max", "uv_index_max"),
+)
+
+# Response field -> Open-Meteo hourly variable
+_HOURLY_COLUMNS = (
+    ("temperature", "temperature_2m"),
+    ("feels_like", "apparent_temperature"),
+    ("humidity", "relative_humidity_2m"),
+    ("precipitation_probability", "precipitation_probability"),
+    ("precipitation", "precipitation"),
+    ("cloud_cover", "cloud_cover"),
+    ("wind_speed", "wind_speed_10m"),
+    ("wind_gusts", "wind_gusts_10m"),
+    ("uv_index", "uv_index"),
+)
+
+# WMO weather interpretation codes
+WEATHER_CODES = {
+    0: "Clear sky",
+    1: "Mainly clear",
+    2: "Partly cloudy",
+    3: "Overcast",
+    45: "Foggy",
+    48: "Depositing rime fog",
+    51: "Light drizzle",
+    53: "Moderate drizzle",
+    55: "Dense drizzle",
+    56: "Light freezing drizzle",
+    57: "Dense freezing drizzle",
+    61: "Slight rain",
+    63: "Moderate rain",
+    65: "Heavy rain",
+    66: "Light freezing rain",
+    67: "Heavy freezing rain",
+    71: "Slight snowfall",
+    73: "Moderate snowfall",
+    75: "Heavy snowfall",
+    77: "Snow grains",
+    80: "Slight rain showers",
+    81: "Moderate rain showers",
+    82: "Violent rain showers",
+    85: "Slight snow showers",
+    86: "Heavy snow showers",
+    95: "Thunderstorm",
+    96: "Thunderstorm with slight hail",
+    99: "Thunderstorm with heavy hail",
+}
+
 
 async def get_current_weather(
     latitude: float,
@@ -55,10 +118,10 @@ async def get_current_weather(
         "timezone": "auto",
     }
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        response = await client.get(f"{OPEN_METEO_BASE_URL}/forecast", params=params)
-        response.raise_for_status()
-        data = response.json()
+    client = get_http_client()
+    response = await client.get(f"{OPEN_METEO_BASE_URL}/forecast", params=params, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
 
     current = data.get("current", {})
 
@@ -128,35 +191,21 @@ async def get_weather_forecast(
         "forecast_days": min(days, 16),
     }
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        response = await client.get(f"{OPEN_METEO_BASE_URL}/forecast", params=params)
-        response.raise_for_status()
-        data = response.json()
+    client = get_http_client()
+    response = await client.get(f"{OPEN_METEO_BASE_URL}/forecast", params=params, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
 
     daily = data.get("daily", {})
     dates = daily.get("time", [])
+    codes = _column(daily, "weather_code", len(dates))
 
-    forecasts = []
-    for i, date in enumerate(dates):
-        forecasts.append({
-            "date": date,
-            "weather_code": daily.get("weather_code", [])[i] if i < len(daily.get("weather_code", [])) else None,
-            "weather_description": _weather_code_to_description(
-                daily.get("weather_code", [])[i] if i < len(daily.get("weather_code", [])) else None
-            ),
-            "temp_high": daily.get("temperature_2m_max", [])[i] if i < len(daily.get("temperature_2m_max", [])) else None,
-            "temp_low": daily.get("temperature_2m_min", [])[i] if i < len(daily.get("temperature_2m_min", [])) else None,
-            "feels_like_high": daily.get("apparent_temperature_max", [])[i] if i < len(daily.get("apparent_temperature_max", [])) else None,
-            "feels_like_low": daily.get("apparent_temperature_min", [])[i] if i < len(daily.get("apparent_temperature_min", [])) else None,
-            "sunrise": daily.get("sunrise", [])[i] if i < len(daily.get("sunrise", [])) else None,
-            "sunset": daily.get("sunset", [])[i] if i < len(daily.get("sunset", [])) else None,
-            "precipitation": daily.get("precipitation_sum", [])[i] if i < len(daily.get("precipitation_sum", [])) else None,
-            "precipitation_probability": daily.get("precipitation_probability_max", [])[i] if i < len(daily.get("precipitation_probability_max", [])) else None,
-            "precipitation_hours": daily.get("precipitation_hours", [])[i] if i < len(daily.get("precipitation_hours", [])) else None,
-            "wind_speed_max": daily.get("wind_speed_10m_max", [])[i] if i < len(daily.get("wind_speed_10m_max", [])) else None,
-            "wind_gusts_max": daily.get("wind_gusts_10m_max", [])[i] if i < len(daily.get("wind_gusts_10m_max", [])) else None,
-            "uv_index_max": daily.get("uv_index_max", [])[i] if i < len(daily.get("uv_index_max", [])) else None,
-        })
+    forecasts = _rows({
+        "date": dates,
+        "weather_code": codes,
+        "weather_description": [_weather_code_to_description(code) for code in codes],
+        **{name: _column(daily, key, len(dates)) for name, key in _DAILY_COLUMNS},
+    })
 
     return {
         "forecasts": forecasts,
@@ -211,33 +260,22 @@ async def get_hourly_forecast(
         "forecast_hours": min(hours, 384),
     }
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        response = await client.get(f"{OPEN_METEO_BASE_URL}/forecast", params=params)
-        response.raise_for_status()
-        data = response.json()
+    client = get_http_client()
+    response = await client.get(f"{OPEN_METEO_BASE_URL}/forecast", params=params, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
 
     hourly = data.get("hourly", {})
     times = hourly.get("time", [])[:hours]
+    codes = _column(hourly, "weather_code", len(times))
 
-    forecasts = []
-    for i, time in enumerate(times):
-        forecasts.append({
-            "time": time,
-            "temperature": hourly.get("temperature_2m", [])[i] if i < len(hourly.get("temperature_2m", [])) else None,
-            "feels_like": hourly.get("apparent_temperature", [])[i] if i < len(hourly.get("apparent_temperature", [])) else None,
-            "humidity": hourly.get("relative_humidity_2m", [])[i] if i < len(hourly.get("relative_humidity_2m", [])) else None,
-            "precipitation_probability": hourly.get("precipitation_probability", [])[i] if i < len(hourly.get("precipitation_probability", [])) else None,
-            "precipitation": hourly.get("precipitation", [])[i] if i < len(hourly.get("precipitation", [])) else None,
-            "weather_code": hourly.get("weather_code", [])[i] if i < len(hourly.get("weather_code", [])) else None,
-            "weather_description": _weather_code_to_description(
-                hourly.get("weather_code", [])[i] if i < len(hourly.get("weather_code", [])) else None
-            ),
-            "cloud_cover": hourly.get("cloud_cover", [])[i] if i < len(hourly.get("cloud_cover", [])) else None,
-            "wind_speed": hourly.get("wind_speed_10m", [])[i] if i < len(hourly.get("wind_speed_10m", [])) else None,
-            "wind_gusts": hourly.get("wind_gusts_10m", [])[i] if i < len(hourly.get("wind_gusts_10m", [])) else None,
-            "uv_index": hourly.get("uv_index", [])[i] if i < len(hourly.get("uv_index", [])) else None,
-            "is_day": hourly.get("is_day", [])[i] == 1 if i < len(hourly.get("is_day", [])) else None,
-        })
+    forecasts = _rows({
+        "time": times,
+        "weather_code": codes,
+        "weather_description": [_weather_code_to_description(code) for code in codes],
+        "is_day": [None if flag is None else flag == 1 for flag in _column(hourly, "is_day", len(times))],
+        **{name: _column(hourly, key, len(times)) for name, key in _HOURLY_COLUMNS},
+    })
 
     return {
         "forecasts": forecasts,
@@ -250,40 +288,20 @@ async def get_hourly_forecast(
     }
 
 
+def _column(block: dict, key: str, length: int) -> list:
+    """Get one Open-Meteo variable as a list of exactly `length` values, padded with None."""
+    values = block.get(key) or []
+    return values[:length] + [None] * (length - len(values))
+
+
+def _rows(columns: dict) -> list:
+    """Turn equal-length columns into one dict per time step, keeping column order."""
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
 def _weather_code_to_description(code: Optional[int]) -> str:
     """Convert WMO weather code to human-readable description."""
     if code is None:
         return "Unknown"
-
-    weather_codes = {
-        0: "Clear sky",
-        1: "Mainly clear",
-        2: "Partly cloudy",
-        3: "Overcast",
-        45: "Foggy",
-        48: "Depositing rime fog",
-        51: "Light drizzle",
-        53: "Moderate drizzle",
-        55: "Dense drizzle",
-        56: "Light freezing drizzle",
-        57: "Dense freezing drizzle",
-        61: "Slight rain",
-        63: "Moderate rain",
-        65: "Heavy rain",
-        66: "Light freezing rain",
-        67: "Heavy freezing rain",
-        71: "Slight snowfall",
-        73: "Moderate snowfall",
-        75: "Heavy snowfall",
-        77: "Snow grains",
-        80: "Slight rain showers",
-        81: "Moderate rain showers",
-        82: "Violent rain showers",
-        85: "Slight snow showers",
-        86: "Heavy snow showers",
-        95: "Thunderstorm",
-        96: "Thunderstorm with slight hail",
-        99: "Thunderstorm with heavy hail",
-    }
-
-    return weather_codes.get(code, f"Unknown ({code})")
+    return WEATHER_CODES.get(code, f"Unknown ({code})")
@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 """Script to run the Weather Intelligence Agent API server."""
+import importlib.util
+
 import uvicorn
 from app.config import settings
 
+# uvicorn[standard] installs uvloop and httptools (uvloop isn't available on
+# Windows); fall back to the pure-Python implementations without them
+LOOP = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+HTTP = "httptools" if importlib.util.find_spec("httptools") else "h11"
+
 if __name__ == "__main__":
     print(f"Starting {settings.app_name}...")
     print(f"API docs available at: http://{settings.api_host}:{settings.api_port}/docs")
+    print(f"Event loop: {LOOP}, HTTP parser: {HTTP}")
 
+    # A single worker: agents, subscriptions and caches are held in process
+    # memory, so extra workers would each see a different subset of users
     uvicorn.run(
         "app.main:app",
         host=settings.api_host,
         port=settings.api_port,
+        loop=LOOP,
+        http=HTTP,
+        # The reloader's file watcher is only for development
         reload=settings.debug
     )
@@ -18,3 +18,24 @@ def pytest_configure(config):
     config.addinivalue_line(
         "markers", "asyncio: mark test as async"
     )
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Start every test with empty in-process caches."""
+    from app.agent import weather_agent
+    from app.api import routes
+
+    weather_agent._GEOCODE_CACHE.clear()
+    weather_agent._CURRENT_WEATHER_CACHE.clear()
+    weather_agent._LETTA_CLIENTS.clear()
+    routes._current_weather_cache.clear()
+    routes._forecast_cache.clear()
+    routes._geocode_cache.clear()
+    routes._alert_checks.clear()
+    routes._calendar_status_cache.clear()
+    routes._health_cache.clear()
+    routes._chat_limiter.clear()
+    routes._notification_test_limiter.clear()
+    routes._write_limiter.clear()
+    yield
@@ -0,0 +1,1044 @@
+"""Tests for the Letta weather agent manager."""
+import asyncio
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+from app.agent import weather_agent
+from app.agent.weather_agent import WeatherAgentManager, get_agent_manager, get_weather_tools
+
+
+def make_letta_manager(tmp_path):
+    """Create a manager wired to a mocked Letta client."""
+    manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+    manager._client = MagicMock()
+    manager._client.agents.list.return_value = []
+    manager._client.tools.list.return_value = []
+    manager._client.agents.create.return_value = SimpleNamespace(id="agent-new")
+    manager._client.tools.create.return_value = SimpleNamespace(id="tool-1")
+    manager._letta_available = True
+    return manager
+
+
+class TestWeatherTools:
+    """Tests for the agent tool definitions."""
+
+    def test_weather_tools_built_once(self):
+        """Test that the tool schemas are a shared module-level constant."""
+        assert get_weather_tools() is get_weather_tools()
+        assert len(get_weather_tools()) == 7
+
+    def test_every_tool_has_an_implementation(self):
+        """Test that each tool definition maps to a callable."""
+        for tool_def in get_weather_tools():
+            func = weather_agent._TOOL_FUNCTIONS[tool_def["name"]]
+            assert callable(func)
+            assert func.__name__ == tool_def["name"]
+
+    def test_tool_payloads_built_once_at_import(self):
+        """Test that every tool's upload arguments are prepared for registration."""
+        for tool_def in get_weather_tools():
+            payload = weather_agent._TOOL_PAYLOADS[tool_def["name"]]
+            assert f"def {tool_def['name']}(" in payload["source_code"]
+            assert payload["description"] == tool_def["description"]
+
+    @pytest.mark.asyncio
+    async def test_tool_created_from_prepared_payload(self, tmp_path, monkeypatch):
+        """Test that registration uploads the prepared payload without re-reading source."""
+        manager = make_letta_manager(tmp_path)
+        monkeypatch.setattr(weather_agent.inspect, "getsource", MagicMock(side_effect=AssertionError))
+        tool_def = get_weather_tools()[0]
+
+        await manager._get_tool_id(tool_def)
+        manager._client.tools.create.assert_called_once_with(
+            **weather_agent._TOOL_PAYLOADS[tool_def["name"]]
+        )
+
+
+class TestLettaHttpClient:
+    """Tests for the HTTP client handed to the Letta SDK."""
+
+    def test_responses_decoded_with_orjson(self):
+        """Test that the transport returns responses parsing the same JSON."""
+        pytest.importorskip("orjson")
+        body = {"messages": [{"assistant_message": "Sunny \u2600", "tool_call": None}]}
+        inner = httpx.MockTransport(lambda request: httpx.Response(200, json=body))
+        client = httpx.Client(transport=weather_agent._OrjsonTransport(inner))
+
+        response = client.get("http://letta.test/v1/agents/")
+        assert isinstance(response, weather_agent._OrjsonResponse)
+        assert response.json() == body
+
+
+    def test_http_client_timeout(self):
+        """Test that the Letta HTTP client is built with the tuned timeout."""
+        client = weather_agent._build_letta_http_client()
+        try:
+            assert client.timeout == weather_agent.LETTA_HTTP_TIMEOUT
+        finally:
+            client.close()
+
+
+class TestLazyConnection:
+    """Tests for connecting to Letta on first use."""
+
+    @pytest.mark.asyncio
+    async def test_connects_once_on_first_use(self, tmp_path, monkeypatch):
+        """Test that construction is offline and concurrent first calls connect once."""
+        letta_cls = MagicMock()
+        monkeypatch.setattr(weather_agent, "LETTA_AVAILABLE", True)
+        monkeypatch.setitem(sys.modules, "letta_client", SimpleNamespace(Letta=letta_cls))
+
+        manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        letta_cls.assert_not_called()
+
+        results = await asyncio.gather(*(manager.ensure_connected() for _ in range(5)))
+        assert results == [True] * 5
+        letta_cls.assert_called_once()
+        letta_cls.return_value.health.check.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_client_shared_across_managers(self, tmp_path, monkeypatch):
+        """Test that managers for the same server reuse one checked client."""
+        letta_cls = MagicMock()
+        monkeypatch.setattr(weather_agent, "LETTA_AVAILABLE", True)
+        monkeypatch.setitem(sys.modules, "letta_client", SimpleNamespace(Letta=letta_cls))
+
+        first = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        second = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        other = WeatherAgentManager(base_url="http://letta.test:9000", cache_path=str(tmp_path / "agents.json"))
+        assert await first.ensure_connected()
+        assert await second.ensure_connected()
+        assert await other.ensure_connected()
+
+        assert first.client is second.client
+        assert letta_cls.call_count == 2
+        assert letta_cls.return_value.health.check.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_unreachable_server_runs_standalone(self, tmp_path, monkeypatch):
+        """Test that a failed health check falls back to local agents."""
+        letta_cls = MagicMock()
+        letta_cls.return_value.health.check.side_effect = ConnectionError("refused")
+        monkeypatch.setattr(weather_agent, "LETTA_AVAILABLE", True)
+        monkeypatch.setitem(sys.modules, "letta_client", SimpleNamespace(Letta=letta_cls))
+
+        manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        assert await manager.create_agent("tess") == "local_agent_tess"
+        assert await manager.ensure_connected() is False
+        letta_cls.return_value.health.check.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_unreachable_server_reprobed_after_interval(self, tmp_path, monkeypatch):
+        """Test that a standalone manager reconnects once the re-probe interval passes."""
+        letta_cls = MagicMock()
+        letta_cls.return_value.health.check.side_effect = [ConnectionError("refused"), None]
+        monkeypatch.setattr(weather_agent, "LETTA_AVAILABLE", True)
+        monkeypatch.setitem(sys.modules, "letta_client", SimpleNamespace(Letta=letta_cls))
+
+        manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        assert await manager.ensure_connected() is False
+        assert await manager.ensure_connected() is False
+        assert letta_cls.return_value.health.check.call_count == 1
+
+        manager._next_probe_at = 0.0
+        assert await manager.ensure_connected() is True
+        assert letta_cls.return_value.health.check.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_recovered_server_replaces_local_agent(self, tmp_path, monkeypatch):
+        """Test that a user answered locally during an outage gets their Letta agent afterwards."""
+        letta_cls = MagicMock()
+        letta_cls.return_value.health.check.side_effect = [ConnectionError("refused"), None]
+        letta_cls.return_value.agents.list.return_value = [SimpleNamespace(id="agent-tess")]
+        monkeypatch.setattr(weather_agent, "LETTA_AVAILABLE", True)
+        monkeypatch.setitem(sys.modules, "letta_client", SimpleNamespace(Letta=letta_cls))
+
+        manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        assert await manager.create_agent("tess") == "local_agent_tess"
+
+        manager._next_probe_at = 0.0
+        assert await manager.ensure_connected() is True
+        assert await manager.get_agent_id("tess") == "agent-tess"
+
+    @pytest.mark.asyncio
+    async def test_hung_health_check_times_out(self, tmp_path, monkeypatch):
+        """Test that a hanging health check gives up after its deadline and one retry."""
+        release = threading.Event()
+        letta_cls = MagicMock()
+        letta_cls.return_value.health.check.side_effect = lambda: release.wait(timeout=2)
+        monkeypatch.setattr(weather_agent, "LETTA_AVAILABLE", True)
+        monkeypatch.setattr(weather_agent.settings, "letta_health_timeout", 0.05)
+        monkeypatch.setitem(sys.modules, "letta_client", SimpleNamespace(Letta=letta_cls))
+
+        manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        try:
+            assert await manager.ensure_connected() is False
+        finally:
+            release.set()
+        assert letta_cls.return_value.health.check.call_count == 2
+
+
+class TestAgentLookup:
+    """Tests for resolving a user's agent ID."""
+
+    @pytest.mark.asyncio
+    async def test_get_agent_id_uses_name_filter(self, tmp_path):
+        """Test that lookups ask Letta for a single agent by name."""
+        manager = make_letta_manager(tmp_path)
+        manager._client.agents.list.return_value = [SimpleNamespace(id="agent-42")]
+
+        assert await manager.get_agent_id("alice") == "agent-42"
+        manager._client.agents.list.assert_called_once_with(
+            name="weather_agent_alice", limit=1
+        )
+
+    @pytest.mark.asyncio
+    async def test_get_agent_id_cached_after_first_lookup(self, tmp_path):
+        """Test that a resolved agent ID is served from memory."""
+        manager = make_letta_manager(tmp_path)
+        manager._client.agents.list.return_value = [SimpleNamespace(id="agent-42")]
+
+        await manager.get_agent_id("alice")
+        await manager.get_agent_id("alice")
+        assert manager._client.agents.list.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_messages_do_not_relist_agents(self, tmp_path):
+        """Test that a conversation resolves the user's agent from Letta only once."""
+        manager = make_letta_manager(tmp_path)
+        manager._client.agents.list.return_value = [SimpleNamespace(id="agent-42")]
+        manager._client.agents.messages.stream.return_value = [
+            SimpleNamespace(assistant_message="Hi!")
+        ]
+
+        for _ in range(5):
+            await manager.send_message("paula", "Is it sunny?")
+
+        manager._client.agents.list.assert_called_once_with(
+            name="weather_agent_paula", limit=1
+        )
+        manager._client.agents.create.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_sdk_calls_run_off_event_loop(self, tmp_path):
+        """Test that every Letta call made while creating an agent runs in a worker thread."""
+        manager = make_letta_manager(tmp_path)
+        loop_thread = threading.get_ident()
+        call_threads = []
+
+        def record(result):
+            def call(*args, **kwargs):
+                call_threads.append(threading.get_ident())
+                return result
+            return call
+
+        manager._client.agents.list.side_effect = record([])
+        manager._client.agents.create.side_effect = record(SimpleNamespace(id="agent-new"))
+        manager._client.tools.create.side_effect = record(SimpleNamespace(id="tool-1"))
+        manager._client.agents.tools.create.side_effect = record(None)
+
+        await manager.create_agent("vera")
+        assert len(call_threads) == 1 + 1 + 7 + 7
+        assert loop_thread not in call_threads
+
+    @pytest.mark.asyncio
+    async def test_letta_call_latency_logged(self, tmp_path, caplog):
+        """Test that outbound Letta calls log their latency."""
+        manager = make_letta_manager(tmp_path)
+
+        with caplog.at_level("INFO", logger=weather_agent.logger.name):
+            await manager.create_agent("wes")
+
+        messages = [record.getMessage() for record in caplog.records]
+        for label in ("letta.agents.list", "letta.agents.create", "letta.tools.create"):
+            assert any(m.startswith(f"{label} latency_ms=") for m in messages)
+
+    @pytest.mark.asyncio
+    async def test_agent_cache_persisted(self, tmp_path):
+        """Test that created agents are written to and reloaded from disk."""
+        manager = make_letta_manager(tmp_path)
+        assert await manager.create_agent("bob") == "agent-new"
+
+        with open(tmp_path / "agents.json") as f:
+            assert json.load(f) == {"bob": "agent-new"}
+
+        reloaded = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        assert reloaded._load_agent_cache() == {"bob": "agent-new"}
+
+    @pytest.mark.asyncio
+    async def test_agent_cache_written_off_event_loop(self, tmp_path, monkeypatch):
+        """Test that persisting the agent cache does not block the event loop."""
+        manager = make_letta_manager(tmp_path)
+        loop_thread = threading.get_ident()
+        write_threads = []
+        write = WeatherAgentManager._write_agent_cache
+
+        def record_write(self, remote_agents):
+            write_threads.append(threading.get_ident())
+            write(self, remote_agents)
+
+        monkeypatch.setattr(WeatherAgentManager, "_write_agent_cache", record_write)
+        await manager.create_agent("dora")
+
+        assert write_threads and loop_thread not in write_threads
+
+    @pytest.mark.asyncio
+    async def test_connect_keeps_ids_resolved_meanwhile(self, tmp_path, monkeypatch):
+        """Test that the persisted map is merged on the loop without replacing newer IDs."""
+        (tmp_path / "agents.json").write_text(json.dumps({"eve": "agent-old", "fay": "agent-fay"}))
+        monkeypatch.setattr(weather_agent, "LETTA_AVAILABLE", True)
+        monkeypatch.setitem(sys.modules, "letta_client", SimpleNamespace(Letta=MagicMock()))
+        manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        manager._remember_agent("eve", "agent-eve")
+
+        assert await manager.ensure_connected()
+        assert dict(manager._agents) == {"eve": "agent-eve", "fay": "agent-fay"}
+
+    @pytest.mark.asyncio
+    async def test_delete_agent_removes_cache_entry(self, tmp_path):
+        """Test that deleting an agent drops it from the persisted cache."""
+        manager = make_letta_manager(tmp_path)
+        await manager.create_agent("carol")
+        await manager.delete_agent("carol")
+
+        manager._client.agents.delete.assert_called_once_with("agent-new")
+        with open(tmp_path / "agents.json") as f:
+            assert json.load(f) == {}
+
+    @pytest.mark.asyncio
+    async def test_agent_cache_evicts_least_recently_used(self, tmp_path, monkeypatch):
+        """Test that the agent ID cache is bounded and evicts idle users."""
+        monkeypatch.setattr(weather_agent, "MAX_CACHED_AGENTS", 2)
+        manager = make_letta_manager(tmp_path)
+        manager._remember_agent("u1", "agent-1")
+        manager._remember_agent("u2", "agent-2")
+        await manager.get_agent_id("u1")  # u1 is now most recently used
+        manager._remember_agent("u3", "agent-3")
+
+        assert list(manager._agents) == ["u1", "u3"]
+
+        # Evicted users are resolved again from Letta by name
+        manager._client.agents.list.return_value = [SimpleNamespace(id="agent-2")]
+        assert await manager.get_agent_id("u2") == "agent-2"
+
+    @pytest.mark.asyncio
+    async def test_standalone_mode_does_not_persist(self, tmp_path):
+        """Test that local fallback agents are never written to disk."""
+        manager = WeatherAgentManager(cache_path=str(tmp_path / "agents.json"))
+        manager._letta_available = False
+
+        assert await manager.create_agent("dave") == "local_agent_dave"
+        await manager.delete_agent("dave")
+        assert not (tmp_path / "agents.json").exists()
+
+
+class TestConcurrentResolution:
+    """Tests for resolving one user's agent from concurrent requests."""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_lookups_share_one_call(self, tmp_path):
+        """Test that simultaneous lookups for a user issue a single list call."""
+        manager = make_letta_manager(tmp_path)
+        manager._client.agents.list.return_value = [SimpleNamespace(id="agent-7")]
+
+        results = await asyncio.gather(*(manager.get_agent_id("nina") for _ in range(5)))
+        assert results == ["agent-7"] * 5
+        assert manager._client.agents.list.call_count == 1
+        assert len(manager._in_flight) == 0
+
+    @pytest.mark.asyncio
+    async def test_concurrent_creates_make_one_agent(self, tmp_path):
+        """Test that racing first messages don't create duplicate agents."""
+        manager = make_letta_manager(tmp_path)
+
+        results = await asyncio.gather(*(manager.create_agent("omar") for _ in range(5)))
+        assert results == ["agent-new"] * 5
+        assert manager._client.agents.create.call_count == 1
+
+
+class TestNegativeCache:
+    """Tests for backing off Letta RPCs after misses and failures."""
+
+    @pytest.mark.asyncio
+    async def test_repeated_misses_issue_one_lookup(self, tmp_path):
+        """Test that a missing agent is not looked up again within the window."""
+        manager = make_letta_manager(tmp_path)
+
+        assert await manager.get_agent_id("ghost") is None
+        assert await manager.get_agent_id("ghost") is None
+        assert manager._client.agents.list.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_create_skips_lookup_after_miss(self, tmp_path):
+        """Test that creating right after a missed lookup doesn't list agents again."""
+        manager = make_letta_manager(tmp_path)
+
+        await manager.get_agent_id("newbie")
+        assert await manager.create_agent("newbie") == "agent-new"
+        assert manager._client.agents.list.call_count == 1
+        assert "newbie" not in manager._lookup_backoff
+
+    @pytest.mark.asyncio
+    async def test_lookup_error_not_treated_as_miss(self, tmp_path):
+        """Test that a failed lookup doesn't back off, so creation still finds the existing agent."""
+        manager = make_letta_manager(tmp_path)
+        manager._client.agents.list.side_effect = [
+            httpx.ReadTimeout("timed out"),
+            [SimpleNamespace(id="agent-kim")],
+        ]
+
+        assert await manager.get_agent_id("kim") is None
+        assert "kim" not in manager._lookup_backoff
+        assert await manager.create_agent("kim") == "agent-kim"
+        manager._client.agents.create.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_failed_create_backs_off_exponentially(self, tmp_path, monkeypatch):
+        """Test that failed creations answer locally and retry after 5s, then 30s."""
+        now = [1000.0]
+        monkeypatch.setattr(weather_agent.time, "monotonic", lambda: now[0])
+        manager = make_letta_manager(tmp_path)
+        manager._client.agents.create.side_effect = RuntimeError("quota exceeded")
+
+        assert await manager.create_agent("mo") == "local_agent_mo"
+        assert await manager.create_agent("mo") == "local_agent_mo"
+        assert manager._client.agents.create.call_count == 1
+
+        now[0] += 5.0
+        await manager.create_agent("mo")
+        assert manager._client.agents.create.call_count == 2
+
+        now[0] += 5.0
+        await manager.create_agent("mo")
+        assert manager._client.agents.create.call_count == 2
+
+        now[0] += 25.0
+        manager._client.agents.create.side_effect = None
+        assert await manager.create_agent("mo") == "agent-new"
+        assert "mo" not in manager._create_backoff
+
+
+class TestToolRegistration:
+    """Tests for registering tools with a new agent."""
+
+    @pytest.mark.asyncio
+    async def test_tools_registered_concurrently(self, tmp_path):
+        """Test that tool registrations overlap instead of running one by one."""
+        manager = make_letta_manager(tmp_path)
+        lock = threading.Lock()
+        in_flight = {"current": 0, "peak": 0}
+        release = threading.Event()
+
+        def create_tool(**kwargs):
+            with lock:
+                in_flight["current"] += 1
+                in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+                if in_flight["peak"] >= 2:
+                    release.set()
+            release.wait(timeout=2)
+            with lock:
+                in_flight["current"] -= 1
+            return SimpleNamespace(id="tool-1")
+
+        manager._client.tools.create.side_effect = create_tool
+
+        await manager._register_tools("agent-1")
+        assert in_flight["peak"] >= 2
+        assert manager._client.agents.tools.create.call_count == 7
+
+    @pytest.mark.asyncio
+    async def test_tool_calls_bounded(self, tmp_path, monkeypatch):
+        """Test that no more than MAX_CONCURRENT_TOOL_CALLS tools register at once."""
+        monkeypatch.setattr(weather_agent, "MAX_CONCURRENT_TOOL_CALLS", 2)
+        manager = make_letta_manager(tmp_path)
+        lock = threading.Lock()
+        in_flight = {"current": 0, "peak": 0}
+
+        def create_tool(**kwargs):
+            with lock:
+                in_flight["current"] += 1
+                in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+            threading.Event().wait(0.01)
+            with lock:
+                in_flight["current"] -= 1
+            return SimpleNamespace(id="tool-1")
+
+        manager._client.tools.create.side_effect = create_tool
+
+        await manager._register_tools("agent-1")
+        assert in_flight["peak"] <= 2
+        assert manager._client.agents.tools.create.call_count == 7
+
+    @pytest.mark.asyncio
+    async def test_one_failing_tool_does_not_abort_others(self, tmp_path):
+        """Test that a failed registration is isolated to that tool."""
+        manager = make_letta_manager(tmp_path)
+        manager._client.tools.create.side_effect = [RuntimeError("boom")] + [
+            SimpleNamespace(id=f"tool-{i}") for i in range(6)
+        ]
+
+        await manager._register_tools("agent-1")
+        assert manager._client.agents.tools.create.call_count == 6
+
+    @pytest.mark.asyncio
+    async def test_tools_created_once_across_agents(self, tmp_path):
+        """Test that tools are created once and only attached for later agents."""
+        manager = make_letta_manager(tmp_path)
+
+        await manager._register_tools("agent-1")
+        await manager._register_tools("agent-2")
+
+        assert manager._client.tools.create.call_count == 7
+        assert manager._client.agents.tools.create.call_count == 14
+
+    @pytest.mark.asyncio
+    async def test_existing_server_tools_reused(self, tmp_path):
+        """Test that tools already on the server are attached without re-uploading."""
+        manager = make_letta_manager(tmp_path)
+        manager._client.tools.list.side_effect = lambda name, limit: (
+            [SimpleNamespace(name=name, id=f"existing-{name}")] if name == "get_current_weather" else []
+        )
+
+        await manager._register_tools("agent-1")
+
+        assert manager._client.tools.create.call_count == 6
+        assert manager._tool_ids["get_current_weather"] == "existing-get_current_weather"
+        manager._client.agents.tools.create.assert_any_call(
+            agent_id="agent-1", tool_id="existing-get_current_weather"
+        )
+
+
+class TestUserPreferences:
+    """Tests for writing preferences into the agent's memory."""
+
+    @pytest.mark.asyncio
+    async def test_preferences_merged_into_one_block_update(self, tmp_path):
+        """Test that successive updates are merged and written in one call each."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["hank"] = "agent-hank"
+        blocks = manager._client.agents.blocks
+
+        await manager.update_user_preferences("hank", {"temperature_unit": "celsius"})
+        await manager.update_user_preferences(
+            "hank", {"home_location": {"name": "Seattle", "latitude": 47.6}}
+        )
+
+        assert blocks.update.call_count == 2
+        block = blocks.update.call_args.kwargs["value"]
+        assert "- Preferred temperature unit: celsius" in block
+        assert "- Home location: Seattle" in block
+
+    @pytest.mark.asyncio
+    async def test_unchanged_preferences_skip_memory_write(self, tmp_path):
+        """Test that re-saving the same preferences does not call Letta."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["ivy"] = "agent-ivy"
+
+        await manager.update_user_preferences("ivy", {"temperature_unit": "celsius"})
+        await manager.update_user_preferences(
+            "ivy", {"temperature_unit": "celsius", "home_location": None}
+        )
+
+        assert manager._client.agents.blocks.update.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_stored_block_merged_after_restart(self, tmp_path):
+        """Test that a fresh manager keeps the preferences already in the agent's memory."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["jo"] = "agent-jo"
+        blocks = manager._client.agents.blocks
+        blocks.retrieve.return_value = SimpleNamespace(
+            value=weather_agent._render_human_block(
+                name="Jo", temperature_unit="celsius", home_location="Not yet set"
+            )
+        )
+
+        await manager.update_user_preferences("jo", {"home_location": "Boston"})
+        await manager.update_user_preferences("jo", {"name": "Joanna"})
+
+        assert blocks.retrieve.call_count == 1
+        block = blocks.update.call_args.kwargs["value"]
+        assert "- Name: Joanna" in block
+        assert "- Preferred temperature unit: celsius" in block
+        assert "- Home location: Boston" in block
+
+    @pytest.mark.asyncio
+    async def test_per_user_preferences_bounded(self, tmp_path, monkeypatch):
+        """Test that saved preferences and home locations are evicted least recently used first."""
+        monkeypatch.setattr(weather_agent, "MAX_CACHED_AGENTS", 2)
+        manager = make_letta_manager(tmp_path)
+        manager._client.agents.blocks.retrieve.return_value = SimpleNamespace(value="")
+        for user_id in ("a", "b", "c"):
+            manager._agents[user_id] = f"agent-{user_id}"
+            await manager.update_user_preferences(
+                user_id, {"home_location": {"name": "Denver", "latitude": 39.7}}
+            )
+
+        assert list(manager._preferences) == ["b", "c"]
+        assert list(manager._home_locations) == ["b", "c"]
+
+
+class TestSendMessage:
+    """Tests for sending messages through Letta."""
+
+    @pytest.mark.asyncio
+    async def test_letta_call_runs_off_event_loop(self, tmp_path):
+        """Test that the blocking Letta SDK stream is consumed in a worker thread."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["erin"] = "agent-erin"
+        loop_thread = threading.get_ident()
+        call_threads = []
+
+        def stream_messages(**kwargs):
+            call_threads.append(threading.get_ident())
+            return iter([SimpleNamespace(assistant_message="Sunny today.", tool_call=None)])
+
+        manager._client.agents.messages.stream.side_effect = stream_messages
+
+        result = await manager.send_message("erin", "How is the weather?")
+        assert result["response"] == "Sunny today."
+        assert result["agent_id"] == "agent-erin"
+        assert call_threads and call_threads[0] != loop_thread
+
+    @pytest.mark.asyncio
+    async def test_response_parsing(self, tmp_path):
+        """Test extraction of assistant text and tool calls from Letta messages."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["frank"] = "agent-frank"
+        tool_call = SimpleNamespace(name="get_current_weather", arguments='{"latitude": 1}')
+        manager._client.agents.messages.stream.return_value = [
+            SimpleNamespace(tool_call=tool_call),
+            SimpleNamespace(tool_return="72F"),
+            SimpleNamespace(assistant_message="It's 72F."),
+            SimpleNamespace(assistant_message=" Enjoy!"),
+        ]
+
+        result = await manager.send_message("frank", "Weather?")
+        assert result["response"] == "It's 72F. Enjoy!"
+        assert result["tool_calls"] == [
+            {"name": "get_current_weather", "arguments": '{"latitude": 1}'}
+        ]
+
+    @pytest.mark.asyncio
+    async def test_response_without_assistant_text(self, tmp_path):
+        """Test the default reply when Letta returns no assistant message."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["gina"] = "agent-gina"
+        manager._client.agents.messages.stream.return_value = []
+
+        result = await manager.send_message("gina", "Remember that I live in Ohio")
+        assert result["response"] == "I processed your request."
+        assert result["tool_calls"] == []
+
+    @pytest.mark.asyncio
+    async def test_stream_yields_chunks_as_they_arrive(self, tmp_path):
+        """Test that deltas and tool calls are streamed before the final event."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["kim"] = "agent-kim"
+        tool_call = SimpleNamespace(name="geocode_location", arguments='{"query": "Oslo"}')
+        manager._client.agents.messages.stream.return_value = [
+            SimpleNamespace(tool_call=tool_call),
+            SimpleNamespace(assistant_message="Cold"),
+            SimpleNamespace(assistant_message=" and snowy."),
+        ]
+
+        events = [e async for e in manager.send_message_stream("kim", "Oslo?")]
+        assert events[:3] == [
+            {"tool_call": {"name": "geocode_location", "arguments": '{"query": "Oslo"}'}},
+            {"delta": "Cold"},
+            {"delta": " and snowy."},
+        ]
+        assert events[-1]["done"] is True
+        assert events[-1]["response"] == "Cold and snowy."
+
+    @pytest.mark.asyncio
+    async def test_stalled_stream_not_resent(self, tmp_path, monkeypatch):
+        """Test that a stream producing nothing before the deadline isn't sent again."""
+        monkeypatch.setattr(weather_agent.settings, "letta_request_timeout", 0.05)
+        manager = make_letta_manager(tmp_path)
+        manager._agents["uma"] = "agent-uma"
+        release = threading.Event()
+
+        def stalled():
+            release.wait(timeout=2)
+            yield SimpleNamespace(assistant_message="too late")
+
+        manager._client.agents.messages.stream.side_effect = [
+            stalled(), [SimpleNamespace(assistant_message="Clear skies.")]
+        ]
+        try:
+            result = await manager.send_message("uma", "Weather?")
+        finally:
+            release.set()
+
+        # The first request may still be running on Letta, so answer locally
+        assert result["agent_id"] == "local_agent_uma"
+        assert manager._client.agents.messages.stream.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_stream_connect_failure_retried_once(self, tmp_path):
+        """Test that a stream that couldn't reach Letta is sent again."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["uma"] = "agent-uma"
+        manager._client.agents.messages.stream.side_effect = [
+            httpx.ConnectError("refused"), [SimpleNamespace(assistant_message="Clear skies.")]
+        ]
+
+        result = await manager.send_message("uma", "Weather?")
+
+        assert result["response"] == "Clear skies."
+        assert manager._client.agents.messages.stream.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_stream_failure_falls_back_to_local(self, tmp_path):
+        """Test that a stream failing before any output is answered locally."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["lee"] = "agent-lee"
+        manager._client.agents.messages.stream.side_effect = RuntimeError("down")
+
+        result = await manager.send_message("lee", "Is it windy?")
+        assert result["agent_id"] == "local_agent_lee"
+
+    @pytest.mark.asyncio
+    async def test_one_turn_at_a_time_per_user(self, tmp_path, monkeypatch):
+        """Test that a user's concurrent messages reach Letta one after another."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents.update({"ann": "agent-ann", "ben": "agent-ben"})
+        active = {"agent-ann": 0, "agent-ben": 0}
+        peak = {"agent-ann": 0, "agent-ben": 0, "total": 0}
+
+        async def stream(self, agent_id, message):
+            active[agent_id] += 1
+            peak[agent_id] = max(peak[agent_id], active[agent_id])
+            peak["total"] = max(peak["total"], sum(active.values()))
+            await asyncio.sleep(0.01)
+            active[agent_id] -= 1
+            yield SimpleNamespace(assistant_message=message)
+
+        monkeypatch.setattr(WeatherAgentManager, "_stream_letta_messages", stream)
+        results = await asyncio.gather(
+            manager.send_message("ann", "one"),
+            manager.send_message("ann", "two"),
+            manager.send_message("ben", "three"),
+        )
+
+        assert [r["response"] for r in results] == ["one", "two", "three"]
+        assert peak["agent-ann"] == 1
+        assert peak["total"] == 2
+        assert len(manager._user_locks) == 0
+
+
+class TestSendMessagesBatch:
+    """Tests for sending many messages at once."""
+
+    @pytest.mark.asyncio
+    async def test_users_concurrent_and_each_user_in_order(self, monkeypatch):
+        """Test that users are served in parallel while one user's messages stay ordered."""
+        manager = WeatherAgentManager()
+        in_flight = {"current": 0, "peak": 0}
+        sent = []
+
+        async def send_message(self, user_id, message):
+            in_flight["current"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+            await asyncio.sleep(0.01)
+            in_flight["current"] -= 1
+            sent.append((user_id, message))
+            return {"response": message.upper(), "agent_id": user_id}
+
+        monkeypatch.setattr(WeatherAgentManager, "send_message", send_message)
+        items = [("ada", "one"), ("bo", "two"), ("ada", "three"), ("cy", "four")]
+
+        results = await manager.send_messages_batch(items, max_concurrency=2)
+        assert [r["response"] for r in results] == ["ONE", "TWO", "THREE", "FOUR"]
+        assert in_flight["peak"] == 2
+        assert [m for u, m in sent if u == "ada"] == ["one", "three"]
+
+
+class TestLocalFallback:
+    """Tests for answering messages without a Letta server."""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("message,reply", [
+        ("What's the Temperature?", weather_agent._LOCAL_WEATHER_REPLY),
+        ("Any forecasts for tomorrow", weather_agent._LOCAL_FORECAST_REPLY),
+        ("Tell me a joke", weather_agent._LOCAL_DEFAULT_REPLY),
+        ("Is the weatherman right?", weather_agent._LOCAL_DEFAULT_REPLY),
+        ("FORECAST or current weather?", weather_agent._LOCAL_FORECAST_REPLY),
+        ("hello", weather_agent._GREETING_REPLY),
+        ("Thank you so much!", weather_agent._THANKS_REPLY),
+        ("help please", weather_agent._HELP_REPLY),
+        ("hi, what's the weather like", weather_agent._LOCAL_WEATHER_REPLY),
+    ])
+    async def test_keyword_routing(self, message, reply):
+        """Test that keywords are matched as words, ignoring case and punctuation."""
+        manager = WeatherAgentManager()
+        result = await manager._handle_message_locally("quinn", message)
+        assert result["response"] == reply
+        assert result["agent_id"] == "local_agent_quinn"
+
+    @pytest.mark.asyncio
+    async def test_repeated_questions_reuse_classification(self):
+        """Test that short repeated messages are classified once, long ones never cached."""
+        weather_agent._keyword_reply.cache_clear()
+        manager = WeatherAgentManager()
+
+        await manager._handle_message_locally("quinn", "What's the weather? ")
+        result = await manager._handle_message_locally("quinn", "what's the WEATHER?")
+        assert result["response"] == weather_agent._LOCAL_WEATHER_REPLY
+        assert weather_agent._keyword_reply.cache_info().hits == 1
+
+        long_message = "forecast " + "x" * weather_agent.MAX_CACHED_MESSAGE_LENGTH
+        result = await manager._handle_message_locally("quinn", long_message)
+        assert result["response"] == weather_agent._LOCAL_FORECAST_REPLY
+        assert weather_agent._keyword_reply.cache_info().currsize == 1
+
+    @pytest.mark.asyncio
+    async def test_standalone_send_skips_agent_resolution(self):
+        """Test that standalone mode answers without looking up or creating an agent."""
+        manager = WeatherAgentManager()
+        result = await manager.send_message("quinn", "Any forecast?")
+        assert result["response"] == weather_agent._LOCAL_FORECAST_REPLY
+        assert result["agent_id"] == "local_agent_quinn"
+        assert "quinn" not in manager._agents
+
+    @pytest.mark.asyncio
+    async def test_local_agent_ids_are_typed(self):
+        """Test that local IDs are recognised by type and still serialize as plain strings."""
+        manager = WeatherAgentManager()
+        agent_id = await manager.create_agent("quinn")
+        assert isinstance(agent_id, weather_agent._LocalAgentId)
+        assert agent_id == "local_agent_quinn"
+        assert json.dumps({"agent_id": agent_id}) == '{"agent_id": "local_agent_quinn"}'
+
+    @pytest.mark.parametrize("message,place", [
+        ("What's the weather in Paris?", "Paris"),
+        ("temperature for New York, NY!!", "New York, NY"),
+        ("Weather at  Lake Tahoe", "Lake Tahoe"),
+    ])
+    def test_location_extraction(self, message, place):
+        """Test that the place name is pulled out of a weather question."""
+        assert weather_agent._LOCATION_RE.search(message).group(1) == place
+
+    @pytest.mark.parametrize("message,places", [
+        ("What's the weather for tomorrow?", []),
+        ("weather at the moment?", []),
+        ("Weather in Paris tomorrow", ["Paris"]),
+        ("weather in Lake Tahoe this weekend!", ["Lake Tahoe"]),
+        ("Weather for Oslo right now", ["Oslo"]),
+    ])
+    def test_time_phrases_not_taken_as_places(self, message, places):
+        """Test that time words after "weather for/at/in" aren't geocoded."""
+        assert weather_agent._location_queries(message) == places
+
+    @pytest.mark.asyncio
+    async def test_unknown_place_falls_back_to_keyword_reply(self, monkeypatch):
+        """Test that a message whose "place" geocodes to nothing gets the keyword reply."""
+        monkeypatch.setattr(weather_agent.geocoding, "geocode_location", AsyncMock(return_value=[]))
+
+        result = await WeatherAgentManager()._handle_message_locally("zed", "weather for my trip")
+        assert result["response"] == weather_agent._LOCAL_WEATHER_REPLY
+
+    @pytest.mark.asyncio
+    async def test_weather_in_location_answered_locally(self, monkeypatch):
+        """Test that "weather in X" geocodes X and reports current conditions."""
+        geocode = AsyncMock(return_value=[{"name": "Paris", "latitude": 48.85, "longitude": 2.35}])
+        current = AsyncMock(return_value={
+            "temperature": 61.2, "feels_like": 59.0, "weather_description": "Partly cloudy"
+        })
+        monkeypatch.setattr(weather_agent.geocoding, "geocode_location", geocode)
+        monkeypatch.setattr(weather_agent.weather, "get_current_weather", current)
+
+        result = await WeatherAgentManager()._handle_message_locally("rosa", "weather in Paris?")
+        assert result["response"] == (
+            "Right now in Paris it's 61.2°F and partly cloudy (feels like 59.0°F)."
+        )
+        assert [call["name"] for call in result["tool_calls"]] == [
+            "geocode_location", "get_current_weather"
+        ]
+        geocode.assert_awaited_once_with("Paris", limit=1)
+        current.assert_awaited_once_with(48.85, 2.35)
+
+    @pytest.mark.asyncio
+    async def test_several_places_looked_up_concurrently(self, monkeypatch):
+        """Test that each named place is geocoded and fetched in parallel."""
+        coords = {"Paris": (48.85, 2.35), "Oslo": (59.91, 10.75)}
+        in_flight = {"current": 0, "peak": 0}
+
+        async def geocode(query, limit=5):
+            in_flight["current"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+            await asyncio.sleep(0.01)
+            in_flight["current"] -= 1
+            if query not in coords:
+                return []
+            lat, lon = coords[query]
+            return [{"name": query, "latitude": lat, "longitude": lon}]
+
+        async def current(latitude, longitude):
+            return {"temperature": latitude, "feels_like": longitude,
+                    "weather_description": "Clear sky"}
+
+        monkeypatch.setattr(weather_agent.geocoding, "geocode_location", geocode)
+        monkeypatch.setattr(weather_agent.weather, "get_current_weather", current)
+
+        result = await WeatherAgentManager()._handle_message_locally(
+            "xan", "Weather in Paris? And the weather in Atlantis? Weather in Oslo."
+        )
+        assert in_flight["peak"] == 3
+        assert result["response"] == (
+            "Right now in Paris it's 48.85°F and clear sky (feels like 2.35°F). "
+            "I couldn't find a location called \"Atlantis\". "
+            "Right now in Oslo it's 59.91°F and clear sky (feels like 10.75°F)."
+        )
+        assert [call["name"] for call in result["tool_calls"]].count("get_current_weather") == 2
+
+    @pytest.mark.asyncio
+    async def test_geocoding_results_cached(self, monkeypatch):
+        """Test that repeated questions about a place geocode it only once."""
+        geocode = AsyncMock(return_value=[{"name": "Lima", "latitude": -12.05, "longitude": -77.04}])
+        current = AsyncMock(return_value={
+            "temperature": 70.0, "feels_like": 70.0, "weather_description": "Overcast"
+        })
+        monkeypatch.setattr(weather_agent.geocoding, "geocode_location", geocode)
+        monkeypatch.setattr(weather_agent.weather, "get_current_weather", current)
+        manager = WeatherAgentManager()
+
+        await manager._handle_message_locally("yara", "weather in Lima")
+        await manager._handle_message_locally("zed", "Weather in LIMA?")
+        geocode.assert_awaited_once_with("Lima", limit=1)
+
+    @pytest.mark.asyncio
+    async def test_current_weather_shared_across_requests(self, monkeypatch):
+        """Test that concurrent and repeated questions fetch conditions once."""
+        geocode = AsyncMock(return_value=[{"name": "Rome", "latitude": 41.9028, "longitude": 12.4964}])
+        fetches = []
+
+        async def current(latitude, longitude):
+            fetches.append((latitude, longitude))
+            await asyncio.sleep(0.01)
+            return {"temperature": 75.0, "feels_like": 77.0, "weather_description": "Clear sky"}
+
+        monkeypatch.setattr(weather_agent.geocoding, "geocode_location", geocode)
+        monkeypatch.setattr(weather_agent.weather, "get_current_weather", current)
+        manager = WeatherAgentManager()
+
+        replies = await asyncio.gather(*(
+            manager._handle_message_locally(f"user{i}", "weather in Rome") for i in range(4)
+        ))
+        await manager._handle_message_locally("late", "weather in Rome")
+
+        assert fetches == [(41.9028, 12.4964)]
+        assert len({reply["response"] for reply in replies}) == 1
+
+    @pytest.mark.asyncio
+    async def test_warm_user_context_prefetches_home_weather(self, monkeypatch):
+        """Test that warming the session makes the first home-weather question a cache hit."""
+        geocode = AsyncMock(return_value=[{"name": "Seattle", "latitude": 47.6, "longitude": -122.3}])
+        current = AsyncMock(return_value={
+            "temperature": 55.0, "feels_like": 53.0, "weather_description": "Light drizzle"
+        })
+        availability = AsyncMock(return_value=False)
+        monkeypatch.setattr(weather_agent.geocoding, "geocode_location", geocode)
+        monkeypatch.setattr(weather_agent.weather, "get_current_weather", current)
+        monkeypatch.setattr(weather_agent.calendar, "check_calendar_availability", availability)
+        manager = WeatherAgentManager()
+        manager._letta_available = False
+
+        await manager.update_user_preferences(
+            "cy", {"home_location": {"name": "Seattle", "latitude": 47.61, "longitude": -122.33}}
+        )
+        await manager.warm_user_context("cy")
+        result = await manager._handle_message_locally("cy", "weather in Seattle")
+
+        availability.assert_awaited_once_with("cy")
+        geocode.assert_awaited_once()
+        current.assert_awaited_once()
+        assert "Seattle" in result["response"]
+
+    @pytest.mark.asyncio
+    async def test_failed_lookup_falls_back_to_keywords(self, monkeypatch):
+        """Test that a failing weather lookup still gets the canned reply."""
+        monkeypatch.setattr(
+            weather_agent.geocoding, "geocode_location", AsyncMock(side_effect=OSError("offline"))
+        )
+
+        result = await WeatherAgentManager()._handle_message_locally("sam", "weather in Oslo")
+        assert result["response"] == weather_agent._LOCAL_WEATHER_REPLY
+
+
+    @pytest.mark.asyncio
+    async def test_rapid_messages_coalesced(self, tmp_path, monkeypatch):
+        """Test that messages within the coalesce window share one agent call."""
+        monkeypatch.setattr(weather_agent.settings, "chat_coalesce_window", 0.05)
+        manager = make_letta_manager(tmp_path)
+        manager._agents["bea"] = "agent-bea"
+        manager._client.agents.messages.stream.return_value = [
+            SimpleNamespace(assistant_message="Rainy in Leeds, bring a coat.")
+        ]
+
+        first, second = await asyncio.gather(
+            manager.send_message("bea", "Weather in Leeds?"),
+            manager.send_message("bea", "Do I need a coat?"),
+        )
+
+        assert first == second
+        manager._client.agents.messages.stream.assert_called_once()
+        assert manager._client.agents.messages.stream.call_args.kwargs["input"] == (
+            "Weather in Leeds?\nDo I need a coat?"
+        )
+        assert manager._pending_messages == {}
+
+    @pytest.mark.asyncio
+    async def test_greeting_skips_letta_call(self, tmp_path):
+        """Test that small talk is answered without an LLM round-trip."""
+        manager = make_letta_manager(tmp_path)
+        manager._agents["abe"] = "agent-abe"
+
+        result = await manager.send_message("abe", "Hi there!")
+        assert result == {
+            "response": weather_agent._GREETING_REPLY,
+            "tool_calls": [],
+            "agent_id": "agent-abe",
+        }
+        manager._client.agents.messages.stream.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_greeting_from_new_user_creates_no_agent(self, tmp_path):
+        """Test that a new user's first greeting neither looks up nor creates an agent."""
+        manager = make_letta_manager(tmp_path)
+
+        result = await manager.send_message("bea", "hi")
+        assert result["response"] == weather_agent._GREETING_REPLY
+        manager._client.agents.list.assert_not_called()
+        manager._client.agents.create.assert_not_called()
+        manager._client.agents.tools.create.assert_not_called()
+
+
+class TestAgentManagerSingleton:
+    """Tests for the global agent manager."""
+
+    def test_manager_has_no_instance_dict(self):
+        """Test that the manager stores its state in slots."""
+        manager = WeatherAgentManager()
+        assert not hasattr(manager, "__dict__")
+        with pytest.raises(AttributeError):
+            manager.unexpected = True
+
+    def test_concurrent_first_calls_share_one_instance(self, monkeypatch):
+        """Test that racing first calls construct a single manager."""
+        monkeypatch.setattr(weather_agent, "agent_manager", None)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            managers = list(pool.map(lambda _: get_agent_manager(), range(16)))
+
+        assert all(manager is managers[0] for manager in managers)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
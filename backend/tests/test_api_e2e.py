@@ -1,13 +1,20 @@
 """End-to-end tests for the Weather Intelligence Agent API."""
+import asyncio
+import json
 import pytest
 import httpx
 from fastapi.testclient import TestClient
-from datetime import datetime
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock
 
+from app.api import routes
+from app import main
 from app.main import app
 
 
 client = TestClient(app)
+# Returns the 500 response for unhandled errors instead of re-raising them
+error_client = TestClient(app, raise_server_exceptions=False)
 
 
 def network_available():
@@ -40,6 +47,281 @@ class TestHealthEndpoint:
         assert data["services"]["weather_api"] == "available"
         assert data["services"]["geocoding"] == "available"
 
+    def test_calendar_status_cached_between_probes(self, monkeypatch):
+        """Test that repeated health probes reuse the calendar availability check."""
+        check = AsyncMock(return_value=False)
+        monkeypatch.setattr(routes.calendar, "check_calendar_availability", check)
+
+        for _ in range(3):
+            assert client.get("/api/v1/health").json()["services"]["calendar"] is False
+        check.assert_awaited_once()
+
+    def test_health_report_reused_briefly(self):
+        """Test that probes within a few seconds get the same report, marked cacheable."""
+        first = client.get("/api/v1/health")
+        second = client.get("/api/v1/health")
+        assert first.headers["cache-control"] == "public, max-age=5"
+        assert second.json()["timestamp"] == first.json()["timestamp"]
+
+
+class TestCalendarEndpoints:
+    """Tests for calendar endpoints."""
+
+    def test_availability_shared_with_health(self, monkeypatch):
+        """Test that calendar requests reuse the cached availability check."""
+        check = AsyncMock(return_value=False)
+        monkeypatch.setattr(routes.calendar, "check_calendar_availability", check)
+
+        assert client.get("/api/v1/health").status_code == 200
+        assert client.get("/api/v1/calendar/events").status_code == 503
+        assert client.get("/api/v1/calendar/events").status_code == 503
+        check.assert_awaited_once()
+
+    def test_event_window_uses_one_timestamp(self, monkeypatch):
+        """Test that the requested window spans exactly days_ahead days."""
+        monkeypatch.setattr(routes.calendar, "check_calendar_availability", AsyncMock(return_value=True))
+        get_events = AsyncMock(return_value=[])
+        monkeypatch.setattr(routes.calendar, "get_calendar_events", get_events)
+
+        assert client.get("/api/v1/calendar/events", params={"days_ahead": 3}).json() == {"events": []}
+        kwargs = get_events.await_args.kwargs
+        assert kwargs["end_date"] - kwargs["start_date"] == timedelta(days=3)
+
+
+class TestPreferencesEndpoint:
+    """Tests for updating user preferences."""
+
+    def test_only_agent_memory_fields_passed(self, monkeypatch):
+        """Test that the route hands the agent just the preferences it stores."""
+        update = AsyncMock()
+        monkeypatch.setattr(routes.WeatherAgentManager, "update_user_preferences", update)
+        body = {
+            "temperature_unit": "celsius",
+            "home_location": {"name": "Lyon"},
+            "favorite_locations": [{"name": "Nice"}],
+        }
+
+        response = client.put("/api/v1/agent/pref_user/preferences", json=body)
+        assert response.json() == {"status": "updated", "user_id": "pref_user"}
+        update.assert_awaited_once_with(
+            "pref_user", {"temperature_unit": "celsius", "home_location": {"name": "Lyon"}}
+        )
+
+
+class TestLifespan:
+    """Tests for application startup and shutdown."""
+
+    def test_services_created_at_startup(self, monkeypatch):
+        """Test that startup creates the service singletons before any request."""
+        from app.services import notifications, weather_alerts
+
+        monkeypatch.setattr(notifications, "_notification_service", None)
+        monkeypatch.setattr(weather_alerts, "_weather_alert_service", None)
+        with TestClient(app):
+            assert notifications._notification_service is not None
+            assert weather_alerts._weather_alert_service is not None
+
+
+class TestChatEndpoints:
+    """Tests for chat endpoints (standalone mode, no Letta server)."""
+
+    def test_chat(self):
+        """Test that a chat reply is returned in the ChatResponse shape."""
+        response = client.post(
+            "/api/v1/chat", json={"user_id": "chat_user", "message": "Any forecast?"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert set(data) == {"response", "tool_calls", "agent_id"}
+        assert data["response"].startswith("For weather forecasts")
+        assert data["agent_id"] == "local_agent_chat_user"
+
+    def test_chat_stream(self):
+        """Test that the stream endpoint emits SSE events ending with the full reply."""
+        response = client.post(
+            "/api/v1/chat/stream",
+            json={"user_id": "stream_user", "message": "Hello"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+
+        events = [
+            json.loads(line[len("data: "):])
+            for line in response.text.splitlines()
+            if line.startswith("data: ")
+        ]
+        assert events[0]["delta"]
+        assert events[-1]["done"] is True
+        assert events[-1]["response"] == events[0]["delta"]
+
+    def test_chat_batch(self):
+        """Test that a batch returns one reply per message, in request order."""
+        response = client.post(
+            "/api/v1/chat/batch",
+            json={"messages": [
+                {"user_id": "batch_a", "message": "Any forecast?"},
+                {"user_id": "batch_b", "message": "Tell me a joke"},
+            ]}
+        )
+        assert response.status_code == 200
+        replies = response.json()["responses"]
+        assert [reply["agent_id"] for reply in replies] == ["local_agent_batch_a", "local_agent_batch_b"]
+
+    def test_chat_batch_over_rate_limit_rejected(self):
+        """Test that each batch message counts, so a batch bigger than the chat limit is refused."""
+        messages = [{"user_id": "big_batch", "message": "hi"}] * (routes._chat_limiter.rate + 1)
+        response = client.post("/api/v1/chat/batch", json={"messages": messages})
+        assert response.status_code == 429
+
+    def test_chat_batch_rejects_empty(self):
+        """Test that an empty batch is rejected by validation."""
+        response = client.post("/api/v1/chat/batch", json={"messages": []})
+        assert response.status_code == 422
+
+
+class TestResponseCaching:
+    """Tests for reusing upstream responses across requests."""
+
+    def test_nearby_coordinates_share_current_weather(self, monkeypatch):
+        """Test that requests within ~1 km are served from one upstream call."""
+        fetch = AsyncMock(return_value={"temperature": 70.0})
+        monkeypatch.setattr(routes.weather, "get_current_weather", fetch)
+
+        for latitude in (40.7128, 40.7131):
+            response = client.post(
+                "/api/v1/weather/current", json={"latitude": latitude, "longitude": -74.006}
+            )
+            assert response.json() == {"temperature": 70.0}
+
+        fetch.assert_awaited_once_with(latitude=40.71, longitude=-74.01, temperature_unit="fahrenheit")
+
+    def test_cache_key_includes_parameters(self, monkeypatch):
+        """Test that different forecast lengths and units are cached separately."""
+        fetch = AsyncMock(return_value={"forecasts": []})
+        monkeypatch.setattr(routes.weather, "get_weather_forecast", fetch)
+        body = {"latitude": 51.5, "longitude": -0.12}
+
+        client.post("/api/v1/weather/forecast", json=body, params={"days": 3})
+        client.post("/api/v1/weather/forecast", json=body, params={"days": 5})
+        client.post("/api/v1/weather/forecast", json=body, params={"days": 5, "temperature_unit": "celsius"})
+        client.post("/api/v1/weather/forecast", json=body, params={"days": 5})
+        assert fetch.await_count == 3
+
+    def test_cache_control_headers(self, monkeypatch):
+        """Test that read endpoints tell HTTP caches how long responses stay fresh."""
+        monkeypatch.setattr(routes.weather, "get_hourly_forecast", AsyncMock(return_value={}))
+        monkeypatch.setattr(routes.geocoding, "reverse_geocode", AsyncMock(return_value={}))
+        body = {"latitude": 51.5, "longitude": -0.12}
+
+        hourly = client.post("/api/v1/weather/hourly", json=body)
+        assert hourly.headers["cache-control"] == "public, max-age=1800, stale-while-revalidate=3600"
+        reverse = client.post("/api/v1/reverse-geocode", json=body)
+        assert reverse.headers["cache-control"] == "public, max-age=86400, stale-while-revalidate=604800"
+
+    def test_large_responses_compressed(self, monkeypatch):
+        """Test that large forecasts are gzipped for clients that accept it."""
+        hours = [{"time": f"2024-01-15T{h % 24:02d}:00", "temperature": 70.0} for h in range(168)]
+        monkeypatch.setattr(
+            routes.weather, "get_hourly_forecast", AsyncMock(return_value={"forecasts": hours})
+        )
+        body = {"latitude": 51.5, "longitude": -0.12}
+
+        response = client.post("/api/v1/weather/hourly", json=body, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json()["forecasts"] == hours
+
+        small = client.get("/api/v1/health", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in small.headers
+
+    def test_errors_not_marked_cacheable(self, monkeypatch):
+        """Test that failed upstream calls don't carry Cache-Control."""
+        monkeypatch.setattr(
+            routes.weather, "get_current_weather", AsyncMock(side_effect=RuntimeError("down"))
+        )
+        response = error_client.post("/api/v1/weather/current", json={"latitude": 1.0, "longitude": 2.0})
+        assert response.status_code == 500
+        assert response.json() == {"detail": "Internal error: down"}
+        assert "cache-control" not in response.headers
+
+    def test_errors_carry_cors_headers(self, monkeypatch):
+        """Test that a 500 from an allowed origin is readable by the web client."""
+        monkeypatch.setattr(
+            routes.weather, "get_current_weather", AsyncMock(side_effect=RuntimeError("down"))
+        )
+        origin = main.cors_origins[0] if main.cors_origins[0] != "*" else "http://localhost:3000"
+        response = error_client.post(
+            "/api/v1/weather/current",
+            json={"latitude": 1.0, "longitude": 2.0},
+            headers={"Origin": origin},
+        )
+        assert response.status_code == 500
+        assert response.headers["access-control-allow-origin"] in (origin, "*")
+
+    def test_geocode_many_places_concurrently(self, monkeypatch):
+        """Test that a batch geocode looks places up in parallel and reports failures per place."""
+        in_flight = {"current": 0, "peak": 0}
+
+        async def geocode_location(query, limit):
+            in_flight["current"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["current"])
+            await asyncio.sleep(0.01)
+            in_flight["current"] -= 1
+            if query == "Atlantis":
+                raise RuntimeError("upstream error")
+            return [{"name": query}]
+
+        monkeypatch.setattr(routes.geocoding, "geocode_location", geocode_location)
+        response = client.post(
+            "/api/v1/geocode", json={"queries": ["Paris", "Tokyo", "Atlantis"], "limit": 1}
+        )
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["results"] == {"Paris": [{"name": "Paris"}], "Tokyo": [{"name": "Tokyo"}]}
+        assert "Atlantis" in data["errors"]
+        assert "cache-control" not in response.headers
+        assert in_flight["peak"] == 3
+
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_share_one_fetch(self):
+        """Test that simultaneous requests for an uncached key make one upstream call."""
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"temperature": 70.0}
+
+        results = await asyncio.gather(*(
+            routes._cached(routes._current_weather_cache, ("current", 1.0, 2.0, "fahrenheit"), fetch)
+            for _ in range(10)
+        ))
+        assert results == [{"temperature": 70.0}] * 10
+        assert len(calls) == 1
+        assert len(routes._upstream_flights) == 0
+
+    def test_geocode_search_case_insensitive(self, monkeypatch):
+        """Test that searches differing only in case or spacing reuse one lookup."""
+        fetch = AsyncMock(return_value=[{"name": "Paris"}])
+        monkeypatch.setattr(routes.geocoding, "geocode_location", fetch)
+
+        for query in ("Paris", " paris "):
+            response = client.post("/api/v1/geocode", json={"query": query})
+            assert response.json() == {"locations": [{"name": "Paris"}]}
+        fetch.assert_awaited_once()
+
+    def test_geocode_requires_a_place(self, monkeypatch):
+        """Test that a request with no query or an empty queries list is rejected."""
+        fetch = AsyncMock(return_value=[])
+        monkeypatch.setattr(routes.geocoding, "geocode_location", fetch)
+
+        for body in ({}, {"queries": []}, {"queries": ["Paris", ""]}):
+            assert client.post("/api/v1/geocode", json=body).status_code == 422
+        fetch.assert_not_awaited()
+
+        # An explicit empty query is still accepted, as before batching
+        assert client.post("/api/v1/geocode", json={"query": ""}).json() == {"locations": []}
+
 
 @network_required
 class TestWeatherEndpoints:
@@ -116,7 +398,7 @@ class TestWeatherEndpoints:
 
     def test_weather_invalid_coordinates(self):
         """Test weather endpoint with invalid coordinates."""
-        response = client.post(
+        response = error_client.post(
             "/api/v1/weather/current",
             json={"latitude": 999, "longitude": 999}  # Invalid
         )
@@ -291,15 +573,56 @@ class TestAlertEndpoints:
             }
         )
 
-        # Check alerts
+        # Check alerts (runs after the 202 response; TestClient waits for it)
         response = client.post("/api/v1/alerts/check/check_alert_user")
+        assert response.status_code == 202
+        response = client.get(f"/api/v1/alerts/result/{response.json()['task_id']}")
         assert response.status_code == 200
         data = response.json()
+        assert data["status"] == "done"
         assert "alerts" in data
         assert "count" in data
         assert isinstance(data["alerts"], list)
 
 
+class TestAlertChecks:
+    """Tests for queued alert checks (no network)."""
+
+    def test_check_queued_then_polled(self, monkeypatch):
+        """Test that a check answers 202 at once and its alerts are available by task ID."""
+        alerts = [{"type": "rain", "message": "Rain expected"}]
+        monkeypatch.setattr(
+            routes.get_weather_alert_service(), "check_weather_for_user", AsyncMock(return_value=alerts)
+        )
+
+        response = client.post("/api/v1/alerts/check/queued_user")
+        assert response.status_code == 202
+        queued = response.json()
+        assert queued["status"] == "queued"
+
+        result = client.get(f"/api/v1/alerts/result/{queued['task_id']}").json()
+        assert result == {
+            "task_id": queued["task_id"], "user_id": "queued_user",
+            "status": "done", "alerts": alerts, "count": 1,
+        }
+
+    def test_failed_check_reported(self, monkeypatch):
+        """Test that an error during the check is recorded instead of lost."""
+        monkeypatch.setattr(
+            routes.get_weather_alert_service(), "check_weather_for_user",
+            AsyncMock(side_effect=RuntimeError("upstream down"))
+        )
+        task_id = client.post("/api/v1/alerts/check/failing_user").json()["task_id"]
+
+        result = client.get(f"/api/v1/alerts/result/{task_id}").json()
+        assert result["status"] == "failed"
+        assert result["error"] == "upstream down"
+
+    def test_unknown_task_not_found(self):
+        """Test that polling an unknown task ID returns 404."""
+        assert client.get("/api/v1/alerts/result/missing").status_code == 404
+
+
 @network_required
 class TestIntegrationScenarios:
     """Integration tests for real-world scenarios."""
@@ -426,8 +749,9 @@ class TestIntegrationScenarios:
 
         # 4. Check for alerts
         check_response = client.post(f"/api/v1/alerts/check/{user_id}")
-        assert check_response.status_code == 200
-        assert "alerts" in check_response.json()
+        assert check_response.status_code == 202
+        result_response = client.get(f"/api/v1/alerts/result/{check_response.json()['task_id']}")
+        assert "alerts" in result_response.json()
 
         # 5. Cleanup
         client.delete(f"/api/v1/alerts/unsubscribe/{user_id}")
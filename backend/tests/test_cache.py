@@ -0,0 +1,74 @@
+"""Tests for the in-process caching helpers."""
+import asyncio
+import pytest
+
+from app import cache
+from app.cache import SingleFlight, TTLCache
+
+
+class TestTTLCache:
+    """Tests for the TTL cache."""
+
+    def test_entries_expire(self, monkeypatch):
+        """Test that an entry is served until its TTL elapses."""
+        now = [100.0]
+        monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+        ttl_cache = TTLCache(maxsize=10, ttl=60)
+        ttl_cache.set("paris", [48.85, 2.35])
+
+        now[0] += 59
+        assert ttl_cache.get("paris") == [48.85, 2.35]
+        now[0] += 1
+        assert ttl_cache.get("paris") is None
+        assert len(ttl_cache) == 0
+
+    def test_oldest_entries_evicted(self):
+        """Test that the cache never grows beyond maxsize."""
+        ttl_cache = TTLCache(maxsize=2, ttl=60)
+        ttl_cache.set("a", 1)
+        ttl_cache.set("b", 2)
+        ttl_cache.set("c", 3)
+
+        assert ttl_cache.get("a") is None
+        assert ttl_cache.get("b") == 2
+        assert ttl_cache.get("c") == 3
+
+
+class TestSingleFlight:
+    """Tests for collapsing concurrent calls."""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_calls_share_result(self):
+        """Test that callers with the same key share one call."""
+        flights = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"temperature": 72}
+
+        results = await asyncio.gather(*(flights.do("nyc", fetch) for _ in range(3)))
+        assert results == [{"temperature": 72}] * 3
+        assert len(calls) == 1
+        assert len(flights) == 0
+
+    @pytest.mark.asyncio
+    async def test_cancelled_caller_does_not_cancel_others(self):
+        """Test that cancelling one waiter leaves the shared call running."""
+        flights = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.02)
+            return "done"
+
+        first = asyncio.ensure_future(flights.do("key", fetch))
+        second = asyncio.ensure_future(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        assert await second == "done"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,31 @@
+"""Tests for the shared HTTP client."""
+import asyncio
+import pytest
+
+from app import http_client
+
+
+class TestSharedHttpClient:
+    """Tests for reusing one pooled client across calls."""
+
+    @pytest.mark.asyncio
+    async def test_client_reused_until_closed(self):
+        """Test that calls share one client and a fresh one follows shutdown."""
+        first = http_client.get_http_client()
+        assert http_client.get_http_client() is first
+        assert first.timeout == http_client.HTTP_TIMEOUT
+
+        await http_client.close_http_client()
+        assert first.is_closed
+        second = http_client.get_http_client()
+        assert second is not first
+        await http_client.close_http_client()
+
+    def test_new_client_per_event_loop(self):
+        """Test that a client is never reused from a different event loop."""
+        async def get_client():
+            return http_client.get_http_client()
+
+        first = asyncio.run(get_client())
+        second = asyncio.run(get_client())
+        assert second is not first
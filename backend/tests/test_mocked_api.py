@@ -40,8 +40,8 @@ class TestWeatherToolsMocked:
         }
         mock_response.raise_for_status = MagicMock()
 
-        with patch("httpx.AsyncClient") as mock_client:
-            mock_client.return_value.__aenter__.return_value.get = AsyncMock(
+        with patch("app.tools.weather.get_http_client") as mock_client:
+            mock_client.return_value.get = AsyncMock(
                 return_value=mock_response
             )
 
@@ -80,8 +80,8 @@ class TestWeatherToolsMocked:
         }
         mock_response.raise_for_status = MagicMock()
 
-        with patch("httpx.AsyncClient") as mock_client:
-            mock_client.return_value.__aenter__.return_value.get = AsyncMock(
+        with patch("app.tools.weather.get_http_client") as mock_client:
+            mock_client.return_value.get = AsyncMock(
                 return_value=mock_response
             )
 
@@ -117,8 +117,8 @@ class TestWeatherToolsMocked:
         }
         mock_response.raise_for_status = MagicMock()
 
-        with patch("httpx.AsyncClient") as mock_client:
-            mock_client.return_value.__aenter__.return_value.get = AsyncMock(
+        with patch("app.tools.weather.get_http_client") as mock_client:
+            mock_client.return_value.get = AsyncMock(
                 return_value=mock_response
             )
 
@@ -127,6 +127,31 @@ class TestWeatherToolsMocked:
             assert len(result["forecasts"]) == 3
             assert result["forecasts"][1]["temperature"] == 70.0
 
+    @pytest.mark.asyncio
+    async def test_hourly_forecast_short_columns_padded(self):
+        """Test that variables missing or shorter than the time axis read as None."""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "hourly": {
+                "time": ["2024-01-15T10:00", "2024-01-15T11:00"],
+                "temperature_2m": [68.0],
+                "weather_code": [95, 1],
+                "is_day": [0, 1],
+            },
+        }
+        mock_response.raise_for_status = MagicMock()
+
+        with patch("app.tools.weather.get_http_client") as mock_client:
+            mock_client.return_value.get = AsyncMock(return_value=mock_response)
+
+            result = await get_hourly_forecast(40.7128, -74.0060, hours=2)
+
+        first, second = result["forecasts"]
+        assert first["temperature"] == 68.0 and second["temperature"] is None
+        assert second["humidity"] is None
+        assert first["weather_description"] == "Thunderstorm"
+        assert (first["is_day"], second["is_day"]) == (False, True)
+
 
 class TestGeocodingToolsMocked:
     """Mocked tests for geocoding tools."""
@@ -154,8 +179,8 @@ class TestGeocodingToolsMocked:
         ]
         mock_response.raise_for_status = MagicMock()
 
-        with patch("httpx.AsyncClient") as mock_client:
-            mock_client.return_value.__aenter__.return_value.get = AsyncMock(
+        with patch("app.tools.geocoding.get_http_client") as mock_client:
+            mock_client.return_value.get = AsyncMock(
                 return_value=mock_response
             )
 
@@ -190,8 +215,8 @@ class TestGeocodingToolsMocked:
         }
         mock_response.raise_for_status = MagicMock()
 
-        with patch("httpx.AsyncClient") as mock_client:
-            mock_client.return_value.__aenter__.return_value.get = AsyncMock(
+        with patch("app.tools.geocoding.get_http_client") as mock_client:
+            mock_client.return_value.get = AsyncMock(
                 return_value=mock_response
             )
 
@@ -279,7 +304,7 @@ class TestWeatherAlertServiceMocked:
             with patch("app.services.weather_alerts.weather.get_hourly_forecast",
                        new_callable=AsyncMock, return_value=mock_forecast):
                 with patch("app.services.weather_alerts.get_notification_service") as mock_notif:
-                    mock_notif.return_value.send_weather_alert = AsyncMock(return_value=True)
+                    mock_notif.return_value.queue_weather_alert = AsyncMock(return_value=True)
 
                     alerts = await service.check_weather_for_user("severe_test")
 
@@ -322,7 +347,7 @@ class TestWeatherAlertServiceMocked:
             with patch("app.services.weather_alerts.weather.get_hourly_forecast",
                        new_callable=AsyncMock, return_value=mock_forecast):
                 with patch("app.services.weather_alerts.get_notification_service") as mock_notif:
-                    mock_notif.return_value.send_weather_alert = AsyncMock(return_value=True)
+                    mock_notif.return_value.queue_weather_alert = AsyncMock(return_value=True)
 
                     alerts = await service.check_weather_for_user("rain_test")
 
@@ -331,6 +356,65 @@ class TestWeatherAlertServiceMocked:
                     assert any(a["type"] == "rain_coming" for a in alerts)
 
 
+    @pytest.mark.asyncio
+    async def test_repeated_alert_not_resent(self):
+        """Test that an ongoing condition is only re-notified after the interval."""
+        service = WeatherAlertService()
+        service.subscribe(
+            user_id="storm_test",
+            latitude=40.7128,
+            longitude=-74.0060,
+            location_name="New York",
+        )
+        mock_current = {
+            "temperature": 75.0,
+            "weather_code": 95,
+            "weather_description": "Thunderstorm",
+            "wind_speed": 10,
+            "wind_gusts": 15,
+        }
+
+        with patch("app.services.weather_alerts.weather.get_current_weather",
+                   new_callable=AsyncMock, return_value=mock_current):
+            with patch("app.services.weather_alerts.weather.get_hourly_forecast",
+                       new_callable=AsyncMock, return_value={"forecasts": []}):
+                with patch("app.services.weather_alerts.get_notification_service") as mock_notif:
+                    send = mock_notif.return_value.queue_weather_alert = AsyncMock(return_value=True)
+
+                    first = await service.check_weather_for_user("storm_test")
+                    second = await service.check_weather_for_user("storm_test")
+
+                    # Both checks report the storm, but only the first notifies
+                    assert first == second
+                    assert send.await_count == 1
+
+                    sub = service._subscriptions["storm_test"]
+                    sub.last_alert_sent["severe_weather"] -= sub.min_renotify_interval
+                    await service.check_weather_for_user("storm_test")
+                    assert send.await_count == 2
+
+
+    @pytest.mark.asyncio
+    async def test_dropped_alert_retried_next_check(self):
+        """Test that an alert the queue rejected is not held back by the re-notify interval."""
+        service = WeatherAlertService()
+        service.subscribe("dropped_test", 40.7128, -74.0060, "New York")
+        mock_current = {"temperature": 75.0, "weather_code": 95, "weather_description": "Thunderstorm"}
+
+        with patch("app.services.weather_alerts.weather.get_current_weather",
+                   new_callable=AsyncMock, return_value=mock_current):
+            with patch("app.services.weather_alerts.weather.get_hourly_forecast",
+                       new_callable=AsyncMock, return_value={"forecasts": []}):
+                with patch("app.services.weather_alerts.get_notification_service") as mock_notif:
+                    send = mock_notif.return_value.queue_weather_alert = AsyncMock(side_effect=[False, True])
+
+                    await service.check_weather_for_user("dropped_test")
+                    assert "severe_weather" not in service._subscriptions["dropped_test"].last_alert_sent
+                    await service.check_weather_for_user("dropped_test")
+                    assert send.await_count == 2
+                    assert "severe_weather" in service._subscriptions["dropped_test"].last_alert_sent
+
+
 class TestWeatherCodeDescriptions:
     """Tests for weather code to description mapping."""
 
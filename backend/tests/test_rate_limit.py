@@ -0,0 +1,66 @@
+"""Tests for per-client rate limiting."""
+import math
+
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from app import rate_limit
+from app.rate_limit import TokenBucketLimiter
+
+
+class TestTokenBucketLimiter:
+    """Tests for the token bucket."""
+
+    def test_burst_then_refill(self, monkeypatch):
+        """Test that a full bucket allows a burst and refills at the configured rate."""
+        now = [100.0]
+        monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+        limiter = TokenBucketLimiter(rate=2, period=60)
+
+        assert limiter.acquire("alice") == 0
+        assert limiter.acquire("alice") == 0
+        assert limiter.acquire("alice") == 30.0
+        assert limiter.acquire("bob") == 0
+
+        now[0] += 30
+        assert limiter.acquire("alice") == 0
+
+    def test_zero_rate_disables(self):
+        """Test that a rate of 0 never limits."""
+        limiter = TokenBucketLimiter(rate=0)
+        assert all(limiter.acquire("alice") == 0 for _ in range(100))
+
+    def test_cost_over_bucket_size_never_allowed(self):
+        """Test that a request costing more than a full bucket is refused without draining it."""
+        limiter = TokenBucketLimiter(rate=5)
+        assert limiter.acquire("alice", cost=50) == math.inf
+        assert limiter.acquire("alice", cost=5) == 0
+        assert limiter.acquire("alice") > 0
+
+    def test_tracked_clients_bounded(self):
+        """Test that the least recently seen clients are forgotten beyond maxsize."""
+        limiter = TokenBucketLimiter(rate=1, maxsize=2)
+        for key in ("a", "b", "c"):
+            limiter.acquire(key)
+        assert list(limiter._buckets) == ["b", "c"]
+
+
+class TestRateLimitDependency:
+    """Tests for the route dependency."""
+
+    def test_over_limit_returns_429_per_client(self):
+        """Test that callers are keyed by address, not a user ID they can change, and told when to retry."""
+        app = FastAPI()
+        limiter = TokenBucketLimiter(rate=1)
+
+        @app.post("/write", dependencies=[Depends(rate_limit.rate_limit(limiter))])
+        async def write():
+            return {"ok": True}
+
+        client = TestClient(app)
+        assert client.post("/write", params={"user_id": "alice"}).status_code == 200
+        response = client.post("/write", headers={"X-User-Id": "bob"}, params={"user_id": "bob"})
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "60"
+        other_client = TestClient(app, client=("203.0.113.7", 50000))
+        assert other_client.post("/write").status_code == 200
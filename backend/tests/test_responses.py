@@ -0,0 +1,21 @@
+"""Tests for the API's JSON response classes."""
+import json
+
+from app import responses
+from app.responses import OrjsonResponse
+
+
+class TestOrjsonResponse:
+    """Tests for orjson-backed response encoding."""
+
+    def test_renders_compact_utf8_json(self):
+        """Test that content round-trips with non-ASCII text left unescaped."""
+        body = OrjsonResponse({"name": "São Paulo", "temps": [21.5, None]}).body
+        assert json.loads(body) == {"name": "São Paulo", "temps": [21.5, None]}
+        assert "São".encode() in body
+
+    def test_falls_back_without_orjson(self, monkeypatch):
+        """Test that the stdlib encoder is used when orjson isn't installed."""
+        monkeypatch.setattr(responses, "ORJSON_AVAILABLE", False)
+        body = OrjsonResponse({"ok": True}).body
+        assert json.loads(body) == {"ok": True}
@@ -1,11 +1,25 @@
 """Tests for backend services."""
+import asyncio
 import pytest
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
 
+from app.services import notifications, weather_alerts
 from app.services.notifications import NotificationService, get_notification_service
 from app.services.weather_alerts import WeatherAlertService, get_weather_alert_service
 
 
+def install_fake_messaging(monkeypatch) -> MagicMock:
+    """Stand in for firebase_admin.messaging, with its token error types."""
+    fake_messaging = MagicMock()
+    fake_messaging.UnregisteredError = type("UnregisteredError", (Exception,), {})
+    fake_messaging.SenderIdMismatchError = type("SenderIdMismatchError", (Exception,), {})
+    monkeypatch.setattr(notifications, "messaging", fake_messaging, raising=False)
+    return fake_messaging
+
+
 class TestNotificationService:
     """Tests for the notification service."""
 
@@ -49,6 +63,31 @@ class TestNotificationService:
         result = service.unregister_device("never_registered")
         assert result is False
 
+    def test_expired_tokens_cleaned_up_on_registration(self):
+        """Test that only tokens unused for longer than the TTL are removed."""
+        service = NotificationService()
+        service.register_device("stale_user", "stale_token")
+        service.register_device("active_user", "active_token")
+        long_ago = time.time() - notifications.TOKEN_TTL_SECONDS - 86400
+        for user_id in ("stale_user", "active_user"):
+            info = service._device_tokens[user_id]._replace(last_used=long_ago)
+            service._device_tokens[user_id] = info
+            service._track_last_used(user_id, long_ago)
+        # Using a token refreshes it, leaving its old heap entry stale
+        service.get_device_token("active_user")
+
+        service.register_device("new_user", "new_token")
+        assert service.get_device_token("stale_user") is None
+        assert service.get_device_token("active_user") == "active_token"
+
+    def test_expiry_heap_stays_bounded(self):
+        """Test that repeated token use doesn't grow the expiry heap without limit."""
+        service = NotificationService()
+        service.register_device("busy_user", "busy_token")
+        for _ in range(1000):
+            service.get_device_token("busy_user")
+        assert len(service._expiry_heap) <= 102
+
     @pytest.mark.asyncio
     async def test_send_notification_without_token(self):
         """Test sending notification to user without device token."""
@@ -119,6 +158,196 @@ class TestNotificationService:
         assert results["multi_user_3"] is True
         assert results["no_token"] is False
 
+    @pytest.mark.asyncio
+    async def test_firebase_send_uses_async_transport(self, monkeypatch):
+        """Test that a single Firebase send is awaited, with failures reported as False."""
+        fake_messaging = install_fake_messaging(monkeypatch)
+        fake_messaging.send_each_async = AsyncMock(side_effect=[
+            SimpleNamespace(responses=[SimpleNamespace(success=True, message_id="msg-1")]),
+            SimpleNamespace(responses=[SimpleNamespace(success=False, exception=RuntimeError("unregistered"))]),
+        ])
+        service = NotificationService()
+        service._initialized = True
+        service.register_device("fcm_user", "fcm_token")
+
+        assert await service.send_notification("fcm_user", "Title", "Body") is True
+        assert await service.send_notification("fcm_user", "Title", "Body") is False
+        fake_messaging.send.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_unregistered_token_not_retried(self, monkeypatch):
+        """Test that a token FCM rejects is dropped and skipped if registered again."""
+        fake_messaging = install_fake_messaging(monkeypatch)
+        fake_messaging.send_each_async = AsyncMock(return_value=SimpleNamespace(responses=[
+            SimpleNamespace(success=False, exception=fake_messaging.UnregisteredError("gone"))
+        ]))
+        service = NotificationService()
+        service._initialized = True
+        service.register_device("gone_user", "gone_token")
+
+        assert await service.send_notification("gone_user", "Title", "Body") is False
+        assert service.get_device_token("gone_user") is None
+
+        service.register_device("gone_user", "gone_token")
+        assert await service.send_notification("gone_user", "Title", "Body") is False
+        fake_messaging.send_each_async.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_send_to_multiple_batches_fcm_calls(self, monkeypatch):
+        """Test that Firebase sends go out in batches with per-user results."""
+        def send_each_async(messages):
+            # The second message of each batch fails
+            responses = [
+                SimpleNamespace(success=i != 1, message_id=f"msg-{i}", exception=RuntimeError("invalid"))
+                for i in range(len(messages))
+            ]
+            return SimpleNamespace(responses=responses, success_count=sum(r.success for r in responses))
+
+        fake_messaging = install_fake_messaging(monkeypatch)
+        fake_messaging.send_each_async = AsyncMock(side_effect=send_each_async)
+        monkeypatch.setattr(notifications, "FCM_BATCH_SIZE", 2)
+        service = NotificationService()
+        service._initialized = True
+        for i in range(3):
+            service.register_device(f"fcm_user_{i}", f"token_{i}")
+
+        results = await service.send_to_multiple(
+            ["fcm_user_0", "fcm_user_1", "fcm_user_2", "no_token"], "Title", "Body"
+        )
+
+        assert fake_messaging.send_each_async.await_count == 2
+        assert results == {"fcm_user_0": True, "fcm_user_1": False, "fcm_user_2": True, "no_token": False}
+
+    @pytest.mark.asyncio
+    async def test_topic_members_follow_subscribers(self):
+        """Test that topic membership drops users who leave and picks up new tokens."""
+        service = NotificationService()
+        service.register_device("member_a", "token_a")
+        service.register_device("member_b", "token_b")
+
+        assert await service.set_topic_members("severe_weather_40.7_-74.0", ["member_a", "member_b"]) == 2
+        service.register_device("member_b", "token_b2")
+        assert await service.set_topic_members("severe_weather_40.7_-74.0", ["member_b", "no_device"]) == 1
+        assert service._topic_tokens["severe_weather_40.7_-74.0"] == {"token_b2"}
+
+        await service.set_topic_members("severe_weather_40.7_-74.0", [])
+        assert "severe_weather_40.7_-74.0" not in service._topic_tokens
+
+    @pytest.mark.asyncio
+    async def test_topic_subscriptions_sent_in_chunks(self, monkeypatch):
+        """Test that new topic members are subscribed in FCM-sized chunks, not one by one."""
+        fake_messaging = install_fake_messaging(monkeypatch)
+        monkeypatch.setattr(notifications, "FCM_TOPIC_BATCH_SIZE", 2)
+        service = NotificationService()
+        service._initialized = True
+        for i in range(5):
+            service.register_device(f"chunk_user_{i}", f"token_{i}")
+
+        await service.set_topic_members("severe_weather_0.0_0.0", [f"chunk_user_{i}" for i in range(5)])
+
+        chunks = [call.args[0] for call in fake_messaging.subscribe_to_topic.call_args_list]
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        assert sorted(token for chunk in chunks for token in chunk) == [f"token_{i}" for i in range(5)]
+        fake_messaging.unsubscribe_from_topic.assert_not_called()
+
+    def test_data_payload_encoded_as_strings(self):
+        """Test that scalars keep their str() form and only containers are sent as JSON text."""
+        encoded = notifications._encode_data({
+            "type": "weather_alert", "severity": 3, "urgent": True, "extra": None,
+            "hours": [1, 2], "location": {"lat": 1.5},
+        })
+        assert encoded == {
+            "type": "weather_alert",
+            "severity": "3",
+            "urgent": "True",
+            "extra": "None",
+            "hours": "[1,2]",
+            "location": '{"lat":1.5}',
+        }
+        assert notifications._encode_data(None) == {}
+
+    @pytest.mark.asyncio
+    async def test_broadcast_shares_payload_between_messages(self, monkeypatch):
+        """Test that a broadcast converts its data payload and content once."""
+        fake_messaging = install_fake_messaging(monkeypatch)
+        fake_messaging.send_each_async = AsyncMock(side_effect=lambda messages: SimpleNamespace(
+            responses=[SimpleNamespace(success=True, message_id="msg") for _ in messages]
+        ))
+        service = NotificationService()
+        service._initialized = True
+        for i in range(3):
+            service.register_device(f"broadcast_user_{i}", f"token_{i}")
+
+        await service.send_to_multiple(
+            [f"broadcast_user_{i}" for i in range(3)], "Title", "Body", data={"severity": 3}
+        )
+
+        assert fake_messaging.Notification.call_count == 1
+        payloads = [call.kwargs["data"] for call in fake_messaging.Message.call_args_list]
+        assert payloads[0] == {"severity": "3"}
+        assert all(payload is payloads[0] for payload in payloads)
+
+    @pytest.mark.asyncio
+    async def test_queued_notifications_sent_in_one_batch(self, monkeypatch):
+        """Test that a burst of alerts and direct sends reaches FCM as one batch."""
+        fake_messaging = install_fake_messaging(monkeypatch)
+        fake_messaging.send_each_async = AsyncMock(side_effect=lambda messages: SimpleNamespace(
+            responses=[SimpleNamespace(success=True, message_id="msg") for _ in messages]
+        ))
+        service = NotificationService()
+        service._initialized = True
+        for i in range(3):
+            service.register_device(f"burst_user_{i}", f"token_{i}")
+
+        await service.start_workers(count=1)
+        assert await service.queue_weather_alert(
+            "burst_user_0", alert_type="rain", location="Seattle", message="Rain soon", severity="warning"
+        )
+        assert await service.queue_notification("burst_user_1", "Title", "Body")
+        sent = await service.send_notification("burst_user_2", "Title", "Body")
+        await service.stop_workers()
+
+        assert sent is True
+        fake_messaging.send_each_async.assert_awaited_once()
+        assert len(fake_messaging.send_each_async.await_args.args[0]) == 3
+        assert fake_messaging.Notification.call_args_list[0].kwargs["title"] == "⚠️ Weather Alert - Seattle"
+
+    @pytest.mark.asyncio
+    async def test_full_queue_drops_notification(self, monkeypatch):
+        """Test that notifications beyond the queue size are rejected instead of blocking."""
+        monkeypatch.setattr(notifications, "NOTIFICATION_QUEUE_SIZE", 1)
+        service = NotificationService()
+        await service.start_workers(count=1)
+
+        # Workers don't run until the test yields to the event loop
+        assert await service.queue_notification("u1", "Title", "Body") is True
+        assert await service.queue_notification("u2", "Title", "Body") is False
+        await service.stop_workers()
+
+    @pytest.mark.asyncio
+    async def test_shutdown_fails_unsent_notifications(self, monkeypatch):
+        """Test that sends still queued at shutdown return False instead of hanging."""
+        monkeypatch.setattr(notifications, "NOTIFICATION_DRAIN_TIMEOUT", 0.01)
+        service = NotificationService()
+        service.register_device("late_user", "late_token")
+        # Workers that never take anything off the queue
+        monkeypatch.setattr(service, "_send_worker", lambda: asyncio.sleep(3600))
+        await service.start_workers(count=1)
+
+        pending = asyncio.create_task(service.send_notification("late_user", "Title", "Body"))
+        await asyncio.sleep(0)
+        await service.stop_workers()
+
+        assert await asyncio.wait_for(pending, 1) is False
+
+    @pytest.mark.asyncio
+    async def test_queue_sends_inline_without_workers(self):
+        """Test that queueing falls back to sending when workers aren't running."""
+        service = NotificationService()
+        service.register_device("inline_user", "inline_token")
+        assert await service.queue_notification("inline_user", "Title", "Body") is True
+        assert await service.queue_notification("no_token", "Title", "Body") is False
+
     def test_global_service_singleton(self):
         """Test that get_notification_service returns singleton."""
         service1 = get_notification_service()
@@ -147,6 +376,16 @@ class TestWeatherAlertService:
         assert result is True
         assert "sub_user" in service._subscriptions
 
+    def test_subscription_has_no_instance_dict(self):
+        """Test that subscriptions use slots and ignore unknown update keys."""
+        service = WeatherAlertService()
+        service.subscribe("slots_user", 40.7128, -74.0060, "New York")
+        sub = service._subscriptions["slots_user"]
+        assert not hasattr(sub, "__dict__")
+
+        service.update_subscription("slots_user", rain_alerts=False, not_a_field=True)
+        assert sub.rain_alerts is False
+
     def test_subscribe_with_options(self):
         """Test subscribing with custom options."""
         service = WeatherAlertService()
@@ -247,6 +486,206 @@ class TestWeatherAlertService:
         alerts = await service.check_weather_for_user("nonexistent")
         assert alerts == []
 
+    @pytest.mark.asyncio
+    async def test_check_all_users_bounded_concurrency(self, monkeypatch):
+        """Test that subscribers are checked concurrently, within the limit, despite failures."""
+        monkeypatch.setattr(weather_alerts, "MAX_CONCURRENT_ALERT_CHECKS", 3)
+        service = WeatherAlertService()
+        for i in range(10):
+            service.subscribe(f"bulk_user_{i}", 0, 0, "Test")
+        active = {"now": 0, "peak": 0}
+        checked = []
+
+        async def check_weather_for_user(user_id, now=None, notify_severe=True, timestamp=None):
+            active["now"] += 1
+            active["peak"] = max(active["peak"], active["now"])
+            await asyncio.sleep(0.01)
+            active["now"] -= 1
+            if user_id == "bulk_user_0":
+                raise RuntimeError("upstream down")
+            checked.append(user_id)
+
+        service.check_weather_for_user = check_weather_for_user
+        monkeypatch.setattr(service, "_broadcast_severe_alert", AsyncMock())
+        await service.check_all_users()
+
+        assert active["peak"] == 3
+        assert len(checked) == 9
+
+    @pytest.mark.asyncio
+    async def test_check_all_users_spreads_cells_over_interval(self, monkeypatch):
+        """Test that each grid cell's check is staggered evenly across the spread."""
+        service = WeatherAlertService()
+        service.subscribe("spread_user_a", 10.0, 10.0, "A")
+        service.subscribe("spread_user_b", 20.0, 20.0, "B")
+        service.subscribe("spread_user_c", 30.0, 30.0, "C")
+        check_times = {}
+
+        async def check_weather_for_user(user_id, now=None, notify_severe=True, timestamp=None):
+            check_times[user_id] = now
+
+        service.check_weather_for_user = check_weather_for_user
+        monkeypatch.setattr(service, "_broadcast_severe_alert", AsyncMock())
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await service.check_all_users(spread=0.3)
+
+        assert loop.time() - started >= 0.2
+        times = [check_times[f"spread_user_{name}"] for name in "abc"]
+        assert times[1] - times[0] == timedelta(seconds=0.1)
+        assert times[2] - times[0] == timedelta(seconds=0.2)
+
+    @pytest.mark.asyncio
+    async def test_unsubscribe_during_spread_pass(self, monkeypatch):
+        """Test that a user who unsubscribes before their cell's turn is not alerted or stamped."""
+        service = WeatherAlertService()
+        service.subscribe("late_user_a", 10.0, 10.0, "A")
+        service.subscribe("late_user_b", 20.0, 20.0, "B")
+        service.subscribe("late_user_c", 20.0, 20.0, "B")
+        checked, broadcast = [], []
+
+        async def check_weather_for_user(user_id, now=None, notify_severe=True, timestamp=None):
+            checked.append(user_id)
+            if user_id == "late_user_a":
+                service.unsubscribe("late_user_b")
+                service.subscribe("late_user_c", 20.0, 20.0, "B")
+
+        async def broadcast_severe_alert(cell, subs, now, timestamp):
+            broadcast.append([sub.user_id for sub in subs])
+
+        service.check_weather_for_user = check_weather_for_user
+        monkeypatch.setattr(service, "_broadcast_severe_alert", broadcast_severe_alert)
+        await service.check_all_users(spread=0.1)
+
+        assert checked == ["late_user_a"]
+        assert broadcast == [["late_user_a"]]
+
+    @pytest.mark.asyncio
+    async def test_aclose_cancels_monitoring_pass(self, monkeypatch):
+        """Test that closing the service stops a monitoring pass that is still running."""
+        service = WeatherAlertService()
+        monkeypatch.setattr(service, "check_all_users", lambda spread=0: asyncio.sleep(3600))
+        monitor = asyncio.create_task(service.start_monitoring())
+        await asyncio.sleep(0)
+        assert service._running is True
+
+        await service.aclose()
+
+        assert monitor.cancelled()
+        assert service._running is False
+
+    @pytest.mark.asyncio
+    async def test_nearby_subscribers_share_weather_fetch(self, monkeypatch):
+        """Test that subscribers in one grid cell trigger one pair of weather calls."""
+        current = AsyncMock(return_value={"temperature": 70, "weather_code": 0})
+        forecast = AsyncMock(return_value={"forecasts": []})
+        monkeypatch.setattr(weather_alerts.weather, "get_current_weather", current)
+        monkeypatch.setattr(weather_alerts.weather, "get_hourly_forecast", forecast)
+        service = WeatherAlertService()
+        service.subscribe("downtown_user", 40.71, -74.00, "Downtown")
+        service.subscribe("village_user", 40.73, -74.02, "Village")
+        service.subscribe("boston_user", 42.36, -71.06, "Boston")
+
+        await service.check_all_users()
+
+        assert current.await_count == 2
+        assert forecast.await_count == 2
+        current.assert_any_await(latitude=40.7, longitude=-74.0)
+
+    @pytest.mark.asyncio
+    async def test_cell_alerts_evaluated_once(self, monkeypatch):
+        """Test that storm and rain checks run once per grid cell, not per subscriber."""
+        monkeypatch.setattr(
+            weather_alerts.weather, "get_current_weather",
+            AsyncMock(return_value={"temperature": 70, "weather_code": 95, "weather_description": "Thunderstorm"}),
+        )
+        monkeypatch.setattr(
+            weather_alerts.weather, "get_hourly_forecast", AsyncMock(return_value={"forecasts": []})
+        )
+        service = WeatherAlertService()
+        severe_check = MagicMock(wraps=service._check_severe_weather)
+        monkeypatch.setattr(service, "_check_severe_weather", severe_check)
+        for index in range(5):
+            service.subscribe(f"storm_user_{index}", 40.71, -74.00, "New York")
+
+        notification_service = MagicMock(queue_weather_alert=AsyncMock(return_value=True))
+        monkeypatch.setattr(weather_alerts, "get_notification_service", lambda: notification_service)
+        alerts = await asyncio.gather(
+            *(service.check_weather_for_user(f"storm_user_{index}") for index in range(5))
+        )
+
+        assert severe_check.call_count == 1
+        assert all(user_alerts[0]["type"] == "severe_weather" for user_alerts in alerts)
+
+    @pytest.mark.asyncio
+    async def test_cell_alerts_share_timestamp(self, monkeypatch):
+        """Test that alerts in one grid cell share a timestamp taken at the cell's check time."""
+        monkeypatch.setattr(
+            weather_alerts.weather, "get_current_weather",
+            AsyncMock(return_value={"temperature": 70, "weather_code": 1, "precipitation": 0}),
+        )
+        monkeypatch.setattr(
+            weather_alerts.weather, "get_hourly_forecast",
+            AsyncMock(return_value={"forecasts": [{"precipitation_probability": 90, "time": "2024-01-15T10:00"}]}),
+        )
+        notification_service = MagicMock(queue_weather_alert=AsyncMock(return_value=True))
+        monkeypatch.setattr(weather_alerts, "get_notification_service", lambda: notification_service)
+        service = WeatherAlertService()
+        service.subscribe("pass_user_a", 40.71, -74.00, "New York")
+        service.subscribe("pass_user_a2", 40.72, -74.01, "New York")
+        service.subscribe("pass_user_b", 42.36, -71.06, "Boston")
+
+        await service.check_all_users(spread=0.02)
+
+        timestamps = {
+            call.kwargs["user_id"]: call.kwargs["timestamp"]
+            for call in notification_service.queue_weather_alert.await_args_list
+        }
+        assert len(timestamps) == 3
+        assert timestamps["pass_user_a"] == timestamps["pass_user_a2"]
+        assert timestamps["pass_user_b"] > timestamps["pass_user_a"]
+
+    @pytest.mark.asyncio
+    async def test_severe_alert_sent_once_per_cell_topic(self, monkeypatch):
+        """Test that a storm over a cell sends one topic message to its opted-in subscribers."""
+        monkeypatch.setattr(
+            weather_alerts.weather, "get_current_weather",
+            AsyncMock(return_value={"temperature": 70, "weather_code": 95, "weather_description": "Thunderstorm"}),
+        )
+        monkeypatch.setattr(
+            weather_alerts.weather, "get_hourly_forecast", AsyncMock(return_value={"forecasts": []})
+        )
+        notification_service = NotificationService()
+        monkeypatch.setattr(weather_alerts, "get_notification_service", lambda: notification_service)
+        monkeypatch.setattr(notification_service, "send_to_topic", AsyncMock(return_value=True))
+        monkeypatch.setattr(notification_service, "queue_weather_alert", AsyncMock(return_value=True))
+        service = WeatherAlertService()
+        for index in range(3):
+            service.subscribe(f"topic_user_{index}", 40.71, -74.00, "New York")
+            notification_service.register_device(f"topic_user_{index}", f"topic_token_{index}")
+        service.update_subscription("topic_user_2", severe_weather_alerts=False)
+
+        await service.check_all_users()
+        await service.check_all_users()
+
+        topic = weather_alerts.severe_alert_topic((40.7, -74.0))
+        notification_service.send_to_topic.assert_awaited_once()
+        assert notification_service.send_to_topic.await_args.args[0] == topic
+        assert notification_service.send_to_topic.await_args.kwargs["title"].endswith("40.7°N, 74.0°W")
+        assert notification_service._topic_tokens[topic] == {"topic_token_0", "topic_token_1"}
+        notification_service.queue_weather_alert.assert_not_awaited()
+
+        # A subscriber joining mid-storm gets the alert; those already alerted don't
+        service.subscribe("topic_user_3", 40.72, -74.01, "Grandma's house")
+        notification_service.register_device("topic_user_3", "topic_token_3")
+        first_alert = service._subscriptions["topic_user_0"].last_alert_sent["severe_weather"]
+        await service.check_all_users()
+
+        assert notification_service.send_to_topic.await_count == 2
+        assert "Grandma" not in str(notification_service.send_to_topic.await_args)
+        assert notification_service._topic_tokens[topic] == {"topic_token_3"}
+        assert service._subscriptions["topic_user_0"].last_alert_sent["severe_weather"] == first_alert
+
     def test_global_service_singleton(self):
         """Test that get_weather_alert_service returns singleton."""
         service1 = get_weather_alert_service()
@@ -260,8 +699,6 @@ class TestAlertDetection:
     def test_severe_weather_detection_thunderstorm(self):
         """Test detection of thunderstorm conditions."""
         service = WeatherAlertService()
-        service.subscribe("severe_user", 0, 0, "Test")
-        sub = service._subscriptions["severe_user"]
 
         # Simulate thunderstorm conditions
         current = {
@@ -271,15 +708,13 @@ class TestAlertDetection:
             "wind_gusts": 35
         }
 
-        alert = service._check_severe_weather(current, sub)
+        alert = service._check_severe_weather(current)
         assert alert is not None
         assert alert["type"] == "severe_weather"
 
     def test_severe_weather_detection_high_wind(self):
         """Test detection of high wind conditions."""
         service = WeatherAlertService()
-        service.subscribe("wind_user", 0, 0, "Test")
-        sub = service._subscriptions["wind_user"]
 
         # Simulate high wind conditions
         current = {
@@ -289,15 +724,13 @@ class TestAlertDetection:
             "wind_gusts": 55
         }
 
-        alert = service._check_severe_weather(current, sub)
+        alert = service._check_severe_weather(current)
         assert alert is not None
         assert alert["type"] == "high_wind"
 
     def test_no_severe_weather(self):
         """Test no alert for normal conditions."""
         service = WeatherAlertService()
-        service.subscribe("normal_user", 0, 0, "Test")
-        sub = service._subscriptions["normal_user"]
 
         # Normal conditions
         current = {
@@ -307,14 +740,12 @@ class TestAlertDetection:
             "wind_gusts": 15
         }
 
-        alert = service._check_severe_weather(current, sub)
+        alert = service._check_severe_weather(current)
         assert alert is None
 
     def test_rain_detection(self):
         """Test detection of upcoming rain."""
         service = WeatherAlertService()
-        service.subscribe("rain_user", 0, 0, "Test")
-        sub = service._subscriptions["rain_user"]
 
         current = {"precipitation": 0}  # Not currently raining
 
@@ -326,7 +757,7 @@ class TestAlertDetection:
             ]
         }
 
-        alert = service._check_rain(current, forecast, sub)
+        alert = service._check_rain(current, forecast)
         assert alert is not None
         assert alert["type"] == "rain_coming"
         assert alert["probability"] == 80
@@ -334,8 +765,6 @@ class TestAlertDetection:
     def test_no_rain_when_already_raining(self):
         """Test no rain alert when already raining."""
         service = WeatherAlertService()
-        service.subscribe("raining_user", 0, 0, "Test")
-        sub = service._subscriptions["raining_user"]
 
         current = {"precipitation": 0.5}  # Currently raining
 
@@ -345,7 +774,7 @@ class TestAlertDetection:
             ]
         }
 
-        alert = service._check_rain(current, forecast, sub)
+        alert = service._check_rain(current, forecast)
         assert alert is None
 
     def test_temperature_high_alert(self):